@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import graph_transit
+import quad_tree
+import schedule
+import synthetic_feed
+
+# Times and memory-profiles the load and query stages on synthetic feeds
+# of several sizes, writing one JSON record per (scale, stage) so runs can
+# be diffed in review or plotted as scaling curves.
+
+SCALES = {
+	"tiny": dict(stops = 200, routes = 5, tripsPerRoute = 20),
+	"small": dict(stops = 1000, routes = 20, tripsPerRoute = 60),
+	"medium": dict(stops = 5000, routes = 80, tripsPerRoute = 120),
+	"large": dict(stops = 20000, routes = 250, tripsPerRoute = 200),
+}
+DEFAULT_SCALES = ("tiny", "small", "medium")
+SERVICE_DAYS = 28
+STOPS_PER_ROUTE = 20
+STAGES = ("loadSchedule", "finish", "getTrips", "formEdges", "quadTreeInsert")
+
+# runs every stage once on a fresh Schedule; measure(name, stage) runs a
+# stage, which returns how many rows/items/edges it produced
+def runStages(path, measure, serviceDays = SERVICE_DAYS):
+	sched = schedule.Schedule()
+
+	def load():
+		sched.loadSchedule(path)
+		return len(sched.stopTimes.pending["tripIndex"])
+
+	def finish():
+		sched.finish()
+		return len(sched.stopTimes)
+
+	def getTrips():
+		trips = 0
+		for day in range(serviceDays):
+			trips += len(sched.getTrips(synthetic_feed.START_DATE + datetime.timedelta(days = day)))
+		return trips
+
+	def formEdges():
+		stops = sched.getStops(synthetic_feed.START_DATE)
+		graph = graph_transit.StopGraph()
+		for stop in stops:
+			graph.addVertex(stop)
+		graph.formEdges(stops)
+		return sum(len(edges) for edges in graph.vertices.values())
+
+	def quadTreeInsert():
+		tree = quad_tree.QuadTree()
+		for stop in sched.stopTimes.stops:
+			tree.insert(quad_tree.Item(stop, stop.longitude, stop.latitude))
+		return len(tree)
+
+	for name, stage in zip(STAGES, (load, finish, getTrips, formEdges, quadTreeInsert)):
+		measure(name, stage)
+
+class Timer:
+	def __init__(self):
+		self.results = {}
+
+	def __call__(self, name, stage):
+		start = time.perf_counter()
+		count = stage()
+		self.results[name] = (time.perf_counter() - start, count)
+
+# traced python and numpy allocations: the peak above what was live when
+# the stage started, and what the stage left allocated
+class MemoryProfiler:
+	def __init__(self):
+		self.results = {}
+
+	def __call__(self, name, stage):
+		before = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+		stage()
+		current, peak = tracemalloc.get_traced_memory()
+		self.results[name] = (peak - before, current - before)
+
+def feedPath(workDir, scale, serviceDays):
+	sizes = SCALES[scale]
+	name = "%s-%d-%d-%d-%d-%d" % (scale, sizes["stops"], sizes["routes"],
+			sizes["tripsPerRoute"], STOPS_PER_ROUTE, serviceDays)
+	return os.path.join(workDir, name)
+
+# the generator is deterministic, so a feed already on disk is reused
+def ensureFeed(workDir, scale, serviceDays):
+	path = feedPath(workDir, scale, serviceDays)
+	if not os.path.isfile(os.path.join(path, "stop_times.txt")):
+		synthetic_feed.generateFeed(path, serviceDays = serviceDays,
+				stopsPerRoute = STOPS_PER_ROUTE, **SCALES[scale])
+	return path
+
+def benchmarkScale(workDir, scale, repeat = 3, serviceDays = SERVICE_DAYS):
+	path = ensureFeed(workDir, scale, serviceDays)
+	timings = []
+	for _ in range(repeat):
+		timer = Timer()
+		runStages(path, timer, serviceDays)
+		timings.append(timer.results)
+
+	# a separate pass, since tracing slows everything it measures
+	profiler = MemoryProfiler()
+	tracemalloc.start()
+	try:
+		runStages(path, profiler, serviceDays)
+	finally:
+		tracemalloc.stop()
+
+	records = []
+	for stage in STAGES:
+		samples = [t[stage][0] for t in timings]
+		record = dict(scale = scale, serviceDays = serviceDays,
+				stopsPerRoute = STOPS_PER_ROUTE, **SCALES[scale])
+		record.update(
+			stage = stage,
+			count = timings[0][stage][1],
+			seconds = min(samples),
+			secondsMedian = statistics.median(samples),
+			samples = samples,
+			peakBytes = profiler.results[stage][0],
+			retainedBytes = profiler.results[stage][1],
+		)
+		records.append(record)
+	return records
+
+def environment():
+	return dict(
+		python = platform.python_version(),
+		numpy = np.__version__,
+		machine = platform.machine(),
+		system = platform.system(),
+		cpus = os.cpu_count(),
+		timestamp = datetime.datetime.now().isoformat(timespec = "seconds"),
+	)
+
+def formatRecord(record):
+	values = (record["scale"], record["stage"], record["count"], record["seconds"] * 1000,
+			record["peakBytes"] / float(1 << 20))
+	return "%-8s %-15s %10d %10.1f ms %9.1f MiB" % values
+
+def main():
+	parser = argparse.ArgumentParser(description = "time and profile schedule stages")
+	parser.add_argument("--scales", default = ",".join(DEFAULT_SCALES),
+			help = "comma separated, from %s" % ", ".join(SCALES))
+	parser.add_argument("--repeat", type = int, default = 3)
+	parser.add_argument("--service-days", type = int, default = SERVICE_DAYS)
+	parser.add_argument("--work-dir", default = os.path.join(tempfile.gettempdir(), "transit-benchmark"),
+			help = "where generated feeds are kept between runs")
+	parser.add_argument("--output", default = "benchmark.json")
+	args = parser.parse_args()
+
+	records = []
+	for scale in args.scales.split(","):
+		for record in benchmarkScale(args.work_dir, scale, args.repeat, args.service_days):
+			print(formatRecord(record))
+			records.append(record)
+
+	with open(args.output, 'w') as f:
+		json.dump(dict(environment = environment(), repeat = args.repeat, results = records),
+				f, indent = 1)
+	print(args.output)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+import pytest
+import realtime
+import schedule
+import synthetic_feed
+
+# Feeds shared by the tests: a small synthetic one, and tiny hand-written
+# ones for regression cases.
+
+DATE = datetime.date(2016, 10, 5) # a wednesday in the synthetic service
+WALK_KM = 0.5
+
+# a feed of the given stops ((id, lat, lon)) and trips ((id, [(stop id,
+# "HH:MM:SS")])), running every day of October 2016. A call's time may
+# also be an (arrival, departure) pair.
+def writeFeed(path, stops, trips):
+	os.makedirs(path, exist_ok = True)
+	tables = {
+		"calendar": ["service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date",
+				"ALL,1,1,1,1,1,1,1,20161001,20161031"],
+		"routes": ["route_id,route_short_name,route_long_name", "R,R,"],
+		"trips": ["route_id,service_id,trip_id"] + ["R,ALL,%s" % trip for trip, _ in trips],
+		"stops": ["stop_id,stop_name,stop_lat,stop_lon"]
+				+ ["%s,%s,%.7f,%.7f" % (stop, stop, lat, lon) for stop, lat, lon in stops],
+		"stop_times": ["trip_id,arrival_time,departure_time,stop_id,stop_sequence"],
+	}
+	for trip, calls in trips:
+		for seq, (stop, at) in enumerate(calls):
+			arrival, departure = (at, at) if isinstance(at, str) else at
+			tables["stop_times"].append("%s,%s,%s,%s,%d" % (trip, arrival, departure, stop, seq + 1))
+	for name, lines in tables.items():
+		with open(os.path.join(path, name + ".txt"), 'w') as f:
+			f.write("\n".join(lines) + "\n")
+	return path
+
+def loadFeed(path):
+	sched = schedule.Schedule()
+	sched.loadSchedule(path)
+	sched.finish()
+	return sched
+
+# delays, cancellations and skipped stops on random trips running on DATE
+def applyRandomUpdates(sched, rng):
+	trips = sched.getTrips(DATE)
+	for trip in rng.sample(trips, 30):
+		realtime.applyUpdate(sched, dict(trip_id = trip.trip_id, delay = rng.choice([-120, 60, 600])))
+	for trip in rng.sample(trips, 8):
+		realtime.applyUpdate(sched, dict(trip_id = trip.trip_id, cancelled = True))
+	for trip in rng.sample(trips, 15):
+		stop = rng.choice(trip.stops)
+		realtime.applyUpdate(sched, dict(trip_id = trip.trip_id, skip_stop = stop.stop_id))
+
+@pytest.fixture(scope = "session")
+def feedPath(tmp_path_factory):
+	path = str(tmp_path_factory.mktemp("synthetic"))
+	synthetic_feed.generateFeed(path, stops = 200, routes = 6, tripsPerRoute = 20,
+			serviceDays = 7, stopsPerRoute = 15, seed = 3, shapes = False)
+	return path
+
+@pytest.fixture
+def sched(feedPath):
+	return loadFeed(feedPath)
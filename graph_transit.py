@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 
+import heapq
 import math
+from bisect import bisect_left
+import numpy as np
+import instrument
+import quad_tree
 import schedule
+import snapshot
 import time_space
 
 TRANSFER_DISTANCE_LIMIT = 1 # km
 MINUTE_PENALTY_PER_TRANSFER = 15
 PENALTY_LIMIT = 30
 MINUTES_PER_KM = 12
+SEARCH_MARGIN = 1.001
 
 class Penalty:
 	def __init__(self, time, distance, transfers = 0):
@@ -32,11 +39,13 @@ class Penalty:
 	@classmethod
 	def getPenalty(cls, sourceStopTime, destStopTime):
 		# don't travel back in time
-		if sourceStopTime.arrivalTime.after(destStopTime.arrivalTime):
+		sourceSeconds = sourceStopTime.arrivalSeconds
+		destSeconds = destStopTime.arrivalSeconds
+		if sourceSeconds > destSeconds:
 			return cls(time_space.Time(-1), None, None)
 
-		time = destStopTime.arrivalTime.diff(sourceStopTime.arrivalTime)
-		dist = destStopTime.location.distanceTo(sourceStopTime.distance)
+		time = time_space.Time(seconds = destSeconds - sourceSeconds)
+		dist = sourceStopTime.stop.distanceTo(destStopTime.stop)
 		transfers = 1
 		if sourceStopTime.onSameTrip(destStopTime):
 			transfers = 0
@@ -65,6 +74,9 @@ class Graph:
 
 		self.vertices[source][dest] = penalty
 
+	def freeze(self):
+		return CsrGraph.fromGraph(self)
+
 	def neighborString(self, source):
 		es = self.vertices[source]
 		form = "\t%s: %s"
@@ -95,29 +107,427 @@ class StopGraph(Graph):
 		return False
 
 
+	# a box holding every point within km of stop. Degrees of longitude
+	# shrink towards the poles, so they are sized for the parallel nearest
+	# the pole the box reaches; the margin absorbs rounding.
+	@staticmethod
+	def searchBounds(stop, km):
+		dLat = km * SEARCH_MARGIN / time_space.KM_PER_DEGREE
+		poleward = min(abs(stop.latitude) + dLat, 90.0)
+		cosLat = max(math.cos(math.radians(poleward)), 0.01)
+		dLon = dLat / cosLat
+		lat = stop.latitude
+		lon = stop.longitude
+		return quad_tree.Bounds(lon - dLon, lon + dLon, lat - dLat, lat + dLat)
+
+	# queries yield positions in stops
+	@staticmethod
+	def stopTree(stops):
+		lons = [stop.longitude for stop in stops]
+		lats = [stop.latitude for stop in stops]
+		return quad_tree.PackedQuadTree.fromArrays(lons, lats)
+
 	def formEdges(self, stops):
-		for i, source in enumerate(stops):
-			print("%d of %d" % (i, len(stops)))
-			for dest in stops:
-				if self.__class__.areReasonableNeighbors(source, dest):
-					transfers = 0 if source.onSameRoute(dest) else 1
-					time = time_space.Time()
-					dist = source.distanceTo(dest)
-					penalty = Penalty(time, dist, transfers)
-					self.addEdge(source, dest, penalty)
-					#bother = Bother.getBother(source, dest)
-					#if bother.penalty < BOTHER_LIMIT:
-					#	self.vertices[source].addEdge(dest, bother)
+		with instrument.span("graph.formEdges") as span:
+			span.addRows(self.addEdges(stops))
+
+	# how many edges were added
+	def addEdges(self, stops):
+		if len(stops) == 0:
+			return 0
+		added = 0
+		position = {stop: i for i, stop in enumerate(stops)}
+		with instrument.span("graph.stopTree") as span:
+			tree = self.__class__.stopTree(stops)
+			span.addRows(len(stops))
+
+		for source in stops:
+			dests = {d for d in source.nextStops if d is not source and d in position}
+			bounds = self.__class__.searchBounds(source, TRANSFER_DISTANCE_LIMIT)
+			for i in tree.getOverlappers(bounds):
+				dest = stops[i]
+				if dest is not source and not source.onSameRoute(dest):
+					dests.add(dest)
+			if len(dests) == 0:
+				continue
+
+			dests = sorted(dests, key = position.get)
+			kms = source.location.distancesTo([dest.location for dest in dests])
+			for dest, km in zip(dests, kms.tolist()):
+				transfers = 0 if source.onSameRoute(dest) else 1
+				if transfers == 1 and km >= TRANSFER_DISTANCE_LIMIT:
+					continue
+				time = time_space.Time()
+				penalty = Penalty(time, time_space.Distance(km), transfers)
+				self.addEdge(source, dest, penalty)
+				added += 1
+		return added
+
+# A frozen Graph in compressed sparse row form: vertices are numbered in
+# insertion order, the edges leaving vertex v are targets[offsets[v]:
+# offsets[v + 1]], and every Penalty's weight is computed once into
+# weights. Penalty parts are kept alongside so toGraph can rebuild it.
+class CsrGraph:
+	def __init__(self, vertices, offsets, targets, weights, seconds, kms, transfers):
+		self.vertices = vertices
+		self.ids = {v: i for i, v in enumerate(vertices)}
+		self.offsets = offsets
+		self.targets = targets
+		self.weights = weights
+		self.seconds = seconds
+		self.kms = kms
+		self.transfers = transfers
+		self.adjacency = None
+		self.kmWeight = None
+
+	@classmethod
+	def fromGraph(cls, graph):
+		vertices = list(graph.vertices)
+		seen = set(vertices)
+		for edges in graph.vertices.values():
+			for dest in edges:
+				if dest not in seen:
+					seen.add(dest)
+					vertices.append(dest)
+		ids = {v: i for i, v in enumerate(vertices)}
+
+		counts = np.zeros(len(vertices) + 1, dtype = np.int64)
+		targets = []
+		penalties = []
+		for source, edges in graph.vertices.items():
+			counts[ids[source] + 1] = len(edges)
+			targets.extend(ids[dest] for dest in edges)
+			penalties.extend(edges.values())
+		# graph.vertices iterates in id order, so edges are already grouped
+		offsets = np.cumsum(counts)
+		weights = np.array([p.weight for p in penalties], dtype = float)
+		seconds = np.array([p.time.seconds for p in penalties], dtype = np.int32)
+		kms = np.array([math.nan if p.distance is None else p.distance.km
+				for p in penalties], dtype = float)
+		transfers = np.array([p.transfers or 0 for p in penalties], dtype = np.int32)
+		return cls(vertices, offsets, np.array(targets, dtype = np.int32), weights,
+				seconds, kms, transfers)
+
+	def penalty(self, edge):
+		km = float(self.kms[edge])
+		distance = None if math.isnan(km) else time_space.Distance(km)
+		time = time_space.Time(seconds = int(self.seconds[edge]))
+		return Penalty(time, distance, int(self.transfers[edge]))
+
+	def toGraph(self, cls = None):
+		graph = (cls or StopGraph)()
+		for v, vertex in enumerate(self.vertices):
+			graph.addVertex(vertex)
+			for edge in range(self.offsets[v], self.offsets[v + 1]):
+				graph.addEdge(vertex, self.vertices[self.targets[edge]], self.penalty(edge))
+		return graph
+
+	def __len__(self):
+		return len(self.vertices)
+
+	def edgeCount(self):
+		return len(self.targets)
+
+	# the arrays as python lists, which the search loop indexes much faster
+	def lists(self):
+		if self.adjacency is None:
+			self.adjacency = (self.offsets.tolist(), self.targets.tolist(),
+					self.weights.tolist())
+		return self.adjacency
+
+	# the largest factor f with every edge weighing at least f * its
+	# straight-line km, so f * km to the target never overestimates. One
+	# free edge between distinct places makes it 0, and StopGraph's edges
+	# along a route are free (no time, no transfer), so for StopGraph there
+	# is no distance bound and A* is plain Dijkstra. Leaving those edges out
+	# would give a larger factor that overestimates along routes.
+	def weightPerKm(self):
+		if self.kmWeight is None:
+			lats = np.array([v.latitude for v in self.vertices])
+			lons = np.array([v.longitude for v in self.vertices])
+			sources = np.repeat(np.arange(len(self.vertices)), np.diff(self.offsets))
+			kms = time_space.distancesKm(lats[sources], lons[sources],
+					lats[self.targets], lons[self.targets])
+			moving = kms > 0
+			ratios = self.weights[moving] / kms[moving]
+			self.kmWeight = float(ratios.min()) if len(ratios) > 0 else 0.0
+		return self.kmWeight
+
+	# an admissible A* heuristic towards target, by vertex id; None when
+	# weightPerKm has no bound to offer
+	def distanceHeuristic(self, target):
+		factor = self.weightPerKm()
+		if factor <= 0:
+			return None
+		vertex = self.vertices[target]
+		lats = [v.latitude for v in self.vertices]
+		lons = [v.longitude for v in self.vertices]
+		kms = time_space.distancesFrom(vertex.latitude, vertex.longitude, lats, lons)
+		return (kms * factor).tolist()
+
+	# Dijkstra, or A* with heuristic (a list by vertex id), from source to
+	# every vertex or until target is settled. Ids in, (cost, predecessor)
+	# lists by vertex id out, predecessor -1 where there is none.
+	def search(self, source, target = None, heuristic = None):
+		offsets, targets, weights = self.lists()
+		count = len(self.vertices)
+		cost = [math.inf] * count
+		previous = [-1] * count
+		settled = [False] * count
+		cost[source] = 0.0
+		heap = [(0.0, source)]
+		while len(heap) > 0:
+			_, v = heapq.heappop(heap)
+			if settled[v]:
+				continue
+			settled[v] = True
+			if v == target:
+				break
+			here = cost[v]
+			for edge in range(offsets[v], offsets[v + 1]):
+				u = targets[edge]
+				total = here + weights[edge]
+				if total < cost[u]:
+					cost[u] = total
+					previous[u] = v
+					key = total if heuristic is None else total + heuristic[u]
+					heapq.heappush(heap, (key, u))
+		return cost, previous
+
+	# (cost, [vertices]) of the lightest path between two vertices, or
+	# (inf, []) when there is none; A* when distanceHeuristic has one
+	def shortestPath(self, source, target, useHeuristic = True):
+		s = self.ids[source]
+		t = self.ids[target]
+		heuristic = self.distanceHeuristic(t) if useHeuristic else None
+		cost, previous = self.search(s, t, heuristic)
+		if cost[t] == math.inf:
+			return math.inf, []
+		path = [t]
+		while path[-1] != s:
+			path.append(previous[path[-1]])
+		return cost[t], [self.vertices[v] for v in reversed(path)]
+
+# the trips from one stop to one next stop on a day: departures sorted, and
+# for each the earliest arrival (with its rows) among that departure and
+# every later one, so the first departure at or after a time gives the
+# earliest arrival from then on even when trips overtake each other
+class TimedEdge:
+	__slots__ = ("departures", "arrivals", "boardRows", "alightRows")
+
+	def __init__(self, departures, arrivals, boardRows, alightRows):
+		self.departures = departures
+		self.arrivals = arrivals
+		self.boardRows = boardRows
+		self.alightRows = alightRows
+
+	# (arrival seconds, boarding row, alighting row) leaving at or after
+	# seconds, or None
+	def earliest(self, seconds):
+		i = bisect_left(self.departures, seconds)
+		if i == len(self.departures):
+			return None
+		return self.arrivals[i], self.boardRows[i], self.alightRows[i]
+
+# Stops linked by the trips running on one date, with travel times read
+# off the timetable at query time rather than fixed weights. A stop's
+# edges are only built when a search first leaves it, so a query touches
+# the part of the network it reaches and no more. Real-time overlay
+# changes are picked up by rebuilding edges as they are reached again.
+class TimeDependentGraph:
+	def __init__(self, sched, date, footpaths = None):
+		self.schedule = sched
+		self.date = date
+		self.tripMask = sched.getTripMask(date)
+		# stop index -> [(stop index, walking seconds)]
+		self.footpaths = footpaths if footpaths is not None else {}
+		# stop index -> {next stop index: TimedEdge}
+		self.edges = {}
+		self.version = sched.overlay.version
+
+	def edgesFrom(self, stopIndex):
+		overlay = self.schedule.overlay
+		if overlay.version != self.version:
+			self.edges.clear()
+			self.version = overlay.version
+		edges = self.edges.get(stopIndex)
+		if edges is None:
+			with instrument.span("graph.timedEdges") as span:
+				edges = self.buildEdges(stopIndex)
+				span.addRows(len(edges))
+			self.edges[stopIndex] = edges
+		return edges
+
+	def buildEdges(self, stopIndex):
+		table = self.schedule.stopTimes
+		overlay = self.schedule.overlay
+		rows = table.stopRows(stopIndex)
+		trips = table.tripIndex[rows]
+		keep = self.tripMask[trips] & (rows < table.tripOffsets[trips + 1] - 1)
+		rows = rows[keep]
+		nextRows = rows + 1
+		if overlay.active:
+			rows, nextRows = self.overlaidHops(rows, nextRows)
+		if len(rows) == 0:
+			return {}
+
+		departures = table.departure[rows] + overlay.delays(rows)
+		arrivals = table.arrival[nextRows] + overlay.delays(nextRows)
+		targets = table.stopIndex[nextRows]
+		order = np.lexsort((departures, targets))
+		targets = targets[order]
+		departures = departures[order]
+		arrivals = arrivals[order]
+		rows = rows[order]
+		nextRows = nextRows[order]
+		# the position breaks ties, so a suffix minimum of the key says
+		# which later departure arrives first
+		count = len(order)
+		key = arrivals.astype(np.int64) * count + np.arange(count)
+		starts = np.flatnonzero(np.diff(targets)) + 1
+		edges = {}
+		for group in np.split(np.arange(count), starts):
+			best = np.minimum.accumulate(key[group][::-1])[::-1] % count
+			edges[int(targets[group[0]])] = TimedEdge(departures[group].tolist(),
+					arrivals[best].tolist(), rows[best].tolist(), nextRows[best].tolist())
+		return edges
+
+	# leaves out cancelled trips and skipped boardings, and rides through
+	# skipped stops to the next stop the trip does serve
+	def overlaidHops(self, rows, nextRows):
+		table = self.schedule.stopTimes
+		overlay = self.schedule.overlay
+		kept = []
+		for row, nextRow in zip(rows.tolist(), nextRows.tolist()):
+			trip = int(table.tripIndex[row])
+			if trip in overlay.cancelled or overlay.isSkipped(row):
+				continue
+			last = int(table.tripOffsets[trip + 1]) - 1
+			while nextRow < last and overlay.isSkipped(nextRow):
+				nextRow += 1
+			if not overlay.isSkipped(nextRow):
+				kept.append((row, nextRow))
+		if len(kept) == 0:
+			empty = np.empty(0, dtype = np.int64)
+			return empty, empty
+		kept = np.array(kept, dtype = np.int64)
+		return kept[:, 0], kept[:, 1]
+
+	# time-dependent Dijkstra from origin (a stop index) leaving at seconds.
+	# As in ConnectionScan, footpaths are not transitive: walks only leave
+	# a stop from when a vehicle (or the start) gets there, so every stop
+	# has two labels, by ride and on foot. Returns stop index -> earliest
+	# arrival and stop index -> how it was reached: (previous stop, boarding
+	# row, alighting row), with None rows for a walk.
+	def search(self, origin, seconds, target = None):
+		arrival, reachedBy, _, _ = self.searchLabels(origin, seconds, target)
+		return arrival, reachedBy
+
+	# also returns, for the ride labels, stop index -> (previous stop,
+	# boarding row, alighting row, whether it was boarded on foot) and for
+	# the walk labels stop index -> the stop walked from
+	def searchLabels(self, origin, seconds, target = None):
+		rode = {origin: seconds}
+		walked = {}
+		rodeBy = {}
+		walkedFrom = {}
+		settled = set()
+		# (time, stop, whether on foot)
+		heap = [(seconds, origin, False)]
+		while len(heap) > 0:
+			now, stop, onFoot = heapq.heappop(heap)
+			if (stop, onFoot) in settled:
+				continue
+			settled.add((stop, onFoot))
+			if stop == target:
+				break
+			for nextStop, edge in self.edgesFrom(stop).items():
+				hop = edge.earliest(now)
+				if hop is not None and hop[0] < rode.get(nextStop, math.inf):
+					rode[nextStop] = hop[0]
+					rodeBy[nextStop] = (stop, hop[1], hop[2], onFoot)
+					heapq.heappush(heap, (hop[0], nextStop, False))
+			if onFoot:
+				continue
+			for nextStop, walk in self.footpaths.get(stop, ()):
+				best = min(rode.get(nextStop, math.inf), walked.get(nextStop, math.inf))
+				if now + walk < best:
+					walked[nextStop] = now + walk
+					walkedFrom[nextStop] = stop
+					heapq.heappush(heap, (now + walk, nextStop, True))
+
+		arrival = dict(rode)
+		reachedBy = {stop: how[:3] for stop, how in rodeBy.items()}
+		for stop, time in walked.items():
+			if time < arrival.get(stop, math.inf):
+				arrival[stop] = time
+				reachedBy[stop] = (walkedFrom[stop], None, None)
+		return arrival, reachedBy, rodeBy, walkedFrom
+
+	# the hops of the earliest way from origin to destination (Stops),
+	# leaving at departure (a Time): (boarding StopTime, alighting
+	# StopTime) for a ride, (Stop, Stop) for a walk. None if unreachable.
+	def path(self, origin, destination, departure):
+		arrival, reachedBy, rodeBy, walkedFrom = self.searchLabels(origin.index,
+				departure.seconds, destination.index)
+		if destination.index not in arrival:
+			return None
+		table = self.schedule.stopTimes
+		hops = []
+		stop = destination.index
+		onFoot = reachedBy.get(stop, (None, None))[1] is None and stop != origin.index
+		while onFoot or stop != origin.index:
+			if onFoot:
+				# walks start from the ride label
+				previous = walkedFrom[stop]
+				hops.append((table.stops[previous], table.stops[stop]))
+				onFoot = False
+			else:
+				previous, board, alight, onFoot = rodeBy[stop]
+				hops.append((table.stopTime(board), table.stopTime(alight)))
+			stop = previous
+		hops.reverse()
+		return hops
+
+	# one Penalty per ride hop of a path, in order
+	@staticmethod
+	def penalties(hops):
+		rides = [hop for hop in hops if isinstance(hop[0], schedule.StopTime)]
+		return [Penalty.getPenalty(board, alight) for board, alight in rides]
 
+# whole seconds to walk kms at WALKING_KM_PER_HOUR
+def walkingSeconds(kms):
+	hours = np.asarray(kms, dtype = float) / time_space.WALKING_KM_PER_HOUR
+	return np.ceil(hours * 3600).astype(np.int32)
 
+# stop index -> [(stop index, walking seconds)] to every other stop closer
+# than km, the footpaths ConnectionScan takes
+def walkingFootpaths(stops, km = TRANSFER_DISTANCE_LIMIT):
+	footpaths = {}
+	if len(stops) == 0:
+		return footpaths
+	tree = StopGraph.stopTree(stops)
+	indices = np.array([stop.index for stop in stops])
+	lats = np.array([stop.latitude for stop in stops])
+	lons = np.array([stop.longitude for stop in stops])
+	with instrument.span("graph.walkingFootpaths") as span:
+		for i, stop in enumerate(stops):
+			near = tree.rangeIndices(StopGraph.searchBounds(stop, km))
+			near = near[near != i]
+			kms = time_space.distancesFrom(stop.latitude, stop.longitude, lats[near], lons[near])
+			keep = kms < km
+			walks = list(zip(indices[near[keep]].tolist(), walkingSeconds(kms[keep]).tolist()))
+			if len(walks) > 0:
+				footpaths[stop.index] = walks
+				span.addRows(len(walks))
+	return footpaths
 
 def main():
 	import datetime
 	import sys
-	sched = schedule.Schedule()
-	sched.loadSchedule(schedule.RAIL_PATH)
-	sched.finish()
-	print("----rail loaded----")
+	if "-v" in sys.argv:
+		instrument.enable(memory = True)
+	sched = snapshot.loadSchedule(schedule.RAIL_PATH)
 	#sched.loadSchedule(schedule.BUS_PATH)
 	#print("----buses loaded----")
 	graph = StopGraph()
@@ -128,6 +538,8 @@ def main():
 		graph.addVertex(stop)
 	graph.formEdges(stops)
 	print(graph)
+	if instrument.isEnabled():
+		print(instrument.formatReport(), file = sys.stderr)
 
 if __name__ == "__main__":
 	main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import csv
+import gzip
+import io
+import itertools
+import operator
+import os
+import zipfile
+
+BATCH_ROWS = 1 << 12
+ENCODING = "utf-8-sig"
+
+# Reads the tables of one GTFS feed by column name. The feed can be a
+# directory of .txt (or .txt.gz) files or a .zip archive, read in place.
+class GtfsReader:
+	def __init__(self, source):
+		self.source = source
+		self.archive = None
+		if os.path.isfile(source) and zipfile.is_zipfile(source):
+			self.archive = zipfile.ZipFile(source)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		if self.archive is not None:
+			self.archive.close()
+			self.archive = None
+
+	def member(self, name):
+		filename = name + ".txt"
+		for member in self.archive.namelist():
+			if member == filename or member.endswith("/" + filename):
+				return member
+		return None
+
+	def plainPath(self, name):
+		if self.archive is not None:
+			return None
+		path = os.path.join(self.source, name + ".txt")
+		return path if os.path.isfile(path) else None
+
+	def exists(self, name):
+		if self.archive is not None:
+			return self.member(name) is not None
+		path = os.path.join(self.source, name + ".txt")
+		return os.path.isfile(path) or os.path.isfile(path + ".gz")
+
+	def open(self, name):
+		if self.archive is not None:
+			member = self.member(name)
+			if member is None:
+				raise FileNotFoundError("%s has no %s.txt" % (self.source, name))
+			return io.TextIOWrapper(self.archive.open(member), encoding = ENCODING, newline = "")
+		path = os.path.join(self.source, name + ".txt")
+		if not os.path.isfile(path) and os.path.isfile(path + ".gz"):
+			return gzip.open(path + ".gz", 'rt', encoding = ENCODING, newline = "")
+		return open(path, 'r', encoding = ENCODING, newline = "")
+
+	# the raw bytes, for byte offsets; every kind of file here can seek,
+	# compressed ones slowly
+	def openBinary(self, name):
+		if self.archive is not None:
+			member = self.member(name)
+			if member is None:
+				raise FileNotFoundError("%s has no %s.txt" % (self.source, name))
+			return self.archive.open(member)
+		path = os.path.join(self.source, name + ".txt")
+		if not os.path.isfile(path) and os.path.isfile(path + ".gz"):
+			return gzip.open(path + ".gz", 'rb')
+		return open(path, 'rb')
+
+	def header(self, name):
+		with self.open(name) as f:
+			return readHeader(f)
+
+	# one tuple of the requested columns per row; columns named in optional
+	# read as "" when the file does not have them
+	def rows(self, name, columns, optional = ()):
+		for batch in self.batches(name, columns, optional):
+			yield from zip(*batch)
+
+	# the same values, but as one tuple per column for every size rows
+	def batches(self, name, columns, optional = (), size = BATCH_ROWS):
+		with self.open(name) as f:
+			lines = csv.reader(f)
+			picker = ColumnPicker(cleanHeader(next(lines, [])), columns, optional, name)
+			yield from picker.batches(lines, size)
+
+	# byte ranges of about chunkBytes covering name.txt, for rangeBatches;
+	# None when the table is compressed and cannot be split
+	def byteRanges(self, name, chunkBytes):
+		path = self.plainPath(name)
+		if path is None:
+			return None
+		size = os.path.getsize(path)
+		if size == 0:
+			return [(0, 0)]
+		return [(start, min(start + chunkBytes, size)) for start in range(0, size, chunkBytes)]
+
+	# batches of the rows whose first byte lies in [start, end)
+	def rangeBatches(self, name, start, end, columns, optional = (), size = BATCH_ROWS):
+		picker = ColumnPicker(self.header(name), columns, optional, name)
+		text = readRange(self.plainPath(name), start, end)
+		return picker.batches(csv.reader(io.StringIO(text, newline = "")), size)
+
+def cleanHeader(names):
+	return [n.strip() for n in names]
+
+def readHeader(f):
+	return cleanHeader(next(csv.reader(f), []))
+
+# pulls the requested columns out of csv rows a batch at a time, one C-level
+# itemgetter pass per column
+class ColumnPicker:
+	def __init__(self, header, columns, optional = (), name = "table"):
+		self.positions = []
+		self.missing = []
+		for i, column in enumerate(columns):
+			if column in header:
+				self.positions.append(header.index(column))
+			elif column in optional:
+				self.missing.append(i)
+			else:
+				raise ValueError("%s has no %s column" % (name, column))
+		self.needed = max(self.positions) + 1 if len(self.positions) > 0 else 0
+		self.getters = [operator.itemgetter(p) for p in self.positions]
+
+	def pad(self, row):
+		# trailing empty fields are often left off entirely
+		if len(row) < self.needed:
+			return row + [""] * (self.needed - len(row))
+		return row
+
+	def pick(self, rows):
+		count = len(rows)
+		if min(map(len, rows)) < self.needed:
+			rows = [self.pad(row) for row in rows]
+		picked = [tuple(map(getter, rows)) for getter in self.getters]
+		for i in self.missing:
+			picked.insert(i, ("",) * count)
+		return tuple(picked)
+
+	def batches(self, lines, size):
+		while True:
+			rows = list(itertools.islice(lines, size))
+			if len(rows) == 0:
+				return
+			# drop blank lines, which csv reads as []
+			rows = list(filter(None, rows))
+			if len(rows) > 0:
+				yield self.pick(rows)
+
+# complete lines starting in [start, end) of a plain file; the header line
+# is left out of the range starting at 0
+def readRange(path, start, end):
+	with open(path, 'rb') as f:
+		if start == 0:
+			f.readline()
+		else:
+			# finish the line that began in the previous range
+			f.seek(start - 1)
+			f.readline()
+		begin = f.tell()
+		data = f.read(max(end - begin, 0))
+		if len(data) > 0 and not data.endswith(b"\n"):
+			data += f.readline()
+	return data.decode(ENCODING)
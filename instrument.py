@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import tracemalloc
+
+# Opt-in measurements of the load phases and queries. Nothing is recorded
+# until enable() is called; until then span() hands back one shared no-op
+# object and count()/observe() return straight away, so the calls can stay
+# in hot paths.
+#
+#	instrument.enable(memory = True)
+#	sched.loadSchedule(path)
+#	print(instrument.formatReport())
+#
+# A span is a named, timed region: every span name gets a call count, a
+# histogram of its durations, the rows it reported and, with memory on,
+# the largest traced allocation peak above what was live when it began.
+# tracemalloc keeps one peak for the whole process, so a span that was open
+# while another thread had a span open is left out of the memory figures
+# and only counted in overlapped. With several threads at work, as in the
+# query server, times stay exact but memory is measured only for the spans
+# that happened to run alone.
+
+recorder = None
+
+# buckets are powers of two of unit: bucket b holds values in
+# [2**(b-1), 2**b) units, bucket 0 everything under one unit
+class Histogram:
+	def __init__(self, unit = 1.0):
+		self.unit = unit
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = None
+		self.buckets = {}
+
+	def bucketOf(self, value):
+		return max(int(value / self.unit), 0).bit_length()
+
+	def bucketLimit(self, bucket):
+		return (1 << bucket) * self.unit
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		bucket = self.bucketOf(value)
+		self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+	@property
+	def mean(self):
+		return self.total / self.count if self.count > 0 else 0.0
+
+	# upper bound of the bucket holding the q-th quantile, 0 <= q <= 1
+	def quantile(self, q):
+		if self.count == 0:
+			return 0.0
+		wanted = q * self.count
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= wanted:
+				return min(self.bucketLimit(bucket), self.max)
+		return self.max
+
+	def asDict(self):
+		return dict(count = self.count, total = self.total, min = self.min,
+				max = self.max, mean = self.mean, p50 = self.quantile(0.5),
+				p90 = self.quantile(0.9), p99 = self.quantile(0.99),
+				buckets = {self.bucketLimit(b): n for b, n in sorted(self.buckets.items())})
+
+class SpanStats:
+	def __init__(self):
+		# microsecond resolution
+		self.seconds = Histogram(1e-6)
+		self.rows = 0
+		self.peakBytes = 0
+		# calls whose memory was not measured
+		self.overlapped = 0
+
+	def asDict(self):
+		return dict(calls = self.seconds.count, seconds = self.seconds.asDict(),
+				rows = self.rows, peakBytes = self.peakBytes, overlapped = self.overlapped)
+
+class NullSpan:
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+	def addRows(self, rows):
+		pass
+
+	def counted(self, items):
+		return items
+
+NULL_SPAN = NullSpan()
+
+class Span:
+	def __init__(self, recorder, name):
+		self.recorder = recorder
+		self.name = name
+		self.rows = 0
+
+	def __enter__(self):
+		self.recorder.enter(self)
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		seconds = time.perf_counter() - self.start
+		self.recorder.exit(self, seconds)
+		return False
+
+	def addRows(self, rows):
+		self.rows += rows
+
+	# items passed through, each one counted as a row
+	def counted(self, items):
+		for item in items:
+			self.rows += 1
+			yield item
+
+class Recorder:
+	def __init__(self, memory = False):
+		self.memory = memory
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.spans = {}
+		self.counters = {}
+		self.histograms = {}
+		# thread ident -> spans it has open, with memory on
+		self.open = {}
+		# bumped whenever a span opens while another thread has one open
+		self.overlaps = 0
+
+	def stack(self):
+		stack = getattr(self.local, "stack", None)
+		if stack is None:
+			stack = self.local.stack = []
+		return stack
+
+	# tracemalloc has one peak, so nested spans hand it up: entering a span
+	# folds the peak so far into the enclosing span and starts a new one
+	def enter(self, span):
+		if not self.memory:
+			return
+		ident = threading.get_ident()
+		with self.lock:
+			span.overlaps = self.overlaps
+			if any(n > 0 for other, n in self.open.items() if other != ident):
+				self.overlaps += 1
+			self.open[ident] = self.open.get(ident, 0) + 1
+		current, peak = tracemalloc.get_traced_memory()
+		stack = self.stack()
+		if len(stack) > 0:
+			stack[-1].peak = max(stack[-1].peak, peak)
+		tracemalloc.reset_peak()
+		span.base = current
+		span.peak = current
+		stack.append(span)
+
+	def exit(self, span, seconds):
+		peakBytes = 0
+		if self.memory:
+			peak = tracemalloc.get_traced_memory()[1]
+			span.peak = max(span.peak, peak)
+			stack = self.stack()
+			stack.pop()
+			if len(stack) > 0:
+				stack[-1].peak = max(stack[-1].peak, span.peak)
+			tracemalloc.reset_peak()
+			peakBytes = span.peak - span.base
+			ident = threading.get_ident()
+			with self.lock:
+				self.open[ident] -= 1
+				if self.open[ident] == 0:
+					del self.open[ident]
+				if span.overlaps != self.overlaps:
+					peakBytes = None
+		self.record(span.name, seconds, span.rows, peakBytes)
+
+	# peakBytes None: the span's memory could not be measured
+	def record(self, name, seconds, rows = 0, peakBytes = 0):
+		with self.lock:
+			stats = self.spans.get(name)
+			if stats is None:
+				stats = self.spans[name] = SpanStats()
+			stats.seconds.add(seconds)
+			stats.rows += rows
+			if peakBytes is None:
+				stats.overlapped += 1
+			else:
+				stats.peakBytes = max(stats.peakBytes, peakBytes)
+
+	def count(self, name, n):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def observe(self, name, value, unit):
+		with self.lock:
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram(unit)
+			histogram.add(value)
+
+	def report(self):
+		with self.lock:
+			return dict(
+				spans = {name: s.asDict() for name, s in self.spans.items()},
+				counters = dict(self.counters),
+				histograms = {name: h.asDict() for name, h in self.histograms.items()},
+			)
+
+# memory also tracks peak allocations per span, which starts tracemalloc
+# and slows everything down noticeably
+def enable(memory = False):
+	global recorder
+	if memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+	recorder = Recorder(memory)
+	return recorder
+
+def disable():
+	global recorder
+	if recorder is not None and recorder.memory and tracemalloc.is_tracing():
+		tracemalloc.stop()
+	recorder = None
+
+def isEnabled():
+	return recorder is not None
+
+# forget what was recorded so far but keep recording
+def reset():
+	if recorder is not None:
+		enable(recorder.memory)
+
+def span(name):
+	if recorder is None:
+		return NULL_SPAN
+	return Span(recorder, name)
+
+# a span over a lazy result: only the time spent producing items counts,
+# every item is a row, and it is recorded once the caller stops reading
+def spanIter(name, items):
+	if recorder is None:
+		return items
+	return timedIter(recorder, name, items)
+
+def timedIter(recorder, name, items):
+	seconds = 0.0
+	rows = 0
+	iterator = iter(items)
+	try:
+		while True:
+			start = time.perf_counter()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			finally:
+				seconds += time.perf_counter() - start
+			rows += 1
+			yield item
+	finally:
+		recorder.record(name, seconds, rows)
+
+def count(name, n = 1):
+	if recorder is not None:
+		recorder.count(name, n)
+
+# unit sets the histogram's resolution the first time name is seen
+def observe(name, value, unit = 1.0):
+	if recorder is not None:
+		recorder.observe(name, value, unit)
+
+def report():
+	if recorder is None:
+		return dict(spans = {}, counters = {}, histograms = {})
+	return recorder.report()
+
+def formatReport():
+	data = report()
+	lines = []
+	for name in sorted(data["spans"]):
+		s = data["spans"][name]
+		seconds = s["seconds"]
+		values = (name, s["calls"], seconds["total"] * 1000, seconds["p50"] * 1000,
+				seconds["max"] * 1000, s["rows"], s["peakBytes"] / float(1 << 20))
+		lines.append("%-32s %7d calls %10.1f ms (p50 %.2f, max %.2f) %10d rows %8.1f MiB" % values)
+	for name in sorted(data["counters"]):
+		lines.append("%-32s %d" % (name, data["counters"][name]))
+	for name in sorted(data["histograms"]):
+		h = data["histograms"][name]
+		values = (name, h["count"], h["mean"], h["p50"], h["p99"], h["max"])
+		lines.append("%-32s n=%d mean %.6g p50 %.6g p99 %.6g max %.6g" % values)
+	return "\n".join(lines)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import numpy as np
+import graph_transit
+import instrument
+import quad_tree
+import time_space
+import trip_planner
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+# travel seconds from each origin (row) to every stop (column, by stop
+# index), UNREACHABLE past the budget. Coordinates are parallel to the
+# columns, ready for time_space.distancesFrom and PackedQuadTree.
+class Isochrones:
+	def __init__(self, stops, lats, lons, seconds):
+		self.stops = stops
+		self.lats = lats
+		self.lons = lons
+		self.seconds = seconds
+
+	def __len__(self):
+		return len(self.seconds)
+
+	# stop indices reached from origin i within budget (a Time, default the
+	# whole budget computed), nearest in time first
+	def reached(self, i, budget = None):
+		row = self.seconds[i]
+		limit = UNREACHABLE - 1 if budget is None else budget.seconds
+		hits = np.flatnonzero(row <= limit)
+		return hits[np.argsort(row[hits], kind = 'stable')]
+
+	def travelSeconds(self, i, indices):
+		return self.seconds[i][indices]
+
+	def reachedStops(self, i, budget = None):
+		return [self.stops[s] for s in self.reached(i, budget).tolist()]
+
+	# (lons, lats) of the stops reached, in reached() order
+	def coordinates(self, i, budget = None):
+		hits = self.reached(i, budget)
+		return self.lons[hits], self.lats[hits]
+
+	# positions the tree yields are positions in reached(i, budget)
+	def tree(self, i, budget = None):
+		lons, lats = self.coordinates(i, budget)
+		return quad_tree.PackedQuadTree.fromArrays(lons, lats)
+
+# everything reachable from stops or places within a time budget: one
+# connection scan per origin gives the earliest arrival at every stop,
+# with walks between stops closer than walkKm
+class IsochroneFinder:
+	def __init__(self, sched, walkKm = graph_transit.TRANSFER_DISTANCE_LIMIT):
+		self.schedule = sched
+		self.walkKm = walkKm
+		stops = sched.stopTimes.stops
+		self.lats = np.array([stop.latitude for stop in stops])
+		self.lons = np.array([stop.longitude for stop in stops])
+		self.tree = quad_tree.PackedQuadTree.fromArrays(self.lons, self.lats)
+		footpaths = graph_transit.walkingFootpaths(stops, walkKm)
+		self.planner = trip_planner.ConnectionScan(sched, footpaths)
+
+	# (stop indices, walking seconds) an origin starts from: for a Place
+	# every stop within walkKm of it, which the walk there already took; a
+	# stop itself, with None for walks since footpaths from it still count
+	def seeds(self, origin):
+		if isinstance(origin, time_space.Place):
+			bounds = graph_transit.StopGraph.searchBounds(origin, self.walkKm)
+			near = self.tree.rangeIndices(bounds)
+			kms = time_space.distancesFrom(origin.latitude, origin.longitude,
+					self.lats[near], self.lons[near])
+			keep = kms < self.walkKm
+			return near[keep].tolist(), graph_transit.walkingSeconds(kms[keep]).tolist()
+		return [origin.index], None
+
+	# origins are Stops or Places; departure and budget are Times
+	def compute(self, origins, date, departure, budget):
+		start = departure.seconds
+		limit = start + budget.seconds
+		stopCount = len(self.lats)
+		seconds = np.full((len(origins), stopCount), UNREACHABLE, dtype = np.int32)
+		with instrument.span("query.isochrones") as span:
+			for i, origin in enumerate(origins):
+				indices, walks = self.seeds(origin)
+				earliest, _, _ = self.planner.scan(indices, date, start,
+						until = limit, offsets = walks)
+				earliest = np.array(earliest, dtype = float)
+				reached = earliest <= limit
+				seconds[i, reached] = earliest[reached] - start
+				span.addRows(int(reached.sum()))
+		return Isochrones(self.schedule.stopTimes.stops, self.lats, self.lons, seconds)
+
+def main():
+	import datetime
+	import schedule
+	import snapshot
+	sched = snapshot.loadSchedule(schedule.RAIL_PATH)
+	finder = IsochroneFinder(sched)
+	origin = list(sched.stops.values())[0]
+	isochrones = finder.compute([origin], datetime.date(2016, 10, 5),
+			time_space.Time(8), time_space.Time(1))
+	for minutes in (30, 45, 60):
+		stops = isochrones.reachedStops(0, time_space.Time(0, minutes))
+		print("%d min: %d stops" % (minutes, len(stops)))
+
+if __name__ == "__main__":
+	main()
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import heapq
+import itertools
 import random
+import numpy as np
 
 class Item:
 	def __init__(self, payload, x = 0, y = 0):
@@ -51,6 +54,19 @@ class Bounds:
 		yOK = item.y >= self._bottom and item.y <= self._top
 		return xOK and yOK
 
+	@classmethod
+	def around(cls, items):
+		xMin = min(item.x for item in items)
+		xMax = max(item.x for item in items)
+		yMin = min(item.y for item in items)
+		yMax = max(item.y for item in items)
+		return cls(xMin, xMax, yMin, yMax)
+
+	def distanceSquared(self, x, y):
+		dx = max(self._left - x, 0, x - self._right)
+		dy = max(self._bottom - y, 0, y - self._top)
+		return dx * dx + dy * dy
+
 	def intersects(self, other):
 		xOver = other._left <= self.right and other.right >= self._left
 		yOver = other._top >= self.bottom and other.bottom <= self._top
@@ -63,13 +79,39 @@ class Bounds:
 
 class QuadTree:
 	MAX_CAPACITY = 4
+	MAX_LEVEL = 32
+	BULK_BITS = 16 # grid resolution per axis used to order points in fromItems
 
-	def __init__(self, level = 0, rect = Bounds()):
+	def __init__(self, level = 0, rect = None):
 		self.subtrees = None
 		self.payload = []
 		self.level = level
 		self.bounds = rect
 
+	@classmethod
+	def fromItems(cls, items, rect = None):
+		items = list(items)
+		if rect is None and len(items) > 0:
+			rect = Bounds.around(items)
+		tree = cls(0, rect)
+		if len(items) == 0:
+			return tree
+
+		xs = np.array([item.x for item in items], dtype = float)
+		ys = np.array([item.y for item in items], dtype = float)
+		order, codes = zOrder(xs, ys, rect, cls.BULK_BITS)
+		tree.build([items[i] for i in order.tolist()], codes, 0, len(items), cls.BULK_BITS)
+		return tree
+
+	def build(self, items, codes, start, end, bits):
+		if end - start <= QuadTree.MAX_CAPACITY or bits == 0 or self.level >= QuadTree.MAX_LEVEL:
+			self.payload = items[start:end]
+			return
+		self.split()
+		bounds = quadrantRuns(codes, start, end, bits)
+		for quadrant, subtree in enumerate(self.subtrees):
+			subtree.build(items, codes, bounds[quadrant], bounds[quadrant + 1], bits - 1)
+
 	def getAllItems(self):
 		toRet = self.payload[:]
 
@@ -79,22 +121,26 @@ class QuadTree:
 
 		return toRet
 
-	def rebound(self):
+	def rebound(self, item = None):
 		li = self.getAllItems()
-
-		xMin = min(li, key = lambda item: item.x).x
-		xMax = max(li, key = lambda item: item.x).x
-		yMin = min(li, key = lambda item: item.y).y
-		yMax = max(li, key = lambda item: item.y).y
-		self.bounds = Bounds(xMin, xMax, yMin, yMax)
-
-		self.subtrees = None
+		if item is not None:
+			li.append(item)
+
+		bounds = Bounds.around(li)
+		if self.bounds is not None and item is not None:
+			# grow by at least the current size, so items arriving one by one
+			# outside the tree only trigger a logarithmic number of rebuilds
+			old = self.bounds
+			bounds = Bounds(
+				min(bounds.left, old.left - old.width if item.x < old.left else old.left),
+				max(bounds.right, old.right + old.width if item.x > old.right else old.right),
+				min(bounds.bottom, old.bottom - old.height if item.y < old.bottom else old.bottom),
+				max(bounds.top, old.top + old.height if item.y > old.top else old.top))
+		rebuilt = QuadTree.fromItems(li, bounds)
+		self.bounds = rebuilt.bounds
+		self.subtrees = rebuilt.subtrees
+		self.payload = rebuilt.payload
 		self.level = 0
-		self.payload = []
-
-		if len(li) > 0:
-			for ele in li:
-				self.insert(ele)
 
 
 	def split(self):
@@ -119,15 +165,17 @@ class QuadTree:
 		return None
 
 	def insert(self, item):
+		if self.bounds is None:
+			self.bounds = Bounds(item.x, item.x, item.y, item.y)
 		if not self.bounds.contains(item):
-			print(item.__str__() + " does not fit in " + self.bounds.__str__())
-			self.payload.append(item)
-			self.rebound()
+			self.rebound(item)
 		else:
 			if self.subtrees is None:
 				self.payload.append(item)
 
-				if len(self.payload) > QuadTree.MAX_CAPACITY:
+				# past MAX_LEVEL, coincident points just share a leaf
+				full = len(self.payload) > QuadTree.MAX_CAPACITY
+				if full and self.level < QuadTree.MAX_LEVEL:
 					self.split()
 					itemsToInsert = self.payload[:]
 					for ele in itemsToInsert:
@@ -141,52 +189,276 @@ class QuadTree:
 
 	def getPossibleHits(self, bounds):
 		toRet = []
-		toRet.extend(payload)
+		toRet.extend(self.payload)
 
 		if self.subtrees is not None:
 			for subtree in self.subtrees:
-				if subtree.intersects(bounds):
+				if subtree.bounds.intersects(bounds):
 					toRet.extend(subtree.getPossibleHits(bounds))
 
 		return toRet
 
 	def getOverlappers(self, bounds):
-		candidates = self.getPossibleHits(bounds)
-		toRet = [c for c in candidates if bounds.contains(candidate)]
-		return toRet
+		return list(self.iterRange(bounds))
+
+	def iterRange(self, bounds):
+		if self.bounds is None:
+			return
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			for item in node.payload:
+				if bounds.contains(item):
+					yield item
+			if node.subtrees is not None:
+				for subtree in reversed(node.subtrees):
+					if subtree.bounds.intersects(bounds):
+						stack.append(subtree)
+
+	# euclidean in the tree's own x/y units
+	def iterWithin(self, x, y, radius):
+		box = Bounds(x - radius, x + radius, y - radius, y + radius)
+		limit = radius * radius
+		for item in self.iterRange(box):
+			if (item.x - x) ** 2 + (item.y - y) ** 2 <= limit:
+				yield item
+
+	# every item in order of increasing distance from (x, y), found best-first
+	# so only the part of the tree that is needed gets visited
+	def iterNearest(self, x, y):
+		if self.bounds is None:
+			return
+		counter = 0
+		heap = [(self.bounds.distanceSquared(x, y), counter, self)]
+		while heap:
+			dist, _, entry = heapq.heappop(heap)
+			if isinstance(entry, Item):
+				yield entry
+				continue
+			for item in entry.payload:
+				counter += 1
+				d = (item.x - x) ** 2 + (item.y - y) ** 2
+				heapq.heappush(heap, (d, counter, item))
+			if entry.subtrees is not None:
+				for subtree in entry.subtrees:
+					counter += 1
+					d = subtree.bounds.distanceSquared(x, y)
+					heapq.heappush(heap, (d, counter, subtree))
+
+	def nearest(self, x, y, k = 1):
+		return itertools.islice(self.iterNearest(x, y), k)
+
+	def __len__(self):
+		count = len(self.payload)
+		if self.subtrees is not None:
+			count += sum(len(subtree) for subtree in self.subtrees)
+		return count
 
 	def __str__(self):
 		spacing = "\t" * self.level
-		pl = "\n".join([item.__str__() for item in self.payload])
+		pl = [item.__str__() for item in self.payload]
 		toRet = spacing + self.bounds.__str__() + ": " + pl.__str__() + "\n"
 		if self.subtrees is not None:
 			toRet += "\n".join([sub.__str__() for sub in self.subtrees])
 		return toRet
 
-	def getPossibleHits(self, bounds):
-		toRet = []
-		toRet.extend(payload)
-
-		if self.subtrees is not None:
-			for subtree in self.subtrees:
-				if subtree.intersects(bounds):
-					toRet.extend(subtree.getPossibleHits(bounds))
-
-		return toRet
+# spreads the low 16 bits of each value out to the even bit positions
+def interleave(values):
+	values = values & np.uint64(0xFFFF)
+	values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF)
+	values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+	values = (values | (values << np.uint64(2))) & np.uint64(0x33333333)
+	values = (values | (values << np.uint64(1))) & np.uint64(0x55555555)
+	return values
+
+# Z-order over a 2^bits grid covering rect: returns the sorting permutation
+# and the sorted codes. Every quadrant of the tree is then one contiguous run.
+def zOrder(xs, ys, rect, bits):
+	cells = (1 << bits) - 1
+	width = rect.width if rect.width > 0 else 1.0
+	height = rect.height if rect.height > 0 else 1.0
+	qx = np.clip((xs - rect.left) / width * (cells + 1), 0, cells).astype(np.uint64)
+	qy = np.clip((ys - rect.bottom) / height * (cells + 1), 0, cells).astype(np.uint64)
+	codes = interleave(qx) | (interleave(qy) << np.uint64(1))
+	order = np.argsort(codes, kind = 'stable')
+	return order, codes[order]
+
+# where each of the four quadrants of codes[start:end] begins, plus end;
+# quadrants are ordered as split() orders its subtrees
+def quadrantRuns(codes, start, end, bits):
+	shift = np.uint64(2 * (bits - 1))
+	prefix = codes[start] >> np.uint64(2 * bits) << np.uint64(2 * bits)
+	runs = [start]
+	for quadrant in range(1, 4):
+		key = prefix | (np.uint64(quadrant) << shift)
+		runs.append(int(np.searchsorted(codes[start:end], key)) + start)
+	runs.append(end)
+	return runs
+
+# The same tree shape as QuadTree.fromItems, held in a handful of flat arrays
+# instead of one object per node and per point. Node i covers
+# bounds[i] = (left, right, bottom, top); a split node's four children sit at
+# firstChild[i] .. firstChild[i] + 3 and a leaf has firstChild -1. The points
+# of node i are positions itemStart[i] .. itemEnd[i] of the Z-sorted xs/ys,
+# and index holds their positions in the caller's arrays. Queries yield those
+# caller positions.
+class PackedQuadTree:
+	LEAF_CAPACITY = 16
+
+	def __init__(self, bounds, firstChild, itemStart, itemEnd, index, xs, ys):
+		self.bounds = bounds
+		self.firstChild = firstChild
+		self.itemStart = itemStart
+		self.itemEnd = itemEnd
+		self.index = index
+		self.xs = xs
+		self.ys = ys
+
+	@classmethod
+	def fromArrays(cls, xs, ys, rect = None, capacity = None):
+		xs = np.asarray(xs, dtype = float)
+		ys = np.asarray(ys, dtype = float)
+		if capacity is None:
+			capacity = cls.LEAF_CAPACITY
+		if len(xs) == 0:
+			empty = np.empty(0, dtype = np.int32)
+			return cls(np.empty((0, 4)), empty, empty, empty, empty, xs, ys)
+		if rect is None:
+			rect = Bounds(xs.min(), xs.max(), ys.min(), ys.max())
+
+		bits = QuadTree.BULK_BITS
+		order, codes = zOrder(xs, ys, rect, bits)
+		bounds = [(rect.left, rect.right, rect.bottom, rect.top)]
+		firstChild = [-1]
+		itemStart = [0]
+		itemEnd = [len(xs)]
+		queue = [(0, bits)]
+		while queue:
+			node, remaining = queue.pop()
+			start, end = itemStart[node], itemEnd[node]
+			if end - start <= capacity or remaining == 0:
+				continue
+			runs = quadrantRuns(codes, start, end, remaining)
+			left, right, bottom, top = bounds[node]
+			xMid = (left + right) / 2
+			yMid = (bottom + top) / 2
+			firstChild[node] = len(bounds)
+			bounds.append((left, xMid, bottom, yMid))
+			bounds.append((xMid, right, bottom, yMid))
+			bounds.append((left, xMid, yMid, top))
+			bounds.append((xMid, right, yMid, top))
+			for quadrant in range(4):
+				child = firstChild[node] + quadrant
+				firstChild.append(-1)
+				itemStart.append(runs[quadrant])
+				itemEnd.append(runs[quadrant + 1])
+				queue.append((child, remaining - 1))
+
+		return cls(
+			np.array(bounds, dtype = float),
+			np.array(firstChild, dtype = np.int32),
+			np.array(itemStart, dtype = np.int32),
+			np.array(itemEnd, dtype = np.int32),
+			order.astype(np.int32),
+			xs[order],
+			ys[order],
+		)
+
+	@classmethod
+	def fromItems(cls, items):
+		xs = [item.x for item in items]
+		ys = [item.y for item in items]
+		return cls.fromArrays(xs, ys)
+
+	def __len__(self):
+		return len(self.index)
+
+	def nodeDistanceSquared(self, node, x, y):
+		left, right, bottom, top = self.bounds[node].tolist()
+		dx = max(left - x, 0, x - right)
+		dy = max(bottom - y, 0, y - top)
+		return dx * dx + dy * dy
+
+	# positions into the Z-sorted arrays of the leaves touching the box
+	def leafRuns(self, left, right, bottom, top):
+		if len(self.index) == 0:
+			return
+		stack = [0]
+		while stack:
+			node = stack.pop()
+			nLeft, nRight, nBottom, nTop = self.bounds[node].tolist()
+			if nLeft > right or nRight < left or nBottom > top or nTop < bottom:
+				continue
+			child = int(self.firstChild[node])
+			if child < 0:
+				yield int(self.itemStart[node]), int(self.itemEnd[node])
+			else:
+				stack.extend(range(child + 3, child - 1, -1))
+
+	def rangeIndices(self, bounds):
+		return self.selectIndices(bounds.left, bounds.right, bounds.bottom, bounds.top, None)
+
+	def selectIndices(self, left, right, bottom, top, keep):
+		found = []
+		for start, end in self.leafRuns(left, right, bottom, top):
+			xs = self.xs[start:end]
+			ys = self.ys[start:end]
+			hit = (xs >= left) & (xs <= right) & (ys >= bottom) & (ys <= top)
+			if keep is not None:
+				hit &= keep(xs, ys)
+			found.append(self.index[start:end][hit])
+		if len(found) == 0:
+			return np.empty(0, dtype = np.int32)
+		return np.concatenate(found)
+
+	def iterRange(self, bounds):
+		for start, end in self.leafRuns(bounds.left, bounds.right, bounds.bottom, bounds.top):
+			xs = self.xs[start:end]
+			ys = self.ys[start:end]
+			hit = (xs >= bounds.left) & (xs <= bounds.right)
+			hit &= (ys >= bounds.bottom) & (ys <= bounds.top)
+			yield from self.index[start:end][hit].tolist()
 
 	def getOverlappers(self, bounds):
-		candidates = self.getPossibleHits(bounds)
-		toRet = [c for c in candidates if bounds.contains(candidate)]
-		return toRet
-
-	def __str__(self):
-		spacing = "\t" * self.level
-		pl = [item.__str__() for item in self.payload]
-		toRet = spacing + self.bounds.__str__() + ": " + pl.__str__() + "\n"
-		if self.subtrees is not None:
-			toRet += "\n".join([sub.__str__() for sub in self.subtrees])
-		return toRet
+		return self.rangeIndices(bounds).tolist()
+
+	def withinIndices(self, x, y, radius):
+		limit = radius * radius
+		keep = lambda xs, ys: (xs - x) ** 2 + (ys - y) ** 2 <= limit
+		return self.selectIndices(x - radius, x + radius, y - radius, y + radius, keep)
+
+	def iterWithin(self, x, y, radius):
+		limit = radius * radius
+		for start, end in self.leafRuns(x - radius, x + radius, y - radius, y + radius):
+			xs = self.xs[start:end]
+			ys = self.ys[start:end]
+			hit = (xs - x) ** 2 + (ys - y) ** 2 <= limit
+			yield from self.index[start:end][hit].tolist()
+
+	def iterNearest(self, x, y):
+		if len(self.index) == 0:
+			return
+		# entries are (distance, node, -1) for nodes, (distance, -1, position)
+		# for points
+		heap = [(self.nodeDistanceSquared(0, x, y), 0, -1)]
+		while heap:
+			dist, node, position = heapq.heappop(heap)
+			if node < 0:
+				yield int(self.index[position])
+				continue
+			child = int(self.firstChild[node])
+			if child < 0:
+				start = int(self.itemStart[node])
+				end = int(self.itemEnd[node])
+				ds = (self.xs[start:end] - x) ** 2 + (self.ys[start:end] - y) ** 2
+				for offset, d in enumerate(ds.tolist()):
+					heapq.heappush(heap, (d, -1, start + offset))
+			else:
+				for c in range(child, child + 4):
+					heapq.heappush(heap, (self.nodeDistanceSquared(c, x, y), c, -1))
 
+	def nearest(self, x, y, k = 1):
+		return itertools.islice(self.iterNearest(x, y), k)
 
 def randomPoint():
 	return random.random() * 100, random.random() * 100
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import graph_transit
+import instrument
+import time_space
+import trip_planner
+
+CACHE_SIZE = 4096
+BUCKET_SECONDS = 5 * 60
+
+# a bounded mapping that forgets the least recently used entry first
+class LruCache:
+	MISSING = object()
+
+	def __init__(self, maxsize = CACHE_SIZE):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		value = self.entries.get(key, LruCache.MISSING)
+		if value is LruCache.MISSING:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.entries.move_to_end(key)
+		return value
+
+	def put(self, key, value):
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxsize:
+			self.entries.popitem(last = False)
+
+	def clear(self):
+		self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
+
+# Journeys and departure boards for repeated questions, keyed on (origin,
+# destination, date, departure bucket). Answers are worked out from the
+# start of the bucket and only reused where that is exactly what the
+# query itself would return. Everything is dropped when the schedule is
+# finished again or its real-time overlay changes. Without a planner it
+# plans with walks between stops within graph_transit's transfer limit.
+class QueryCache:
+	def __init__(self, sched, maxsize = CACHE_SIZE, bucket = BUCKET_SECONDS, planner = None):
+		self.bucket = bucket
+		self.results = LruCache(maxsize)
+		# bucket hits that still had to be recomputed
+		self.stale = 0
+		self.setSchedule(sched, planner)
+
+	def setSchedule(self, sched, planner = None):
+		self.schedule = sched
+		if planner is None:
+			footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops)
+			planner = trip_planner.ConnectionScan(sched, footpaths)
+		self.planner = planner
+		self.token = self.currentToken()
+		self.results.clear()
+
+	def currentToken(self):
+		overlay = self.schedule.overlay
+		return (self.schedule.calendar, overlay, overlay.version)
+
+	def validate(self):
+		token = self.currentToken()
+		if token[0] is not self.token[0]:
+			# finished again: the planner's connections are stale too, but
+			# its footpaths are still the caller's
+			planner = trip_planner.ConnectionScan(self.schedule, self.planner.footpaths)
+			self.setSchedule(self.schedule, planner)
+		elif token[1:] != self.token[1:]:
+			self.token = token
+			self.results.clear()
+			instrument.count("cache.invalidations")
+
+	def bucketStart(self, seconds):
+		return seconds - seconds % self.bucket
+
+	@property
+	def hits(self):
+		return self.results.hits
+
+	@property
+	def misses(self):
+		return self.results.misses
+
+	def stats(self):
+		return dict(hits = self.hits, misses = self.misses, stale = self.stale,
+				size = len(self.results), maxsize = self.results.maxsize)
+
+	def lookup(self, key):
+		value = self.results.get(key)
+		instrument.count("cache.misses" if value is LruCache.MISSING else "cache.hits")
+		return value
+
+	# as ConnectionScan.query. The journey from the bucket start is also
+	# the answer for any later time in the bucket it does not leave before,
+	# since arriving earlier than it is impossible from later on.
+	def journey(self, origin, destination, date, departure):
+		self.validate()
+		seconds = departure.seconds
+		if origin is destination:
+			return self.planner.query(origin, destination, date, departure)
+		start = self.bucketStart(seconds)
+		key = ("journey", origin.index, destination.index, date.toordinal(), start)
+		journey = self.lookup(key)
+		if journey is LruCache.MISSING:
+			journey = self.planner.query(origin, destination, date,
+					time_space.Time(seconds = start))
+			self.results.put(key, journey)
+		if journey is None or journey.departureTime.seconds >= seconds:
+			return journey
+		self.stale += 1
+		return self.planner.query(origin, destination, date, departure)
+
+	# as Schedule.getDepartures, as a list. Bounded boards are cached as
+	# every departure from the bucket start through count past its end,
+	# which covers any time in the bucket; unbounded ones are not cached.
+	def departures(self, stop, date, time, count, children = True):
+		self.validate()
+		if count is None:
+			return list(self.schedule.getDepartures(stop, date, time, None, children))
+		seconds = time.seconds
+		start = self.bucketStart(seconds)
+		key = ("departures", stop.index, children, date.toordinal(), start)
+		board = self.lookup(key)
+		if board is LruCache.MISSING or board[0] < count:
+			if board is not LruCache.MISSING:
+				self.stale += 1
+			board = (count, self.bucketBoard(stop, date, start, count, children))
+			self.results.put(key, board)
+		found = [stopTime for stopTime in board[1] if stopTime.departureSeconds >= seconds]
+		return found[:count]
+
+	def bucketBoard(self, stop, date, start, count, children):
+		end = start + self.bucket
+		board = []
+		after = 0
+		departures = self.schedule.getDepartures(stop, date, time_space.Time(seconds = start),
+				None, children)
+		for stopTime in departures:
+			if stopTime.departureSeconds >= end:
+				after += 1
+				if after > count:
+					break
+			board.append(stopTime)
+		return board
+
+	def clear(self):
+		self.results.clear()
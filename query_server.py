@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+import asyncio
+import heapq
+import itertools
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import graph_transit
+import instrument
+import quad_tree
+import query_cache
+import schedule
+import snapshot
+import time_space
+import trip_planner
+
+# A long-running process answering departure, nearest-stop and journey
+# queries for one warm schedule. The protocol is one JSON object per line
+# each way over TCP, bound to localhost by default:
+#
+#	{"id": 1, "type": "departures", "stop_id": "S1", "date": "20161005",
+#		"time": "08:00:00", "count": 5}
+#	{"id": 2, "type": "nearest", "lat": 34.05, "lon": -118.25, "count": 3}
+#	{"id": 3, "type": "journey", "origin": "S1", "destination": "S9",
+#		"date": "20161005", "time": "08:00:00"}
+#
+# answered by {"id": ..., "ok": true, "result": ...} or {"id": ...,
+# "ok": false, "error": "..."}, not necessarily in request order. Journeys
+# are batched into a pool of worker processes that each map the snapshot;
+# the cheap queries are answered on the event loop.
+
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_PENDING = 256 # admitted but unanswered requests, over all clients
+MAX_LINE = 1 << 16
+BATCH_SIZE = 32
+BATCH_SECONDS = 0.002
+DEFAULT_COUNT = 10
+MAX_COUNT = 1000 # departures or stops in one answer, at most
+# projected distances are scaled down by this much more before they are
+# trusted as lower bounds, for great circles bowing towards the pole
+LOWER_BOUND_SLACK = 0.99
+
+class QueryError(Exception):
+	pass
+
+# one process's (or thread's) view of the schedule, with its own cache;
+# journeys may walk between stops within the transfer limit
+class QueryContext:
+	def __init__(self, sched):
+		self.schedule = sched
+		stops = sched.stopTimes.stops
+		footpaths = graph_transit.walkingFootpaths(stops)
+		planner = trip_planner.ConnectionScan(sched, footpaths)
+		self.cache = query_cache.QueryCache(sched, planner = planner)
+		self.lats = np.array([stop.latitude for stop in stops])
+		self.lons = np.array([stop.longitude for stop in stops])
+		# an equirectangular projection about the stops' mean latitude, in
+		# degrees of latitude, so tree distances are nearly true ones
+		midLat = float(self.lats.mean()) if len(stops) > 0 else 0.0
+		self.xScale = max(math.cos(math.radians(midLat)), 0.01)
+		self.xs = self.lons * self.xScale
+		self.poleward = float(np.abs(self.lats).max()) if len(stops) > 0 else 0.0
+		self.tree = quad_tree.PackedQuadTree.fromArrays(self.xs, self.lats)
+
+	def stop(self, stop_id):
+		if not isinstance(stop_id, str):
+			raise QueryError("stop ids are strings, not %r" % (stop_id,))
+		stop = self.schedule.stops.get(stop_id)
+		if stop is None:
+			raise QueryError("unknown stop %s" % stop_id)
+		return stop
+
+	@staticmethod
+	def when(request):
+		try:
+			date = schedule.Service.getDate(request["date"].replace("-", ""))
+			time = time_space.Time(seconds = time_space.parseSeconds(request["time"]))
+		except (KeyError, ValueError, IndexError, AttributeError, TypeError):
+			raise QueryError("date must be YYYYMMDD and time HH:MM:SS")
+		return date, time
+
+	# at most MAX_COUNT, however many are asked for
+	@staticmethod
+	def count(request, default):
+		count = request.get("count", default)
+		if isinstance(count, bool) or not isinstance(count, int):
+			raise QueryError("count must be an integer")
+		if count < 0:
+			raise QueryError("count must not be negative")
+		return min(count, MAX_COUNT)
+
+	def departures(self, request):
+		stop = self.stop(request.get("stop_id"))
+		date, time = QueryContext.when(request)
+		count = QueryContext.count(request, DEFAULT_COUNT)
+		children = bool(request.get("children", True))
+		return [stopTimeDict(st) for st in self.cache.departures(stop, date, time, count, children)]
+
+	# Stops come out of the tree nearest in projection first. Where the
+	# parallels are shorter than at the middle latitude, projection
+	# overstates distance, so a projected distance only rules out the rest
+	# once, scaled by the shortest parallel in play, it passes the count-th
+	# best haversine distance.
+	def nearest(self, request):
+		try:
+			lat = float(request["lat"])
+			lon = float(request["lon"])
+		except (KeyError, ValueError, TypeError):
+			raise QueryError("nearest needs lat and lon")
+		count = QueryContext.count(request, 1)
+		if count == 0:
+			return []
+		x = lon * self.xScale
+		poleward = min(max(self.poleward, abs(lat)), 90.0)
+		shrink = min(math.cos(math.radians(poleward)) / self.xScale, 1.0) * LOWER_BOUND_SLACK
+		# (-km, stop index) for the best count so far
+		best = []
+		for i in self.tree.iterNearest(x, lat):
+			degrees = math.hypot(self.xs[i] - x, self.lats[i] - lat)
+			if len(best) == count and degrees * time_space.KM_PER_DEGREE * shrink >= -best[0][0]:
+				break
+			km = time_space.distanceKm(lat, lon, self.lats[i], self.lons[i])
+			if len(best) < count:
+				heapq.heappush(best, (-km, i))
+			elif km < -best[0][0]:
+				heapq.heapreplace(best, (-km, i))
+		stops = self.schedule.stopTimes.stops
+		found = sorted((-km, i) for km, i in best)
+		return [dict(stop_id = stops[i].stop_id, name = stops[i].name, km = km) for km, i in found]
+
+	def journey(self, request):
+		origin = self.stop(request.get("origin"))
+		destination = self.stop(request.get("destination"))
+		date, time = QueryContext.when(request)
+		return journeyDict(self.cache.journey(origin, destination, date, time))
+
+	def answer(self, request):
+		handler = {
+			"departures": self.departures,
+			"nearest": self.nearest,
+			"journey": self.journey,
+		}.get(request.get("type"))
+		if handler is None:
+			raise QueryError("unknown query type %r" % request.get("type"))
+		with instrument.span("server." + request["type"]):
+			return handler(request)
+
+def stopTimeDict(stopTime):
+	trip = stopTime.trip
+	return dict(stop_id = stopTime.stop.stop_id, trip_id = trip.trip_id,
+			route = trip.routeName, headsign = stopTime.headsign,
+			arrival = stopTime.arrivalSeconds, departure = stopTime.departureSeconds,
+			delay = stopTime.delay)
+
+def journeyDict(journey):
+	if journey is None:
+		return None
+	legs = []
+	for leg in journey.rides:
+		if isinstance(leg, trip_planner.Walk):
+			legs.append(dict(type = "walk", source = leg.source.stop_id, dest = leg.dest.stop_id,
+					departure = leg.departureTime.seconds, arrival = leg.arrivalTime.seconds))
+		else:
+			legs.append(dict(type = "ride", trip_id = leg.trip.trip_id, route = leg.trip.routeName,
+					source = leg.start.stop.stop_id, dest = leg.stop.stop.stop_id,
+					departure = leg.departureTime.seconds, arrival = leg.arrivalTime.seconds))
+	if len(legs) == 0:
+		return dict(legs = legs, transfers = 0)
+	return dict(legs = legs, transfers = journey.transfers,
+			departure = journey.departureTime.seconds, arrival = journey.arrivalTime.seconds)
+
+# the QueryContext of a worker process
+context = None
+
+def startWorker(path, cacheDir):
+	global context
+	context = QueryContext(snapshot.loadSchedule(path, cacheDir))
+
+# what the client is told went wrong; anything but a QueryError is a field
+# of the wrong type or some other surprise, and still gets an answer
+def errorMessage(e):
+	if isinstance(e, QueryError):
+		return str(e)
+	return "bad request (%s: %s)" % (type(e).__name__, e)
+
+# (True, result) or (False, error message) for each request, so one bad
+# request does not fail the rest of its batch; against the worker's
+# context unless one is given
+def answerBatch(requests, answering = None):
+	if answering is None:
+		answering = context
+	answers = []
+	for request in requests:
+		try:
+			answers.append((True, answering.answer(request)))
+		except Exception as e:
+			answers.append((False, errorMessage(e)))
+	return answers
+
+class QueryServer:
+	# workers = 0 answers journeys on one thread of this process instead
+	# of worker processes, which is handy for tests and tiny feeds
+	def __init__(self, path, workers = None, cacheDir = None, maxPending = MAX_PENDING):
+		sched = snapshot.loadSchedule(path, cacheDir)
+		self.context = QueryContext(sched)
+		# the journey thread's own, since caches are not shared across
+		# threads; worker processes build theirs in startWorker
+		self.journeyContext = None
+		if workers == 0:
+			self.journeyContext = QueryContext(sched)
+			self.pool = ThreadPoolExecutor(max_workers = 1)
+		else:
+			self.pool = ProcessPoolExecutor(max_workers = workers, initializer = startWorker,
+					initargs = (path, cacheDir))
+		self.maxPending = maxPending
+		self.pending = None
+		self.batch = []
+		self.timer = None
+		self.server = None
+		# writer -> the task handling its connection
+		self.connections = {}
+
+	# the port actually bound, which matters for port = 0
+	async def start(self, host = HOST, port = PORT):
+		self.pending = asyncio.Semaphore(self.maxPending)
+		self.server = await asyncio.start_server(self.handle, host, port, limit = MAX_LINE)
+		return self.server.sockets[0].getsockname()[1]
+
+	async def close(self):
+		if self.server is not None:
+			self.server.close()
+			# their handlers see end of file and finish what they admitted
+			handlers = list(self.connections.values())
+			for writer in list(self.connections):
+				writer.close()
+			await asyncio.gather(*handlers, return_exceptions = True)
+			await self.server.wait_closed()
+		self.pool.shutdown()
+
+	async def serveForever(self):
+		async with self.server:
+			await self.server.serve_forever()
+
+	# a client's next line is only read once there is room for it, so a
+	# flood of requests backs up into the client's socket, not our memory
+	async def handle(self, reader, writer):
+		responding = set()
+		self.connections[writer] = asyncio.current_task()
+		try:
+			while True:
+				await self.pending.acquire()
+				try:
+					line = await reader.readline()
+				except (ConnectionError, ValueError):
+					line = b""
+				if len(line) == 0:
+					self.pending.release()
+					break
+				task = asyncio.ensure_future(self.respond(line, writer))
+				responding.add(task)
+				task.add_done_callback(responding.discard)
+			if len(responding) > 0:
+				await asyncio.gather(*responding, return_exceptions = True)
+		finally:
+			self.connections.pop(writer, None)
+			writer.close()
+
+	async def respond(self, line, writer):
+		try:
+			request = None
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict):
+					raise QueryError("requests are JSON objects")
+				result = await self.answer(request)
+				response = dict(id = request.get("id"), ok = True, result = result)
+			except Exception as e:
+				requestId = request.get("id") if isinstance(request, dict) else None
+				response = dict(id = requestId, ok = False, error = errorMessage(e))
+			writer.write((json.dumps(response) + "\n").encode())
+			await writer.drain()
+		finally:
+			self.pending.release()
+
+	async def answer(self, request):
+		if request.get("type") == "journey":
+			ok, result = await self.submit(request)
+			if not ok:
+				raise QueryError(result)
+			return result
+		return self.context.answer(request)
+
+	# journeys wait up to BATCH_SECONDS for company, then go to the pool
+	# together, so one round trip to a worker serves many of them
+	def submit(self, request):
+		future = asyncio.get_running_loop().create_future()
+		self.batch.append((request, future))
+		if len(self.batch) >= BATCH_SIZE:
+			self.flush()
+		elif self.timer is None:
+			self.timer = asyncio.get_running_loop().call_later(BATCH_SECONDS, self.flush)
+		return future
+
+	def flush(self):
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		batch, self.batch = self.batch, []
+		if len(batch) == 0:
+			return
+		instrument.observe("server.batchSize", len(batch))
+		loop = asyncio.get_running_loop()
+		answers = loop.run_in_executor(self.pool, answerBatch, [r for r, _ in batch],
+				self.journeyContext)
+
+		def deliver(done):
+			futures = [f for _, f in batch]
+			if done.exception() is not None:
+				for future in futures:
+					if not future.done():
+						future.set_result((False, "worker failed: %s" % done.exception()))
+				return
+			for future, answer in zip(futures, done.result()):
+				if not future.done():
+					future.set_result(answer)
+		answers.add_done_callback(deliver)
+
+# a small pipelining client, for tests and scripts
+class QueryClient:
+	def __init__(self, reader, writer):
+		self.reader = reader
+		self.writer = writer
+		self.ids = itertools.count(1)
+		self.waiting = {}
+		self.listener = asyncio.ensure_future(self.listen())
+
+	@classmethod
+	async def connect(cls, host = HOST, port = PORT):
+		reader, writer = await asyncio.open_connection(host, port, limit = MAX_LINE)
+		return cls(reader, writer)
+
+	async def listen(self):
+		while True:
+			line = await self.reader.readline()
+			if len(line) == 0:
+				break
+			response = json.loads(line)
+			future = self.waiting.pop(response.get("id"), None)
+			if future is not None and not future.done():
+				future.set_result(response)
+		for future in self.waiting.values():
+			if not future.done():
+				future.set_exception(ConnectionError("server closed the connection"))
+
+	# the result, or QueryError with the server's message
+	async def query(self, **request):
+		request["id"] = next(self.ids)
+		future = asyncio.get_running_loop().create_future()
+		self.waiting[request["id"]] = future
+		self.writer.write((json.dumps(request) + "\n").encode())
+		await self.writer.drain()
+		response = await future
+		if not response["ok"]:
+			raise QueryError(response["error"])
+		return response["result"]
+
+	async def close(self):
+		self.writer.close()
+		await self.listener
+
+def main():
+	import sys
+	path = sys.argv[1] if len(sys.argv) > 1 else schedule.RAIL_PATH
+	port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+
+	async def run():
+		server = QueryServer(path)
+		bound = await server.start(HOST, port)
+		print("serving %s on %s:%d" % (path, HOST, bound))
+		try:
+			await server.serveForever()
+		finally:
+			await server.close()
+
+	asyncio.run(run())
+
+if __name__ == "__main__":
+	main()
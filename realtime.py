@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import json
+import queue
+
+# Real-time updates for a finished Schedule, applied to its overlay. An
+# update is a dict, one JSON object per line when read from a file:
+#   {"trip_id": ..., "delay": seconds}             the whole trip
+#   {"trip_id": ..., "delay": seconds, "stop_sequence": n}   from n on
+#   {"trip_id": ..., "skip_stop": stop_id}
+#   {"trip_id": ..., "cancelled": true}
+#   {"trip_id": ..., "restore": true}              back to the timetable
+#   {"reset": true}                                drop every change
+
+# False when the update names a trip the static feed does not have
+def applyUpdate(sched, update):
+	overlay = sched.overlay
+	if update.get("reset"):
+		overlay.reset()
+		return True
+
+	trip = sched.trips.get(update.get("trip_id"))
+	if trip is None:
+		return False
+	if "delay" in update:
+		fromSeq = update.get("stop_sequence")
+		if fromSeq is not None:
+			fromSeq = int(fromSeq)
+		overlay.delayTrip(trip.index, int(update["delay"]), fromSeq)
+	elif "skip_stop" in update:
+		stop = sched.stops.get(update["skip_stop"])
+		if stop is None:
+			return False
+		overlay.skipStop(trip.index, stop.index)
+	elif update.get("cancelled"):
+		overlay.cancelTrip(trip.index)
+	elif update.get("restore"):
+		overlay.restoreTrip(trip.index)
+	else:
+		raise ValueError("unknown update %r" % (update,))
+	return True
+
+# how many of updates were applied
+def applyUpdates(sched, updates):
+	return sum(1 for update in updates if applyUpdate(sched, update))
+
+def readUpdates(path):
+	with open(path, 'r') as f:
+		for line in f:
+			line = line.strip()
+			if len(line) > 0:
+				yield json.loads(line)
+
+def applyFile(sched, path):
+	return applyUpdates(sched, readUpdates(path))
+
+# everything already waiting on a queue.Queue of updates, without blocking
+def drainQueue(sched, updates):
+	applied = 0
+	while True:
+		try:
+			update = updates.get_nowait()
+		except queue.Empty:
+			return applied
+		if applyUpdate(sched, update):
+			applied += 1
+
+def main():
+	import sys
+	import schedule
+	import snapshot
+	sched = snapshot.loadSchedule(schedule.RAIL_PATH)
+	for path in sys.argv[1:]:
+		print("%s: %d updates applied" % (path, applyFile(sched, path)))
+
+if __name__ == "__main__":
+	main()
@@ -1,182 +1,331 @@
 #!/usr/bin/env python
 
+import heapq
+import itertools
+import os
+import numpy as np
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date as Date
 from time_space import Place
 from time_space import Time
+from time_space import parseSeconds
+from gtfs_reader import GtfsReader
+from shapes import ShapeStore
+import instrument
 
 RAIL_PATH = "../data/metro/gtfs/rail"
 BUS_PATH = "../data/metro/gtfs/bus"
+DEPARTURE_BLOCK = 64
+STOP_TIMES_CHUNK_BYTES = 8 << 20
+STOP_TIME_COLUMNS = ("trip_id", "arrival_time", "departure_time", "stop_id",
+		"stop_sequence", "stop_headsign")
+STOP_TIME_OPTIONAL = ("stop_headsign",)
 
 class Schedule:
 	def __init__(self):
 		#self.agencies = {}
-		#self.shapes = {}
+		# shapes of the feed loaded by loadObjects; trips merged in by
+		# loadFeeds keep their own feed's
+		self.shapes = None
 		self.services = {}
 		self.routes = {}
 		self.stops = {}
-		self.stopTimes = set()
+		self.stopTimes = StopTimeTable()
 		self.trips = {}
+		self.calendar = None
 
+	# real-time changes over the static data; see realtime.py
+	@property
+	def overlay(self):
+		return self.stopTimes.overlay
 
 	def loadSchedule(self, path):
+		self.loadObjects(path)
+		self.loadStopTimes(path) # depends on stops & trips
+
+	def loadObjects(self, path):
+		self.shapes = ShapeStore(path) # nothing is read until a shape is asked for
 		self.loadServices(path)
 		self.loadExceptionServices(path)
 		self.loadRoutes(path)
 		self.loadTrips(path) # depends on services
 		self.loadStops(path)
-		self.loadStopTimes(path) # depends on stops & trips
+
+	# Several feeds at once, e.g. [RAIL_PATH, BUS_PATH]. Ids are qualified
+	# as "namespace:id" (namespaces default to the feed names and must all
+	# differ) so feeds cannot overwrite each other. Each feed's small files
+	# and each chunk of its stop_times.txt are parsed in their own worker
+	# process.
+	def loadFeeds(self, paths, namespaces = None, workers = None):
+		if namespaces is None:
+			namespaces = [feedName(p) for p in paths]
+		if len(set(namespaces)) < len(namespaces):
+			raise ValueError("feeds need distinct namespaces, not %s" % ", ".join(map(str, namespaces)))
+		with ProcessPoolExecutor(max_workers = workers) as pool, instrument.span("load.feeds") as span:
+			feeds = [pool.submit(loadFeedObjects, path) for path in paths]
+			chunks = []
+			for path in paths:
+				with GtfsReader(path) as reader:
+					ranges = reader.byteRanges("stop_times", STOP_TIMES_CHUNK_BYTES)
+				if ranges is None:
+					# compressed: one worker streams the whole table
+					ranges = [(None, None)]
+				chunks.append([pool.submit(parseStopTimesChunk, path, start, end)
+						for start, end in ranges])
+
+			for feed, namespace, feedChunks in zip(feeds, namespaces, chunks):
+				feed = feed.result()
+				self.mergeFeed(feed, namespace)
+				for chunk in feedChunks:
+					chunk = chunk.result()
+					self.addStopTimesChunk(feed, chunk)
+					span.addRows(len(chunk.seq))
+
+	def mergeFeed(self, feed, namespace):
+		def qualify(name):
+			return name if namespace is None else "%s:%s" % (namespace, name)
+
+		for service in feed.services.values():
+			service.service_id = qualify(service.service_id)
+			self.services[service.service_id] = service
+		for route in feed.routes.values():
+			route.route_id = qualify(route.route_id)
+			self.routes[route.route_id] = route
+		for trip in feed.trips.values():
+			trip.trip_id = qualify(trip.trip_id)
+			self.stopTimes.addTrip(trip)
+			self.trips[trip.trip_id] = trip
+		for stop in feed.stops.values():
+			stop.stop_id = qualify(stop.stop_id)
+			if stop.parent_id is not None:
+				stop.parent_id = qualify(stop.parent_id)
+			self.stopTimes.addStop(stop)
+			self.stops[stop.stop_id] = stop
+
+	# chunk ids are the feed's own; feed's dicts are still keyed by them
+	def addStopTimesChunk(self, feed, chunk):
+		table = self.stopTimes
+		tripMap = np.array([feed.trips[t].index for t in chunk.tripIds], dtype = np.int32)
+		stopMap = np.array([feed.stops[s].index for s in chunk.stopIds], dtype = np.int32)
+		headsignMap = np.array([table.headsignFor(h) for h in chunk.headsigns], dtype = np.int32)
+		table.addRows(
+			tripMap[chunk.tripCodes],
+			stopMap[chunk.stopCodes],
+			chunk.seq,
+			headsignMap[chunk.headsignCodes],
+			chunk.arrival,
+			chunk.departure,
+		)
 
 	def finish(self):
-		self.computeChildren()
-		self.finishAll()
+		with instrument.span("finish.computeChildren") as span:
+			self.computeChildren()
+			span.addRows(len(self.stopTimes))
+		with instrument.span("finish.finishAll") as span:
+			self.finishAll()
+			span.addRows(len(self.routes))
+		with instrument.span("finish.computeCalendar") as span:
+			self.computeCalendar()
+			span.addRows(len(self.services))
 
 
 	def loadExceptionServices(self, path):
-		path += "/calendar_dates.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			service_id = words[0]
-			start_date = words[1]
-			end_date = words[1]
-			service = Service(service_id, start_date, end_date)
-			self.services[service_id] = service
-		f.close()
+		with GtfsReader(path) as reader, instrument.span("load.calendarDates") as span:
+			if not reader.exists("calendar_dates"):
+				return
+			columns = ("service_id", "date", "exception_type")
+			rows = reader.rows("calendar_dates", columns)
+			for service_id, date, exception_type in span.counted(rows):
+				service = self.services.get(service_id)
+				if service is None:
+					# only runs on the dates calendar_dates.txt adds
+					service = Service(service_id, date, date, Service.NO_DAYS)
+					self.services[service_id] = service
+				service.addException(date, int(exception_type))
 
 	def loadServices(self, path):
-		path += "/calendar.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			service_id = words[0]
-			start_date = words[8]
-			end_date = words[9]
-			service = Service(service_id, start_date, end_date)
-			self.services[service_id] = service
-		f.close()
+		with GtfsReader(path) as reader, instrument.span("load.calendar") as span:
+			if not reader.exists("calendar"):
+				return
+			columns = ("service_id",) + Service.DAY_COLUMNS + ("start_date", "end_date")
+			for row in span.counted(reader.rows("calendar", columns)):
+				service_id = row[0]
+				days = tuple(w == "1" for w in row[1:8])
+				start_date = row[8]
+				end_date = row[9]
+				service = Service(service_id, start_date, end_date, days)
+				self.services[service_id] = service
 
 	def loadStops(self, path):
-		path = path + "/stops.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			stop_id = words[0]
-			name = words[2]
-			lat = float(words[4])
-			lng = float(words[5])
-			parent_id = words[8] if len(words[8]) > 0 else None
-			stop = Stop(stop_id, name, lat, lng, parent_id)
-			self.stops[stop_id] = stop
-		f.close()
+		columns = ("stop_id", "stop_name", "stop_lat", "stop_lon", "parent_station")
+		with GtfsReader(path) as reader, instrument.span("load.stops") as span:
+			rows = reader.rows("stops", columns, ("parent_station",))
+			for stop_id, name, lat, lng, parent_id in span.counted(rows):
+				parent_id = parent_id if len(parent_id) > 0 else None
+				stop = Stop(stop_id, name, float(lat), float(lng), parent_id)
+				self.stopTimes.addStop(stop)
+				self.stops[stop_id] = stop
 
 	def loadStopTimes(self, path):
-		path = path + "/stop_times.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			trip_id = words[0]
-			trip = self.trips[trip_id]
-			arr = words[1]
-			dep = words[2]
-			stop_id = words[3]
-			seq = int(words[4])
-			headsign = words[5]
-			stop = self.stops[stop_id]
-			stopTime = StopTime(trip, stop, seq, headsign, arr, dep)
-			self.stopTimes.add(stopTime)
-		f.close()
-
-	def loadStops(self, path):
-		path = path + "/stops.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			stop_id = words[0]
-			name = words[2]
-			lat = float(words[4])
-			lng = float(words[5])
-			parent_id = words[8] if len(words[8]) > 0 else None
-			stop = Stop(stop_id, name, lat, lng, parent_id)
-			self.stops[stop_id] = stop
-		f.close()
+		table = self.stopTimes
+		# per-row work below is all C-level map calls
+		tripIndex = {trip_id: trip.index for trip_id, trip in self.trips.items()}
+		stopIndex = {stop_id: stop.index for stop_id, stop in self.stops.items()}
+		with GtfsReader(path) as reader, instrument.span("load.stopTimes") as span:
+			batches = reader.batches("stop_times", STOP_TIME_COLUMNS, STOP_TIME_OPTIONAL)
+			for trip_ids, arrs, deps, stop_ids, seqs, headsigns in batches:
+				span.addRows(len(trip_ids))
+				headsignIndex = {h: table.headsignFor(h) for h in set(headsigns)}
+				table.addRows(
+					list(map(tripIndex.__getitem__, trip_ids)),
+					list(map(stopIndex.__getitem__, stop_ids)),
+					list(map(int, seqs)),
+					list(map(headsignIndex.__getitem__, headsigns)),
+					list(map(parseSeconds, arrs)),
+					list(map(parseSeconds, deps)),
+				)
 
 	def loadTrips(self, path):
-		path = path + "/trips.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(",")
-			route_id = words[0]
-			route = self.routes[route_id]
-			service_id = words[1]
-			service = self.services[service_id]
-			trip_id = words[2]
-			shape_id = words[6]
-			trip = Trip(trip_id, route, service, shape_id)
-			self.trips[trip_id] = trip
-		f.close()
+		columns = ("route_id", "service_id", "trip_id", "shape_id")
+		with GtfsReader(path) as reader, instrument.span("load.trips") as span:
+			rows = reader.rows("trips", columns, ("shape_id",))
+			for route_id, service_id, trip_id, shape_id in span.counted(rows):
+				route = self.routes[route_id]
+				service = self.services[service_id]
+				trip = Trip(trip_id, route, service, shape_id, self.shapes)
+				self.stopTimes.addTrip(trip)
+				self.trips[trip_id] = trip
 
 	def loadRoutes(self, path):
-		path += "/routes.txt"
-		f = open(path, 'r')
-		f.readline()
-		for line in f:
-			words = line.split(',')
-			route_id = words[0]
-			name = words[1]
-			if len(name) == 0:
-				name = words[2]
-			route = Route(route_id, name)
-			self.routes[route_id] = route
-		f.close()
+		columns = ("route_id", "route_short_name", "route_long_name")
+		with GtfsReader(path) as reader, instrument.span("load.routes") as span:
+			rows = reader.rows("routes", columns, columns[1:])
+			for route_id, short_name, long_name in span.counted(rows):
+				name = short_name
+				if len(name) == 0:
+					name = long_name
+				route = Route(route_id, name)
+				self.routes[route_id] = route
 
 
 	def computeChildren(self):
-		for stopTime in self.stopTimes:
-			stop = stopTime.stop
-			trip = stopTime.trip
-			route = trip.route
-			service = trip.service
-			stop.addStopTime(stopTime)
-			trip.addStopTime(stopTime)
-			route.addTrip(trip)
-			service.addTrip(trip)
+		table = self.stopTimes
+		with instrument.span("finish.sortStopTimes"):
+			table.finish()
+
+		routes = list({id(t.route): t.route for t in table.trips}.values())
+		routeIndex = {id(r): i for i, r in enumerate(routes)}
+		tripRoutes = np.array([routeIndex[id(t.route)] for t in table.trips],
+				dtype = np.int64)
+
+		# trips that have stop times, grouped by route and in start order by
+		# one sort, so every route's list is built by appends alone
+		running = np.flatnonzero(np.diff(table.tripOffsets) > 0)
+		starts = table.arrival[table.tripOffsets[running]]
+		for i in running[np.lexsort((starts, tripRoutes[running]))].tolist():
+			trip = table.trips[i]
+			trip.route.addTrip(trip)
+			trip.service.addTrip(trip)
+
+		# one (stop, route) pair per distinct combination, not per row
+		pairs = table.stopIndex.astype(np.int64) * len(routes)
+		pairs += tripRoutes[table.tripIndex]
+		for pair in np.unique(pairs).tolist():
+			stopIndex, r = divmod(pair, len(routes))
+			table.stops[stopIndex].routes.add(routes[r])
+
+		# one (stop, route, next stop) triple per distinct hop between
+		# consecutive stop times, whatever the trip's stop_sequence values
+		stopCount = len(table.stops)
+		hops = np.flatnonzero(table.tripIndex[:-1] == table.tripIndex[1:])
+		triples = table.stopIndex[hops].astype(np.int64) * len(routes)
+		triples += tripRoutes[table.tripIndex[hops]]
+		triples = triples * stopCount + table.stopIndex[hops + 1]
+		for triple in np.unique(triples).tolist():
+			pair, nextIndex = divmod(triple, stopCount)
+			stopIndex, r = divmod(pair, len(routes))
+			table.stops[stopIndex].addNextStop(routes[r], table.stops[nextIndex])
+
+		for stop in table.stops:
+			parent = self.stops.get(stop.parent_id)
+			if parent is not None and stop not in parent.children:
+				parent.children.append(stop)
 
 	def finishAll(self):
-		for trip in self.trips.values():
-			trip.finish()
 		for route in self.routes.values():
 			route.finish()
-		for stop in self.stops.values():
-			stop.finish()
 
+	def computeCalendar(self):
+		self.calendar = ServiceCalendar(self.services.values(), self.stopTimes)
+
+	# the per-date index the queries below need; only getServices can do
+	# without it
+	def requireCalendar(self):
+		if self.calendar is None:
+			raise RuntimeError("the schedule has no service calendar yet: call finish() first")
+		return self.calendar
 
 	def getServices(self, date):
-		return [s for s in self.services.values() if s.includes(date)]
+		with instrument.span("query.getServices") as span:
+			if self.calendar is None:
+				services = [s for s in self.services.values() if s.includes(date)]
+			else:
+				indices = self.calendar.getServiceIndices(date)
+				services = [self.calendar.services[i] for i in indices.tolist()]
+			span.addRows(len(services))
+			return services
 
 	def getTrips(self, date):
-		services = self.getServices(date)
-		trips = self.trips.values()
-		return [t for t in trips if t.service in services]
+		with instrument.span("query.getTrips") as span:
+			trips = self.stopTimes.trips
+			indices = self.requireCalendar().getTripIndices(date)
+			span.addRows(len(indices))
+			return [trips[i] for i in indices.tolist()]
+
+	def getTripMask(self, date):
+		with instrument.span("query.getTripMask") as span:
+			indices = self.requireCalendar().getTripIndices(date)
+			span.addRows(len(indices))
+			mask = np.zeros(len(self.stopTimes.trips), dtype = bool)
+			mask[indices] = True
+			return mask
 
 	def getStopTimes(self, date):
-		trips = self.getTrips(date)
-		return [st for st in self.stopTimes if st.trip in trips]
+		with instrument.span("query.getStopTimes") as span:
+			table = self.stopTimes
+			tripIndices = self.requireCalendar().getTripIndices(date)
+			rows = table.rowsForTrips(tripIndices)
+			span.addRows(len(rows))
+			return StopTimeView(table, rows)
 
 	def getStops(self, date):
-		trips = self.getTrips(date)
-		stops = self.stops.values()
-		toRet = []
-		for stop in stops:
-			for stopTime in stop.stopTimes:
-				if stopTime.trip in trips:
-					toRet.append(stop)
-					break
+		with instrument.span("query.getStops") as span:
+			stops = self.stopTimes.stops
+			indices = self.requireCalendar().getStopIndices(date)
+			span.addRows(len(indices))
+			return [stops[i] for i in indices.tolist()]
+
+	# "next departures from stop after time on date", including the stop's
+	# children (platforms of a station) unless children is False
+	def getDepartures(self, stop, date, time, count = None, children = True):
+		stops = [stop] + (stop.children if children else [])
+		running = self.requireCalendar().runningOn(date)
+		table = self.stopTimes
+		boards = [table.departureRows(s.index, time.seconds, running) for s in stops]
+		rows = heapq.merge(*boards)
+		if count is not None:
+			rows = itertools.islice(rows, count)
+		stopTimes = (table.stopTime(row) for _, row in rows)
+		return instrument.spanIter("query.getDepartures", stopTimes)
+
+	def getTripsInRange(self, start, finish):
+		trips = self.stopTimes.trips
+		toRet = {}
+		with instrument.span("query.getTripsInRange") as span:
+			for date, indices in self.requireCalendar().iterTripIndices(start, finish):
+				toRet[date] = [trips[i] for i in indices.tolist()]
+				span.addRows(len(indices))
 		return toRet
 
 class Service:
@@ -187,56 +336,196 @@ class Service:
 		day = int(s[6:8])
 		return Date(year, month, day)
 
-	def __init__(self, service_id, start_date, end_date):
+	DAY_COLUMNS = ("monday", "tuesday", "wednesday", "thursday", "friday",
+			"saturday", "sunday")
+	ALL_DAYS = (True,) * 7
+	NO_DAYS = (False,) * 7
+	ADDED = 1
+	REMOVED = 2
+
+	# days are monday through sunday, as in calendar.txt
+	def __init__(self, service_id, start_date, end_date, days = ALL_DAYS):
 		self.service_id = service_id
 		self.start = Service.getDate(start_date)
 		self.finish = Service.getDate(end_date)
+		self.days = days
+		self.added = set()
+		self.removed = set()
+		self.index = None
 		self.trips = {}
 
 	def addTrip(self, trip):
 		self.trips[trip.trip_id] = trip
 
+	def addException(self, date, exception_type):
+		date = Service.getDate(date)
+		if exception_type == Service.ADDED:
+			self.added.add(date)
+			self.removed.discard(date)
+		elif exception_type == Service.REMOVED:
+			self.removed.add(date)
+			self.added.discard(date)
+
+	@property
+	def firstDate(self):
+		return min([self.start] + list(self.added))
+
+	@property
+	def lastDate(self):
+		return max([self.finish] + list(self.added))
+
 	def includes(self, date):
+		if date in self.removed:
+			return False
+		if date in self.added:
+			return True
 		afterStart = date.toordinal() >= self.start.toordinal()
 		beforeFinish = date.toordinal() <= self.finish.toordinal()
-		return afterStart and beforeFinish
+		return afterStart and beforeFinish and self.days[date.weekday()]
 
 	def __str__(self):
 		return self.start.__str__() + " - " + self.finish.__str__()
 
+# which services, trips and stops run on each day, as flat offset/index
+# arrays so a date lookup costs O(result) instead of a scan
+class ServiceCalendar:
+	def __init__(self, services, table):
+		self.services = list(services)
+		for i, service in enumerate(self.services):
+			service.index = i
+		self.computeDays()
+		self.computeTrips(table)
+		self.computeStops(table)
+
+	@staticmethod
+	def group(keys, values, count):
+		order = np.argsort(keys, kind = 'stable')
+		offsets = np.searchsorted(keys[order], np.arange(count + 1))
+		return values[order], offsets
+
+	def computeDays(self):
+		if len(self.services) == 0:
+			self.firstOrdinal = 0
+			self.dayServices, self.dayOffsets = ServiceCalendar.group(
+					np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int32), 0)
+			return
+
+		first = min(s.firstDate for s in self.services).toordinal()
+		last = max(s.lastDate for s in self.services).toordinal()
+		days = []
+		services = []
+		for service in self.services:
+			ordinals = np.arange(service.start.toordinal(), service.finish.toordinal() + 1)
+			# ordinal 1 (0001-01-01) was a monday
+			weekdays = (ordinals - 1) % 7
+			running = set(ordinals[np.array(service.days)[weekdays]].tolist())
+			running |= {d.toordinal() for d in service.added}
+			running -= {d.toordinal() for d in service.removed}
+			days.extend(running)
+			services.extend([service.index] * len(running))
+
+		self.firstOrdinal = first
+		days = np.array(days, dtype = np.int64) - first
+		services = np.array(services, dtype = np.int32)
+		self.dayServices, self.dayOffsets = ServiceCalendar.group(days, services,
+				last - first + 1)
+
+	def computeTrips(self, table):
+		tripServices = np.array([t.service.index for t in table.trips], dtype = np.int64)
+		tripIndices = np.arange(len(table.trips), dtype = np.int32)
+		self.serviceTrips, self.serviceTripOffsets = ServiceCalendar.group(
+				tripServices, tripIndices, len(self.services))
+		self.tripServices = tripServices.astype(np.int32)
+
+	# trip index -> whether it runs on date, checked per trip as asked
+	def runningOn(self, date):
+		services = set(self.getServiceIndices(date).tolist())
+		tripServices = self.tripServices
+		return lambda trip: int(tripServices[trip]) in services
+
+	def computeStops(self, table):
+		tripServices = np.array([t.service.index for t in table.trips], dtype = np.int64)
+		stopCount = max(len(table.stops), 1)
+		pairs = tripServices[table.tripIndex] * stopCount + table.stopIndex
+		pairs = np.unique(pairs)
+		services, stops = np.divmod(pairs, stopCount)
+		self.serviceStops, self.serviceStopOffsets = ServiceCalendar.group(
+				services, stops.astype(np.int32), len(self.services))
+
+	def getServiceIndices(self, date):
+		day = date.toordinal() - self.firstOrdinal
+		if day < 0 or day >= len(self.dayOffsets) - 1:
+			return self.dayServices[0:0]
+		return self.dayServices[self.dayOffsets[day]:self.dayOffsets[day + 1]]
+
+	@staticmethod
+	def gather(values, offsets, indices):
+		if len(indices) == 0:
+			return values[0:0]
+		return np.concatenate([values[offsets[i]:offsets[i + 1]] for i in indices.tolist()])
+
+	def getTripIndices(self, date):
+		services = self.getServiceIndices(date)
+		trips = ServiceCalendar.gather(self.serviceTrips, self.serviceTripOffsets, services)
+		return np.sort(trips)
+
+	def getStopIndices(self, date):
+		services = self.getServiceIndices(date)
+		stops = ServiceCalendar.gather(self.serviceStops, self.serviceStopOffsets, services)
+		return np.unique(stops)
+
+	def iterServiceIndices(self, start, finish):
+		for ordinal in range(start.toordinal(), finish.toordinal() + 1):
+			date = Date.fromordinal(ordinal)
+			yield date, self.getServiceIndices(date)
+
+	# days with the same set of running services share one lookup, so a
+	# week of weekdays costs one gather rather than five
+	def iterTripIndices(self, start, finish):
+		seen = {}
+		for date, services in self.iterServiceIndices(start, finish):
+			key = services.tobytes()
+			if key not in seen:
+				trips = ServiceCalendar.gather(self.serviceTrips,
+						self.serviceTripOffsets, services)
+				seen[key] = np.sort(trips)
+			yield date, seen[key]
+
 class Route:
 	def __init__(self, route_id, name):
 		self.route_id = route_id
 		self.name = name
 		self.trips = []
+		self.tripSet = set()
 
 	def addTrip(self, trip):
-		if not trip in self.trips:
+		if not trip in self.tripSet:
+			self.tripSet.add(trip)
 			self.trips.append(trip)
 
 	def finish(self):
-		self.trips.sort(key = lambda x: x.startTime.seconds)
+		self.trips.sort(key = lambda x: x.startSeconds)
 
 	def __str__(self):
 		return "%s" % self.name
 
 class Trip:
-	def __init__(self, trip_id, route, service, shape_id):
+	def __init__(self, trip_id, route, service, shape_id, shapes = None):
 		self.trip_id = trip_id
 		self.route = route
 		self.service = service
 		self.shape_id = shape_id
-		self.stops = []
-		self.stopTimes = []
+		self.shapes = shapes
+		self.index = None
+		self.table = None
 
-	def addStopTime(self, stopTime):
-		if not stopTime in self.stopTimes:
-			self.stopTimes.append(stopTime)
+	@property
+	def stopTimes(self):
+		return self.table.tripStopTimes(self.index)
 
-	def finish(self):
-		self.stopTimes.sort(key = lambda x : x.seq)
-		for stopTime in self.stopTimes:
-			self.stops.append(stopTime.stop)
+	@property
+	def stops(self):
+		return self.table.tripStops(self.index)
 
 	@property
 	def firstStop(self):
@@ -254,13 +543,21 @@ class Trip:
 	def destinationName(self):
 		return self.lastStop.stop.name
 
+	@property
+	def startSeconds(self):
+		return int(self.table.arrival[self.table.tripOffsets[self.index]])
+
+	@property
+	def finishSeconds(self):
+		return int(self.table.arrival[self.table.tripOffsets[self.index + 1] - 1])
+
 	@property
 	def startTime(self):
-		return self.firstStop.arrivalTime
+		return Time(seconds = self.startSeconds)
 
 	@property
 	def finishTime(self):
-		return self.lastStop.arrivalTime
+		return Time(seconds = self.finishSeconds)
 
 	@property
 	def duration(self):
@@ -270,11 +567,22 @@ class Trip:
 	def routeName(self):
 		return self.route.__str__()
 
-	# assumes that stop times are always numbered starting with one
+	@property
+	def cancelled(self):
+		return self.table.overlay.isCancelled(self.index)
+
+	# the trip's Shape, decoded on first use; None without one
+	@property
+	def shape(self):
+		if self.shapes is None or len(self.shape_id) == 0:
+			return None
+		return self.shapes.get(self.shape_id)
+
 	def nextStopTime(self, stopTime):
-		if stopTime.seq >= len(self.stopTimes):
+		row = stopTime.row + 1
+		if row >= self.table.tripOffsets[self.index + 1]:
 			return None
-		return self.stopTimes[stopTime.seq]
+		return self.table.stopTime(row)
 
 	def __str__(self):
 		lineName = self.routeName
@@ -291,16 +599,27 @@ class Stop:
 		self.stop_id = stop_id
 		self.name = name
 		self.parent_id = parent
-		self.stopTimes = []
+		self.index = None
+		self.table = None
 		self.routes = set()
+		self.nextStops = set()
+		self.routeNextStops = {}
+		self.children = []
 
-	def addStopTime(self, stopTime):
-		if not stopTime in self.stopTimes:
-			self.stopTimes.append(stopTime)
-			self.routes.add(stopTime.trip.route)
+	def departures(self, time, running = None):
+		rows = self.table.departureRows(self.index, time.seconds, running)
+		return (self.table.stopTime(row) for _, row in rows)
 
-	def finish(self):
-		self.stopTimes.sort(key = lambda x: x.arrivalTime.seconds)
+	def addNextStop(self, route, stop):
+		self.nextStops.add(stop)
+		self.routeNextStops.setdefault(route, set()).add(stop)
+
+	def nextStopsOn(self, route):
+		return self.routeNextStops.get(route, set())
+
+	@property
+	def stopTimes(self):
+		return self.table.stopStopTimes(self.index)
 
 	@property
 	def latitude(self):
@@ -317,35 +636,71 @@ class Stop:
 		return self.parent_id is None
 
 	def onSameRoute(self, other):
-		return len(self.routes & other.routes) > 0
+		return not self.routes.isdisjoint(other.routes)
 
 	def isNeighboringStop(self, other):
-		if not self.onSameRoute(other):
-			return False
-
-		for stopTime in self.stopTimes:
-			nextStopTime = stopTime.trip.nextStopTime(stopTime)
-			if nextStopTime is not None:
-				nextStop = nextStopTime.stop
-				if nextStop is other:
-					return True
-		return False
+		return other in self.nextStops
 
 	def __str__(self):
 		values = (self.stop_id, self.location.__str__(), self.name)
 		return "Stop %s @ %s: %s" % values
 
 class StopTime:
-	def __init__(self, trip, stop, seq, headsign, arrival, departure):
-		self.trip = trip
-		self.stop = stop
-		self.seq = seq
-		self.headsign = headsign
-		self.arrivalTime = Time.fromString(arrival)
-		self.departureTime = Time.fromString(departure)
+	def __init__(self, table, row):
+		self.table = table
+		self.row = row
+
+	@property
+	def trip(self):
+		return self.table.trips[self.table.tripIndex[self.row]]
+
+	@property
+	def stop(self):
+		return self.table.stops[self.table.stopIndex[self.row]]
+
+	@property
+	def seq(self):
+		return int(self.table.seq[self.row])
+
+	@property
+	def headsign(self):
+		return self.table.headsigns[self.table.headsignIndex[self.row]]
+
+	# real-time delay in seconds, 0 when running to schedule
+	@property
+	def delay(self):
+		return self.table.overlay.delay(self.row)
+
+	@property
+	def skipped(self):
+		return self.table.overlay.isSkipped(self.row)
+
+	@property
+	def arrivalSeconds(self):
+		return int(self.table.arrival[self.row]) + self.delay
+
+	@property
+	def departureSeconds(self):
+		return int(self.table.departure[self.row]) + self.delay
+
+	@property
+	def arrivalTime(self):
+		return Time(seconds = self.arrivalSeconds)
+
+	@property
+	def departureTime(self):
+		return Time(seconds = self.departureSeconds)
 
 	def onSameTrip(self, other):
-		return self.trip is other.trip
+		return self.table.tripIndex[self.row] == other.table.tripIndex[other.row]
+
+	def __eq__(self, other):
+		if not isinstance(other, StopTime):
+			return NotImplemented
+		return self.table is other.table and self.row == other.row
+
+	def __hash__(self):
+		return hash(self.row)
 
 	def __str__(self):
 		arrive = self.arrivalTime
@@ -354,21 +709,391 @@ class StopTime:
 		seq = self.seq
 		routeName = self.trip.route.name
 		headsign = self.headsign
-		loc = self.location
+		loc = self.stop.location
 		values = (routeName, headsign, seq, arrive, loc, stopName)
 		return "%s --> %s \n  [Stop #%2d @ %s]: %s %s" % values
 
+class StopTimeView:
+	def __init__(self, table, rows):
+		self.table = table
+		self.rows = rows
 
+	def __len__(self):
+		return len(self.rows)
 
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return StopTimeView(self.table, self.rows[i])
+		return self.table.stopTime(int(self.rows[i]))
 
-def main():
+	def __iter__(self):
+		for row in self.rows.tolist():
+			yield self.table.stopTime(row)
+
+	@property
+	def arrivals(self):
+		return self.table.arrival[self.rows] + self.table.overlay.delays(self.rows)
+
+	@property
+	def departures(self):
+		return self.table.departure[self.rows] + self.table.overlay.delays(self.rows)
+
+# stop_times as parallel columns sorted by (trip, seq); StopTime objects are
+# only built when a row is actually looked at
+class StopTimeTable:
+	COLUMNS = (
+		("tripIndex", np.int32),
+		("stopIndex", np.int32),
+		("seq", np.int32),
+		("headsignIndex", np.int32),
+		("arrival", np.int32),
+		("departure", np.int32),
+	)
+
+	def __init__(self):
+		self.trips = []
+		self.stops = []
+		self.headsigns = []
+		self.headsignIds = {}
+		self.pending = {name: array('i') for name, _ in StopTimeTable.COLUMNS}
+		for name, dtype in StopTimeTable.COLUMNS:
+			setattr(self, name, np.empty(0, dtype = dtype))
+		self.tripOffsets = np.zeros(1, dtype = np.int64)
+		self.stopOrder = np.empty(0, dtype = np.int64)
+		self.stopOffsets = np.zeros(1, dtype = np.int64)
+		self.overlay = Overlay(self)
+
+	def addTrip(self, trip):
+		trip.index = len(self.trips)
+		trip.table = self
+		self.trips.append(trip)
+
+	def addStop(self, stop):
+		stop.index = len(self.stops)
+		stop.table = self
+		self.stops.append(stop)
+
+	def headsignFor(self, headsign):
+		headsignIndex = self.headsignIds.get(headsign)
+		if headsignIndex is None:
+			headsignIndex = len(self.headsigns)
+			self.headsignIds[headsign] = headsignIndex
+			self.headsigns.append(headsign)
+		return headsignIndex
+
+	def addRow(self, tripIndex, stopIndex, seq, headsign, arrival, departure):
+		headsignIndex = self.headsignFor(headsign)
+		pending = self.pending
+		pending["tripIndex"].append(tripIndex)
+		pending["stopIndex"].append(stopIndex)
+		pending["seq"].append(seq)
+		pending["headsignIndex"].append(headsignIndex)
+		pending["arrival"].append(arrival)
+		pending["departure"].append(departure)
+
+	# whole columns at once; headsigns already as indices
+	def addRows(self, tripIndex, stopIndex, seq, headsignIndex, arrival, departure):
+		values = (tripIndex, stopIndex, seq, headsignIndex, arrival, departure)
+		for (name, _), column in zip(StopTimeTable.COLUMNS, values):
+			self.pending[name].frombytes(np.asarray(column, dtype = np.int32).tobytes())
+
+	def finish(self):
+		grows = sum(len(rows) for rows in self.pending.values()) > 0
+		if grows and self.overlay.active:
+			# the overlay's per-row arrays would point at the wrong rows
+			raise RuntimeError("reset the real-time overlay before adding stop times")
+		columns = {}
+		for name, dtype in StopTimeTable.COLUMNS:
+			added = np.frombuffer(self.pending[name], dtype = np.int32)
+			columns[name] = np.concatenate((getattr(self, name), added))
+			self.pending[name] = array('i')
+
+		order = np.lexsort((columns["seq"], columns["tripIndex"]))
+		for name, dtype in StopTimeTable.COLUMNS:
+			setattr(self, name, columns[name][order].astype(dtype))
+
+		tripRange = np.arange(len(self.trips) + 1)
+		self.tripOffsets = np.searchsorted(self.tripIndex, tripRange)
+		# stable, so equal arrivals at a stop stay in (trip, seq) order
+		self.stopOrder = np.lexsort((self.arrival, self.stopIndex))
+		stopRange = np.arange(len(self.stops) + 1)
+		sortedStops = self.stopIndex[self.stopOrder]
+		self.stopOffsets = np.searchsorted(sortedStops, stopRange)
+		self.stopArrival = self.arrival[self.stopOrder]
+		# how far departure order can lag arrival order at a stop
+		dwell = self.departure.astype(np.int64) - self.arrival
+		self.maxDwell = int(dwell.max()) if len(dwell) > 0 else 0
+		if grows:
+			self.overlay.clear()
+
+	def stopTime(self, row):
+		return StopTime(self, row)
+
+	def tripRows(self, tripIndex):
+		return np.arange(self.tripOffsets[tripIndex], self.tripOffsets[tripIndex + 1])
+
+	def stopRows(self, stopIndex):
+		start = self.stopOffsets[stopIndex]
+		end = self.stopOffsets[stopIndex + 1]
+		return self.stopOrder[start:end]
+
+	def rowsForTrips(self, tripIndices):
+		starts = self.tripOffsets[tripIndices]
+		counts = self.tripOffsets[np.asarray(tripIndices) + 1] - starts
+		total = int(counts.sum())
+		if total == 0:
+			return np.empty(0, dtype = np.int64)
+		# row = trip start + position within the trip, without a python loop
+		shifts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+		return np.arange(total) + shifts
+
+	# (departure seconds, row) at one stop from seconds on, in departure
+	# order, skipping trips that end there and trips running(trip) rejects.
+	# Delays, skipped stops and cancellations in the overlay are applied.
+	def departureRows(self, stopIndex, seconds, running = None):
+		overlay = self.overlay
+		start = int(self.stopOffsets[stopIndex])
+		end = int(self.stopOffsets[stopIndex + 1])
+		arrivals = self.stopArrival[start:end]
+		# rows are in scheduled arrival order; a delay moves a departure by
+		# at most overlay.latest later or overlay.earliest sooner
+		lowest = seconds - self.maxDwell - overlay.latest
+		early = overlay.earliest
+		position = start + int(np.searchsorted(arrivals, lowest))
+		heap = []
+		while position < end:
+			block = slice(position, min(position + DEPARTURE_BLOCK, end))
+			rows = self.stopOrder[block]
+			blockArrivals = self.stopArrival[block].tolist()
+			departures = self.departure[rows]
+			if overlay.active:
+				departures = departures + overlay.delays(rows)
+			departures = departures.tolist()
+			trips = self.tripIndex[rows].tolist()
+			lastRows = (self.tripOffsets[self.tripIndex[rows] + 1] - 1).tolist()
+			for arrival, departure, row, trip, lastRow in zip(blockArrivals,
+					departures, rows.tolist(), trips, lastRows):
+				# nothing arriving from here on can depart before arrival, but
+				# it can depart at arrival from an earlier row, so ties wait
+				while len(heap) > 0 and heap[0][0] < arrival + early:
+					yield heapq.heappop(heap)
+				if departure < seconds or row == lastRow:
+					continue
+				if running is not None and not running(trip):
+					continue
+				if overlay.active and (trip in overlay.cancelled or overlay.isSkipped(row)):
+					continue
+				heapq.heappush(heap, (departure, row))
+			position = block.stop
+		while len(heap) > 0:
+			yield heapq.heappop(heap)
+
+	def tripStopTimes(self, tripIndex):
+		return StopTimeView(self, self.tripRows(tripIndex))
+
+	def tripStops(self, tripIndex):
+		start = self.tripOffsets[tripIndex]
+		end = self.tripOffsets[tripIndex + 1]
+		return [self.stops[i] for i in self.stopIndex[start:end].tolist()]
+
+	def stopStopTimes(self, stopIndex):
+		return StopTimeView(self, self.stopRows(stopIndex))
+
+	def __len__(self):
+		return len(self.tripIndex)
+
+	def __iter__(self):
+		for row in range(len(self)):
+			yield StopTime(self, row)
+
+# real-time changes laid over a finished table: per-row delays, skipped
+# stops and cancelled trips. The static columns are never written; an
+# update or a reset costs O(stop times of the trips it touches).
+class Overlay:
+	def __init__(self, table):
+		self.table = table
+		self.rowDelays = None
+		self.skippedRows = None
+		self.cancelled = set()
+		# every trip with any change, so reset knows what to clear
+		self.trips = set()
+		# bounds on every delay applied since the last reset
+		self.earliest = 0
+		self.latest = 0
+		# bumped on every change, for anything caching query results
+		self.version = 0
+
+	@property
+	def active(self):
+		return len(self.trips) > 0
+
+	def touch(self, tripIndex):
+		rows = len(self.table)
+		if self.rowDelays is None or len(self.rowDelays) != rows:
+			self.rowDelays = np.zeros(rows, dtype = np.int32)
+			self.skippedRows = np.zeros(rows, dtype = bool)
+		self.trips.add(tripIndex)
+		self.version += 1
+		start = int(self.table.tripOffsets[tripIndex])
+		end = int(self.table.tripOffsets[tripIndex + 1])
+		return start, end
+
+	# seconds late (early when negative) from stop_sequence fromSeq on, or
+	# for the whole trip; replaces any earlier delay for those stops. The
+	# trip cannot reach a stop before it left the one before, so running
+	# early after stops that still run late only makes up what the
+	# timetable's slack allows.
+	def delayTrip(self, tripIndex, seconds, fromSeq = None):
+		table = self.table
+		tripStart, end = self.touch(tripIndex)
+		start = tripStart
+		if fromSeq is not None:
+			start += int(np.searchsorted(table.seq[start:end], fromSeq))
+		if start == end:
+			return
+		self.rowDelays[start:end] = seconds
+		if start > tripStart:
+			left = int(table.departure[start - 1]) + int(self.rowDelays[start - 1])
+			arrivals = table.arrival[start:end].tolist()
+			departures = table.departure[start:end].tolist()
+			for i in range(len(arrivals)):
+				if arrivals[i] + seconds >= left:
+					break
+				self.rowDelays[start + i] = left - arrivals[i]
+				left = departures[i] + left - arrivals[i]
+		delays = self.rowDelays[start:end]
+		self.earliest = min(self.earliest, int(delays.min()))
+		self.latest = max(self.latest, int(delays.max()))
+
+	# the trip passes stopIndex without letting anyone on or off
+	def skipStop(self, tripIndex, stopIndex):
+		start, end = self.touch(tripIndex)
+		at = np.flatnonzero(self.table.stopIndex[start:end] == stopIndex)
+		self.skippedRows[start + at] = True
+
+	def cancelTrip(self, tripIndex):
+		self.touch(tripIndex)
+		self.cancelled.add(tripIndex)
+
+	# back to the static schedule for one trip
+	def restoreTrip(self, tripIndex):
+		if tripIndex not in self.trips:
+			return
+		start, end = self.touch(tripIndex)
+		self.rowDelays[start:end] = 0
+		self.skippedRows[start:end] = False
+		self.cancelled.discard(tripIndex)
+		self.trips.discard(tripIndex)
+
+	# forget the per-row arrays, for a table whose rows changed; the next
+	# change allocates them for the new rows
+	def clear(self):
+		self.rowDelays = None
+		self.skippedRows = None
+		self.version += 1
+
+	def reset(self):
+		for tripIndex in list(self.trips):
+			self.restoreTrip(tripIndex)
+		self.earliest = 0
+		self.latest = 0
+		self.version += 1
+
+	def delay(self, row):
+		if self.rowDelays is None:
+			return 0
+		return int(self.rowDelays[row])
+
+	# delays of many rows at once, or a scalar 0 with no overlay
+	def delays(self, rows):
+		if self.rowDelays is None:
+			return 0
+		return self.rowDelays[rows]
+
+	def isSkipped(self, row):
+		return self.skippedRows is not None and bool(self.skippedRows[row])
+
+	def isCancelled(self, tripIndex):
+		return tripIndex in self.cancelled
+
+
+
+
+# everything but stop_times.txt, for one loadFeeds worker
+def loadFeedObjects(path):
 	sched = Schedule()
-	sched.loadSchedule(RAIL_PATH)
-	sched.finish()
+	sched.loadObjects(path)
+	return sched
+
+def feedName(path):
+	return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+
+# the rows of stop_times.txt that start inside [start, end), with ids as
+# codes into per-chunk id lists so only compact arrays cross processes
+class StopTimeChunk:
+	def __init__(self):
+		self.tripIds = []
+		self.stopIds = []
+		self.headsigns = []
+		self.codes = ({}, {}, {})
+		self.tripCodes = array('i')
+		self.stopCodes = array('i')
+		self.seq = array('i')
+		self.headsignCodes = array('i')
+		self.arrival = array('i')
+		self.departure = array('i')
+
+	@staticmethod
+	def code(codes, names, name):
+		index = codes.get(name)
+		if index is None:
+			index = len(names)
+			codes[name] = index
+			names.append(name)
+		return index
+
+	def addBatch(self, trip_ids, arrs, deps, stop_ids, seqs, headsigns):
+		tripCodes, stopCodes, headsignCodes = self.codes
+		code = StopTimeChunk.code
+		for t in set(trip_ids).difference(tripCodes):
+			code(tripCodes, self.tripIds, t)
+		for s in set(stop_ids).difference(stopCodes):
+			code(stopCodes, self.stopIds, s)
+		for h in set(headsigns).difference(headsignCodes):
+			code(headsignCodes, self.headsigns, h)
+		self.tripCodes.extend(map(tripCodes.__getitem__, trip_ids))
+		self.stopCodes.extend(map(stopCodes.__getitem__, stop_ids))
+		self.headsignCodes.extend(map(headsignCodes.__getitem__, headsigns))
+		self.seq.extend(map(int, seqs))
+		self.arrival.extend(map(parseSeconds, arrs))
+		self.departure.extend(map(parseSeconds, deps))
+
+	def finish(self):
+		del self.codes
+		for name in ("tripCodes", "stopCodes", "seq", "headsignCodes", "arrival", "departure"):
+			setattr(self, name, np.frombuffer(getattr(self, name), dtype = np.int32))
+		return self
+
+# the whole table when start is None
+def parseStopTimesChunk(path, start = None, end = None):
+	chunk = StopTimeChunk()
+	with GtfsReader(path) as reader:
+		if start is None:
+			batches = reader.batches("stop_times", STOP_TIME_COLUMNS, STOP_TIME_OPTIONAL)
+		else:
+			batches = reader.rangeBatches("stop_times", start, end,
+					STOP_TIME_COLUMNS, STOP_TIME_OPTIONAL)
+		for batch in batches:
+			chunk.addBatch(*batch)
+	return chunk.finish()
+
+def main():
+	import snapshot
+	sched = snapshot.loadSchedule(RAIL_PATH)
 
 	date = Date(2016, 10, 5)
 	trips = sched.getTrips(date)
-	trips.sort(key = lambda x : x.startTime.seconds)
+	trips.sort(key = lambda x : x.startSeconds)
 	trips.sort(key = lambda x : x.destinationName)
 	trips.sort(key = lambda x : x.routeName)
 	for trip in trips:
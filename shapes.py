@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import csv
+import io
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import instrument
+from gtfs_reader import ColumnPicker
+from gtfs_reader import ENCODING
+from gtfs_reader import GtfsReader
+from gtfs_reader import cleanHeader
+
+SHAPE_CACHE_SIZE = 256
+SHAPE_COLUMNS = ("shape_pt_lat", "shape_pt_lon", "shape_pt_sequence")
+POLYLINE_SCALE = 1e5
+BOM = b"\xef\xbb\xbf"
+
+# The points of one shape in sequence order, as float32 degrees.
+class Shape:
+	__slots__ = ("shape_id", "lats", "lons")
+
+	def __init__(self, shape_id, lats, lons):
+		self.shape_id = shape_id
+		self.lats = lats
+		self.lons = lons
+
+	def __len__(self):
+		return len(self.lats)
+
+	# Google's encoded polyline format, 1e-5 degree precision
+	@property
+	def polyline(self):
+		return encodePolyline(self.lats, self.lons)
+
+	@classmethod
+	def fromPolyline(cls, shape_id, text):
+		lats, lons = decodePolyline(text)
+		return cls(shape_id, lats, lons)
+
+	def __str__(self):
+		return "%s (%d points)" % (self.shape_id, len(self))
+
+# Geometry from shapes.txt, paid for only by processes that ask for it.
+# The first request makes one pass over the file recording the byte ranges
+# each shape_id's rows occupy; after that a shape is read and decoded from
+# its own ranges alone. The last maxsize shapes asked for are kept, as
+# float32 arrays or, with encoded set, as polyline strings at a third of
+# the size. Only the feed path survives pickling.
+class ShapeStore:
+	def __init__(self, path, maxsize = SHAPE_CACHE_SIZE, encoded = False):
+		self.path = os.path.abspath(path)
+		self.maxsize = maxsize
+		self.encoded = encoded
+		self.reset()
+
+	def reset(self):
+		self.lock = threading.Lock()
+		self.header = None
+		# shape_id -> [(start, end)] byte ranges of its rows
+		self.ranges = None
+		self.cache = OrderedDict()
+
+	def __getstate__(self):
+		return dict(path = self.path, maxsize = self.maxsize, encoded = self.encoded)
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.reset()
+
+	def buildIndex(self):
+		ranges = {}
+		header = []
+		with GtfsReader(self.path) as reader, instrument.span("shapes.index") as span:
+			if reader.exists("shapes"):
+				with reader.openBinary("shapes") as f:
+					first = f.readline()
+					header = readHeader(first)
+					ranges = indexRanges(f, len(first), header.index("shape_id"))
+			span.addRows(len(ranges))
+		self.header = header
+		self.ranges = ranges
+
+	def index(self):
+		if self.ranges is None:
+			with self.lock:
+				if self.ranges is None:
+					self.buildIndex()
+		return self.ranges
+
+	def __contains__(self, shape_id):
+		return shape_id in self.index()
+
+	def __len__(self):
+		return len(self.index())
+
+	def shapeIds(self):
+		return list(self.index())
+
+	def lookup(self, shape_id):
+		with self.lock:
+			found = self.cache.get(shape_id)
+			if found is not None:
+				self.cache.move_to_end(shape_id)
+				instrument.count("shapes.cache.hits")
+			return found
+
+	def remember(self, shape_id, value):
+		with self.lock:
+			self.cache[shape_id] = value
+			if len(self.cache) > self.maxsize:
+				self.cache.popitem(last = False)
+
+	# the Shape for shape_id, None when the feed has no such shape
+	def get(self, shape_id):
+		found = self.lookup(shape_id)
+		if isinstance(found, str):
+			return Shape.fromPolyline(shape_id, found)
+		if found is not None:
+			return found
+		shape = self.decode(shape_id)
+		if shape is not None:
+			self.remember(shape_id, shape.polyline if self.encoded else shape)
+		return shape
+
+	def polyline(self, shape_id):
+		found = self.lookup(shape_id)
+		if isinstance(found, str):
+			return found
+		shape = found if found is not None else self.get(shape_id)
+		return None if shape is None else shape.polyline
+
+	def decode(self, shape_id):
+		ranges = self.index().get(shape_id)
+		if ranges is None:
+			return None
+		with GtfsReader(self.path) as reader, instrument.span("shapes.decode") as span:
+			with reader.openBinary("shapes") as f:
+				text = b"".join(readBytes(f, start, end) for start, end in ranges)
+			rows = list(filter(None, csv.reader(io.StringIO(text.decode(ENCODING), newline = ""))))
+			lats, lons, seqs = ColumnPicker(self.header, SHAPE_COLUMNS, (), "shapes").pick(rows)
+			order = np.argsort(np.array(seqs, dtype = np.int64), kind = 'stable')
+			lats = np.array(lats, dtype = np.float32)[order]
+			lons = np.array(lons, dtype = np.float32)[order]
+			span.addRows(len(rows))
+		return Shape(shape_id, lats, lons)
+
+	def clear(self):
+		with self.lock:
+			self.cache.clear()
+
+def readHeader(line):
+	if line.startswith(BOM):
+		line = line[len(BOM):]
+	return cleanHeader(next(csv.reader([line.decode(ENCODING)]), []))
+
+def readBytes(f, start, end):
+	f.seek(start)
+	return f.read(end - start)
+
+# shape_id -> [(start, end)] for the lines of f, which is at offset. Rows
+# of a shape are normally together, so consecutive lines share one range.
+def indexRanges(f, offset, column):
+	ranges = {}
+	current = None
+	start = offset
+	for line in f:
+		if b'"' in line:
+			fields = next(csv.reader([line.decode(ENCODING)]), [])
+			shape_id = fields[column].strip() if len(fields) > column else None
+		else:
+			fields = line.split(b",", column + 1)
+			shape_id = fields[column].strip().decode(ENCODING) if len(fields) > column else None
+		if shape_id != current:
+			if current is not None:
+				ranges.setdefault(current, []).append((start, offset))
+			current = shape_id
+			start = offset
+		offset += len(line)
+	if current is not None:
+		ranges.setdefault(current, []).append((start, offset))
+	# blank lines are ranges of their own
+	ranges.pop("", None)
+	return ranges
+
+def encodePolyline(lats, lons):
+	points = np.column_stack((lats, lons)).astype(np.float64)
+	points = np.round(points * POLYLINE_SCALE).astype(np.int64)
+	deltas = np.diff(points, axis = 0, prepend = np.zeros((1, 2), dtype = np.int64))
+	chars = []
+	for value in deltas.ravel().tolist():
+		value = ~(value << 1) if value < 0 else value << 1
+		while value >= 0x20:
+			chars.append(chr((0x20 | (value & 0x1f)) + 63))
+			value >>= 5
+		chars.append(chr(value + 63))
+	return "".join(chars)
+
+def decodePolyline(text):
+	values = []
+	value = 0
+	shift = 0
+	for char in text:
+		bits = ord(char) - 63
+		value |= (bits & 0x1f) << shift
+		shift += 5
+		if bits < 0x20:
+			values.append(~(value >> 1) if value & 1 else value >> 1)
+			value = 0
+			shift = 0
+	points = np.cumsum(np.array(values, dtype = np.int64).reshape(-1, 2), axis = 0)
+	points = (points / POLYLINE_SCALE).astype(np.float32)
+	return points[:, 0], points[:, 1]
+
+def main():
+	import sys
+	import schedule
+	path = sys.argv[1] if len(sys.argv) > 1 else schedule.RAIL_PATH
+	store = ShapeStore(path)
+	for shape_id in store.shapeIds()[:5]:
+		shape = store.get(shape_id)
+		print("%s %s" % (shape, store.polyline(shape_id)[:60]))
+
+if __name__ == "__main__":
+	main()
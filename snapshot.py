@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import numpy as np
+import instrument
+import schedule
+
+SNAPSHOT_VERSION = 7
+CACHE_DIR_NAME = ".transit_cache"
+OBJECTS_FILE = "schedule.pickle"
+STALE_SECONDS = 24 * 60 * 60
+
+# numpy arrays are pulled out of the pickle stream into their own .npy files
+# so that a restored snapshot can memory-map them instead of copying
+class SnapshotPickler(pickle.Pickler):
+	def __init__(self, f, directory):
+		super().__init__(f, protocol = pickle.HIGHEST_PROTOCOL)
+		self.directory = directory
+		self.arrayIds = {}
+
+	def persistent_id(self, obj):
+		if type(obj) is not np.ndarray or obj.dtype.hasobject:
+			return None
+		key = id(obj)
+		if key not in self.arrayIds:
+			name = "array%d.npy" % len(self.arrayIds)
+			np.save(os.path.join(self.directory, name), obj)
+			self.arrayIds[key] = (name, obj)
+		return self.arrayIds[key][0]
+
+class SnapshotUnpickler(pickle.Unpickler):
+	def __init__(self, f, directory, mmap = True):
+		super().__init__(f)
+		self.directory = directory
+		self.mmapMode = 'r' if mmap else None
+
+	def persistent_load(self, name):
+		path = os.path.join(self.directory, name)
+		return np.load(path, mmap_mode = self.mmapMode)
+
+# a feed is a directory of tables or a single .zip archive
+def feedFiles(path):
+	if os.path.isfile(path):
+		return [(os.path.basename(path), path)]
+	names = sorted(os.listdir(path))
+	return [(name, os.path.join(path, name)) for name in names
+			if os.path.isfile(os.path.join(path, name))]
+
+def feedKey(path):
+	h = hashlib.sha1()
+	h.update(("v%d" % SNAPSHOT_VERSION).encode())
+	for name, full in feedFiles(path):
+		st = os.stat(full)
+		h.update(("%s:%d:%d;" % (name, st.st_size, st.st_mtime_ns)).encode())
+	return h.hexdigest()
+
+# inside a directory feed; beside an archive, in a folder of its own so
+# archives sharing a directory do not clear each other's snapshots
+def cacheRoot(path, cacheDir = None):
+	if cacheDir is None:
+		if os.path.isfile(path):
+			folder, name = os.path.split(os.path.abspath(path))
+			cacheDir = os.path.join(folder, CACHE_DIR_NAME, name)
+		else:
+			cacheDir = os.path.join(path, CACHE_DIR_NAME)
+	return cacheDir
+
+def snapshotPath(path, cacheDir = None):
+	return os.path.join(cacheRoot(path, cacheDir), feedKey(path))
+
+def saveSnapshot(sched, path, cacheDir = None):
+	root = cacheRoot(path, cacheDir)
+	os.makedirs(root, exist_ok = True)
+	target = os.path.join(root, feedKey(path))
+
+	# build next to the target and rename, so readers never see half a
+	# snapshot. Snapshots under one key are interchangeable, so when
+	# another process got there first its snapshot stays: it may be
+	# being read right now.
+	tmp = tempfile.mkdtemp(prefix = ".tmp", dir = root)
+	try:
+		with open(os.path.join(tmp, OBJECTS_FILE), 'wb') as f, instrument.span("snapshot.save"):
+			f.write(("%d\n" % SNAPSHOT_VERSION).encode())
+			SnapshotPickler(f, tmp).dump(sched)
+		if not os.path.exists(target):
+			try:
+				os.rename(tmp, target)
+			except OSError:
+				if not os.path.exists(target):
+					raise
+	finally:
+		shutil.rmtree(tmp, ignore_errors = True)
+	return target
+
+# Snapshots of older versions of the feed are left by saveSnapshot, since a
+# process started before the feed changed may still be loading one. This
+# removes those, and builds abandoned by crashed processes, not written for
+# grace seconds, and returns their paths.
+def removeStaleSnapshots(path, cacheDir = None, grace = STALE_SECONDS):
+	root = cacheRoot(path, cacheDir)
+	if not os.path.isdir(root):
+		return []
+	current = feedKey(path)
+	cutoff = time.time() - grace
+	removed = []
+	for name in os.listdir(root):
+		stale = os.path.join(root, name)
+		if name == current or not os.path.isdir(stale):
+			continue
+		if name.startswith(".") and not name.startswith(".tmp"):
+			continue
+		if os.path.getmtime(stale) < cutoff:
+			shutil.rmtree(stale, ignore_errors = True)
+			removed.append(stale)
+	return removed
+
+def hasSnapshot(path, cacheDir = None):
+	return os.path.exists(os.path.join(snapshotPath(path, cacheDir), OBJECTS_FILE))
+
+# None when there is no usable snapshot, including one that was cleared
+# away or left incomplete while this process was reading it
+def loadSnapshot(path, cacheDir = None, mmap = True):
+	directory = snapshotPath(path, cacheDir)
+	objects = os.path.join(directory, OBJECTS_FILE)
+	try:
+		with open(objects, 'rb') as f:
+			version = f.readline().strip()
+			if version != str(SNAPSHOT_VERSION).encode():
+				return None
+			with instrument.span("snapshot.load"):
+				return SnapshotUnpickler(f, directory, mmap).load()
+	except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+		return None
+
+def loadSchedule(path, cacheDir = None, mmap = True):
+	sched = loadSnapshot(path, cacheDir, mmap)
+	if sched is None:
+		sched = schedule.Schedule()
+		sched.loadSchedule(path)
+		sched.finish()
+		try:
+			saveSnapshot(sched, path, cacheDir)
+		except OSError:
+			# a read-only feed directory just means no cache
+			pass
+	return sched
+
+def main():
+	import sys
+	path = sys.argv[1] if len(sys.argv) > 1 else schedule.RAIL_PATH
+	sched = schedule.Schedule()
+	sched.loadSchedule(path)
+	sched.finish()
+	print(saveSnapshot(sched, path))
+	for stale in removeStaleSnapshots(path):
+		print("removed %s" % stale)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+import datetime
+import math
+import os
+import random
+
+# Deterministic GTFS feeds of any size, for benchmarks and for trying the
+# loaders without the ../data/metro feeds. The same arguments always write
+# byte-identical files.
+
+START_DATE = datetime.date(2016, 10, 3) # a monday
+CENTER_LAT = 34.05
+CENTER_LON = -118.25
+STOP_SPACING_KM = 0.4
+FIRST_DEPARTURE = 5 * 60 * 60
+LAST_DEPARTURE = 23 * 60 * 60
+DWELL_SECONDS = 30
+STATION_EVERY = 20 # one stop in STATION_EVERY gets a parent station
+HEADER = {
+	"stops": "stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station",
+	"routes": "route_id,route_short_name,route_long_name,route_type",
+	"calendar": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date",
+	"calendar_dates": "service_id,date,exception_type",
+	"trips": "route_id,service_id,trip_id,direction_id,shape_id",
+	"stop_times": "trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign",
+	"shapes": "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence",
+}
+STEPS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+
+def gtfsDate(date):
+	return date.strftime("%Y%m%d")
+
+def gtfsTime(seconds):
+	return "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+# stops sit on a jittered square grid around CENTER_*, so routes can walk
+# between neighbouring cells and transfers find stops nearby
+class Grid:
+	def __init__(self, stops, rng):
+		self.side = max(int(math.ceil(math.sqrt(stops))), 1)
+		self.count = stops
+		dLat = STOP_SPACING_KM / 111.32
+		dLon = dLat / math.cos(math.radians(CENTER_LAT))
+		half = self.side / 2.0
+		self.lats = []
+		self.lons = []
+		for i in range(stops):
+			row, col = divmod(i, self.side)
+			self.lats.append(CENTER_LAT + (row - half + rng.uniform(-0.3, 0.3)) * dLat)
+			self.lons.append(CENTER_LON + (col - half + rng.uniform(-0.3, 0.3)) * dLon)
+
+	def cell(self, i):
+		return divmod(i, self.side)
+
+	def stopAt(self, row, col):
+		if row < 0 or col < 0 or col >= self.side:
+			return None
+		i = row * self.side + col
+		return i if i < self.count else None
+
+	# a wandering line of length stops through neighbouring cells
+	def walk(self, length, rng):
+		current = rng.randrange(self.count)
+		step = rng.choice(STEPS)
+		path = [current]
+		seen = {current}
+		while len(path) < length:
+			if rng.random() < 0.25:
+				step = rng.choice(STEPS)
+			row, col = self.cell(current)
+			options = [step] + [s for s in STEPS if s != step]
+			moved = False
+			for dRow, dCol in options:
+				nextStop = self.stopAt(row + dRow, col + dCol)
+				if nextStop is not None and nextStop not in seen:
+					step = (dRow, dCol)
+					current = nextStop
+					moved = True
+					break
+			if not moved:
+				break
+			path.append(current)
+			seen.add(current)
+		return path
+
+def writeTable(path, name, lines):
+	with open(os.path.join(path, name + ".txt"), 'w', newline = "") as f:
+		f.write(HEADER[name] + "\n")
+		for line in lines:
+			f.write(line + "\n")
+
+# writes a feed with stops stops and routes routes, each running
+# tripsPerRoute trips a day (alternating directions) over stopsPerRoute
+# stops, with weekday and weekend services spanning serviceDays days
+def generateFeed(path, stops = 1000, routes = 20, tripsPerRoute = 50,
+		serviceDays = 28, stopsPerRoute = 20, seed = 0, shapes = True):
+	rng = random.Random(seed)
+	os.makedirs(path, exist_ok = True)
+	grid = Grid(stops, rng)
+
+	def stopLines():
+		for i in range(stops):
+			parent = ""
+			if i % STATION_EVERY == 1:
+				parent = "S%d" % (i - 1)
+			yield "S%d,Stop %d,%.6f,%.6f,0,%s" % (i, i, grid.lats[i], grid.lons[i], parent)
+	writeTable(path, "stops", stopLines())
+
+	writeTable(path, "routes", ("R%d,%d,Line %d,3" % (r, r, r) for r in range(routes)))
+
+	finish = START_DATE + datetime.timedelta(days = max(serviceDays, 1) - 1)
+	writeTable(path, "calendar", [
+		"WEEKDAY,1,1,1,1,1,0,0,%s,%s" % (gtfsDate(START_DATE), gtfsDate(finish)),
+		"WEEKEND,0,0,0,0,0,1,1,%s,%s" % (gtfsDate(START_DATE), gtfsDate(finish)),
+	])
+	# the second monday is a holiday run on the weekend timetable
+	holiday = gtfsDate(START_DATE + datetime.timedelta(days = 7))
+	writeTable(path, "calendar_dates", [
+		"WEEKDAY,%s,2" % holiday,
+		"WEEKEND,%s,1" % holiday,
+	])
+
+	lines = [grid.walk(stopsPerRoute, rng) for r in range(routes)]
+	hops = [[rng.randint(60, 180) for _ in line] for line in lines]
+	headway = max((LAST_DEPARTURE - FIRST_DEPARTURE) // max(tripsPerRoute, 1), 1)
+
+	with open(os.path.join(path, "trips.txt"), 'w', newline = "") as trips, \
+			open(os.path.join(path, "stop_times.txt"), 'w', newline = "") as times:
+		trips.write(HEADER["trips"] + "\n")
+		times.write(HEADER["stop_times"] + "\n")
+		for r, line in enumerate(lines):
+			for t in range(tripsPerRoute):
+				direction = t % 2
+				# one trip in four is weekend service
+				service = "WEEKEND" if t % 4 == 3 else "WEEKDAY"
+				trip_id = "R%d_T%d" % (r, t)
+				trips.write("R%d,%s,%s,%d,SH%d_%d\n" % (r, service, trip_id, direction, r, direction))
+				order = line if direction == 0 else line[::-1]
+				runs = hops[r] if direction == 0 else hops[r][::-1]
+				headsign = "Stop %d" % order[-1]
+				seconds = FIRST_DEPARTURE + t * headway + rng.randrange(60)
+				rows = []
+				for seq, (stop, run) in enumerate(zip(order, runs)):
+					rows.append("%s,%s,%s,S%d,%d,%s" % (trip_id, gtfsTime(seconds),
+							gtfsTime(seconds + DWELL_SECONDS), stop, seq + 1, headsign))
+					seconds += DWELL_SECONDS + run
+				times.write("\n".join(rows) + "\n")
+
+	if shapes:
+		def shapeLines():
+			for r, line in enumerate(lines):
+				for direction in (0, 1):
+					order = line if direction == 0 else line[::-1]
+					for seq, stop in enumerate(order):
+						yield "SH%d_%d,%.6f,%.6f,%d" % (r, direction, grid.lats[stop],
+								grid.lons[stop], seq + 1)
+		writeTable(path, "shapes", shapeLines())
+	return path
+
+def main():
+	import sys
+	path = sys.argv[1] if len(sys.argv) > 1 else "synthetic"
+	sizes = [int(a) for a in sys.argv[2:6]]
+	generateFeed(path, *sizes)
+	print(path)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import math
+import random
+import pytest
+import graph_transit
+import time_space
+import trip_planner
+from conftest import DATE
+from conftest import WALK_KM
+from conftest import applyRandomUpdates
+from conftest import loadFeed
+from conftest import writeFeed
+
+def test_transfer_box_reaches_its_whole_radius(tmp_path):
+	# just under the limit due north, in degrees of the haversine sphere
+	north = 0.999 / (math.pi * time_space.EARTH_RADIUS_KM / 180)
+	path = writeFeed(str(tmp_path), [("A", 60.0, 10.0), ("B", 60.0 + north, 10.0)],
+			[("T", [("A", "08:00:00"), ("B", "08:10:00")])])
+	stops = loadFeed(path).stopTimes.stops
+	assert stops[0].distanceTo(stops[1]).km < graph_transit.TRANSFER_DISTANCE_LIMIT
+	footpaths = graph_transit.walkingFootpaths(stops)
+	assert [other for other, _ in footpaths[stops[0].index]] == [stops[1].index]
+
+def stopGraph(sched):
+	graph = graph_transit.StopGraph()
+	stops = sched.getStops(DATE)
+	for stop in stops:
+		graph.addVertex(stop)
+	graph.formEdges(stops)
+	return graph
+
+def test_free_route_edges_leave_no_distance_bound(sched):
+	frozen = stopGraph(sched).freeze()
+	assert frozen.weightPerKm() == 0
+	assert frozen.distanceHeuristic(0) is None
+
+def test_a_star_matches_dijkstra_on_transfers(sched):
+	# transfers alone all cost something per km, so A* has a bound
+	graph = graph_transit.Graph()
+	for source, edges in stopGraph(sched).vertices.items():
+		graph.addVertex(source)
+		for dest, penalty in edges.items():
+			if penalty.transfers == 1:
+				graph.addEdge(source, dest, penalty)
+	frozen = graph.freeze()
+	assert frozen.weightPerKm() > 0
+	rng = random.Random(6)
+	for _ in range(20):
+		source, target = rng.sample(frozen.vertices, 2)
+		expected, _ = frozen.shortestPath(source, target, useHeuristic = False)
+		found, path = frozen.shortestPath(source, target)
+		assert math.isclose(found, expected) or found == expected
+		if path:
+			assert path[0] is source and path[-1] is target
+
+@pytest.mark.parametrize("walk", [False, True])
+@pytest.mark.parametrize("overlay", [False, True])
+def test_scan_matches_time_dependent_graph(sched, walk, overlay):
+	rng = random.Random(1)
+	if overlay:
+		applyRandomUpdates(sched, rng)
+	footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops, WALK_KM) if walk else {}
+	stops = sched.stopTimes.stops
+	scan = trip_planner.ConnectionScan(sched, footpaths)
+	graph = graph_transit.TimeDependentGraph(sched, DATE, footpaths)
+	for _ in range(25):
+		origin = rng.choice(stops)
+		seconds = rng.randint(6 * 3600, 10 * 3600)
+		earliest, _, _ = scan.scan([origin.index], DATE, seconds)
+		arrival, _ = graph.search(origin.index, seconds)
+		assert [arrival.get(i, math.inf) for i in range(len(stops))] == earliest
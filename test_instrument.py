@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import threading
+import pytest
+import instrument
+
+@pytest.fixture
+def recorder():
+	yield instrument.enable(memory = True)
+	instrument.disable()
+
+def test_overlapping_threads_are_not_measured(recorder):
+	with instrument.span("alone"):
+		data = bytearray(1 << 20)
+	del data
+
+	opened = threading.Barrier(2)
+	def work():
+		with instrument.span("shared"):
+			opened.wait()
+			opened.wait()
+	threads = [threading.Thread(target = work) for _ in range(2)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	spans = instrument.report()["spans"]
+	assert spans["alone"]["peakBytes"] >= 1 << 20
+	assert spans["alone"]["overlapped"] == 0
+	assert spans["shared"]["calls"] == 2
+	assert spans["shared"]["overlapped"] == 2
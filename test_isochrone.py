@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import isochrone
+import time_space
+from conftest import DATE
+from conftest import loadFeed
+from conftest import writeFeed
+
+def test_places_walk_once_before_riding(tmp_path):
+	north = lambda km: 34.0 + km / time_space.KM_PER_DEGREE
+	stops = [("A", north(0.6), -118.0), ("B", north(1.2), -118.0),
+			("C", north(5.0), -118.0), ("D", north(5.6), -118.0)]
+	path = writeFeed(str(tmp_path), stops, [("T", [("A", "08:10:00"), ("C", "08:20:00")])])
+	sched = loadFeed(path)
+	finder = isochrone.IsochroneFinder(sched)
+	index = {stop_id: sched.stops[stop_id].index for stop_id, _, _ in stops}
+	walk = 432 # 0.6 km
+
+	place = time_space.Place(34.0, -118.0)
+	found = finder.compute([place, sched.stops["A"]], DATE, time_space.Time(8), time_space.Time(1))
+	fromPlace = found.seconds[0]
+	assert abs(fromPlace[index["A"]] - walk) <= 1
+	assert fromPlace[index["B"]] == isochrone.UNREACHABLE
+	assert fromPlace[index["C"]] == 1200
+	assert abs(fromPlace[index["D"]] - 1200 - walk) <= 1
+	assert abs(found.seconds[1][index["B"]] - walk) <= 1
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import random
+import pytest
+import graph_transit
+import query_cache
+import time_space
+import trip_planner
+from conftest import DATE
+from conftest import WALK_KM
+from conftest import applyRandomUpdates
+from conftest import loadFeed
+from conftest import writeFeed
+
+def test_cached_journeys_match_planner(sched):
+	rng = random.Random(3)
+	footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops)
+	planner = trip_planner.ConnectionScan(sched, footpaths)
+	cache = query_cache.QueryCache(sched)
+	stops = sched.stopTimes.stops
+	for _ in range(60):
+		origin, destination = rng.choice(stops), rng.choice(stops)
+		time = time_space.Time(seconds = rng.randint(6 * 3600, 9 * 3600))
+		expected = planner.query(origin, destination, DATE, time)
+		found = cache.journey(origin, destination, DATE, time)
+		assert (found is None) == (expected is None)
+		if expected is not None:
+			assert found.arrivalTime.seconds == expected.arrivalTime.seconds
+
+@pytest.mark.parametrize("overlay", [False, True])
+def test_cached_departures_match_schedule(sched, overlay):
+	rng = random.Random(2)
+	cache = query_cache.QueryCache(sched)
+	if overlay:
+		applyRandomUpdates(sched, rng)
+	for stop in rng.sample(sched.stopTimes.stops, 40):
+		time = time_space.Time(seconds = rng.randint(5 * 3600, 12 * 3600))
+		expected = [st.row for st in sched.getDepartures(stop, DATE, time, 5)]
+		assert [st.row for st in cache.departures(stop, DATE, time, 5)] == expected
+
+def test_default_planner_walks(tmp_path):
+	path = writeFeed(str(tmp_path), [("A", 34.0, -118.0), ("B", 34.05, -118.0), ("C", 34.054, -118.0)],
+			[("T", [("A", "08:00:00"), ("B", "08:10:00")])])
+	sched = loadFeed(path)
+	journey = query_cache.QueryCache(sched).journey(sched.stops["A"], sched.stops["C"], DATE,
+			time_space.Time(7))
+	assert journey is not None and journey.rides[-1].dest is sched.stops["C"]
+
+def test_cache_keeps_footpaths_after_refinish(sched):
+	footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops, WALK_KM)
+	cache = query_cache.QueryCache(sched, planner = trip_planner.ConnectionScan(sched, footpaths))
+	sched.finish()
+	cache.validate()
+	assert cache.planner.footpaths is footpaths
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+import asyncio
+import math
+import query_server
+import time_space
+from conftest import loadFeed
+from conftest import writeFeed
+
+WHEN = dict(date = "20161005", time = "07:00:00")
+
+# a line A -> B, with C a short walk past B
+def writeLine(path, prefix):
+	stops = [(prefix + "A", 34.0, -118.0), (prefix + "B", 34.05, -118.0), (prefix + "C", 34.054, -118.0)]
+	return writeFeed(path, stops, [(prefix + "T", [(prefix + "A", "08:00:00"), (prefix + "B", "08:10:00")])])
+
+# answers (or exceptions) to requests sent to a workers = 0 server per path
+def ask(paths, cacheDir, requests):
+	async def run():
+		servers = [query_server.QueryServer(path, workers = 0, cacheDir = cacheDir) for path in paths]
+		clients = []
+		try:
+			for server in servers:
+				port = await server.start(port = 0)
+				clients.append(await query_server.QueryClient.connect(port = port))
+			queries = [clients[i].query(**request) for i, request in requests]
+			return await asyncio.wait_for(asyncio.gather(*queries, return_exceptions = True), 30)
+		finally:
+			for client in clients:
+				await client.close()
+			for server in servers:
+				await server.close()
+	return asyncio.run(run())
+
+def test_nearest_is_by_true_distance(tmp_path):
+	lat = 60.0
+	northward = 1.05 / time_space.KM_PER_DEGREE
+	eastward = 1.0 / (time_space.KM_PER_DEGREE * math.cos(math.radians(lat)))
+	stops = [("N%d" % i, lat + northward, 10.0 + (i - 6) * 1e-4) for i in range(12)]
+	stops.append(("E", lat, 10.0 + eastward))
+	path = writeFeed(str(tmp_path), stops, [("T", [("N0", "08:00:00"), ("E", "08:10:00")])])
+	context = query_server.QueryContext(loadFeed(path))
+	found = context.nearest(dict(lat = lat, lon = 10.0, count = 1))
+	assert [f["stop_id"] for f in found] == ["E"]
+
+def test_server_answers_malformed_requests(feedPath, tmp_path):
+	stop = next(iter(loadFeed(feedPath).stops))
+	bad = [
+		dict(type = "departures", stop_id = stop, count = [1], **WHEN),
+		dict(type = "departures", stop_id = stop, count = -1, **WHEN),
+		dict(type = "departures", stop_id = [stop], **WHEN),
+		dict(type = "journey", origin = [stop], destination = stop, **WHEN),
+		dict(type = "nearest", lat = "x", lon = 0),
+		dict(type = "nearest", lat = 34.0, lon = -118.0, count = -2),
+	]
+	good = [
+		dict(type = "departures", stop_id = stop, count = 2, **WHEN),
+		dict(type = "nearest", lat = 34.0, lon = -118.0, count = 10 ** 9),
+	]
+	answers = ask([feedPath], str(tmp_path), [(0, request) for request in bad + good])
+	assert all(isinstance(a, query_server.QueryError) for a in answers[:len(bad)])
+	departures, nearest = answers[len(bad):]
+	assert isinstance(departures, list)
+	assert len(nearest) == min(query_server.MAX_COUNT, 200)
+
+def test_servers_keep_their_own_journeys(tmp_path):
+	paths = [writeLine(str(tmp_path / prefix), prefix) for prefix in ("P", "Q")]
+	requests = [(i, dict(type = "journey", origin = prefix + "A", destination = prefix + "C", **WHEN))
+			for i, prefix in enumerate(("P", "Q"))]
+	for journey in ask(paths, str(tmp_path / "cache"), requests):
+		assert isinstance(journey, dict)
+		assert [leg["type"] for leg in journey["legs"]] == ["ride", "walk"]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import pytest
+import graph_transit
+import realtime
+import time_space
+import trip_planner
+from conftest import DATE
+from conftest import loadFeed
+from conftest import writeFeed
+
+STOPS = [("A", 34.0, -118.0), ("Z", 34.01, -118.0), ("C", 34.02, -118.0)]
+
+def test_delayed_trip_with_simultaneous_hops(tmp_path):
+	path = writeFeed(str(tmp_path), STOPS,
+			[("T", [("C", "08:00:00"), ("A", "08:00:00"), ("Z", "08:00:00")])])
+	sched = loadFeed(path)
+	planner = trip_planner.ConnectionScan(sched)
+	origin, destination = sched.stops["C"], sched.stops["Z"]
+	assert planner.query(origin, destination, DATE, time_space.Time(7)) is not None
+	realtime.applyUpdate(sched, dict(trip_id = "T", delay = 60))
+	journey = planner.query(origin, destination, DATE, time_space.Time(7))
+	assert journey.arrivalTime.seconds == 8 * 3600 + 60
+
+def test_running_early_cannot_overtake_earlier_stops(tmp_path):
+	path = writeFeed(str(tmp_path), STOPS,
+			[("T", [("A", "08:00:00"), ("Z", "08:10:00"), ("C", ("08:20:00", "08:21:00"))])])
+	sched = loadFeed(path)
+	realtime.applyUpdate(sched, dict(trip_id = "T", delay = 600))
+	realtime.applyUpdate(sched, dict(trip_id = "T", delay = -900, stop_sequence = 2))
+	table = sched.stopTimes
+	rows = table.tripRows(0)
+	departures = (table.departure[rows] + sched.overlay.delays(rows)).tolist()
+	arrivals = (table.arrival[rows] + sched.overlay.delays(rows)).tolist()
+	assert departures[0] == 8 * 3600 + 600
+	assert arrivals[1:] == [departures[0], departures[1]]
+	assert sched.overlay.earliest <= -600 and sched.overlay.latest >= 600
+
+	origin, destination = sched.stops["A"], sched.stops["C"]
+	journey = trip_planner.ConnectionScan(sched).query(origin, destination, DATE, time_space.Time(7))
+	assert journey.arrivalTime.seconds == arrivals[2]
+	arrival, _ = graph_transit.TimeDependentGraph(sched, DATE).search(origin.index, 7 * 3600)
+	assert arrival[destination.index] == arrivals[2]
+
+def test_added_rows_need_a_reset_overlay(tmp_path):
+	path = writeFeed(str(tmp_path), STOPS, [("T", [("A", "08:00:00"), ("Z", "08:10:00")])])
+	sched = loadFeed(path)
+	realtime.applyUpdate(sched, dict(trip_id = "T", delay = 60))
+	table = sched.stopTimes
+	table.addRow(0, sched.stops["C"].index, 3, "", 8 * 3600 + 1200, 8 * 3600 + 1200)
+	with pytest.raises(RuntimeError):
+		sched.finish()
+	realtime.applyUpdate(sched, dict(reset = True))
+	sched.finish()
+	assert len(table) == 3
+	realtime.applyUpdate(sched, dict(trip_id = "T", delay = 30))
+	assert sched.overlay.delays(table.tripRows(0)).tolist() == [30, 30, 30]
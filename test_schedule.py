@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import random
+import shutil
+import pytest
+import schedule
+import time_space
+from conftest import DATE
+from conftest import applyRandomUpdates
+from conftest import loadFeed
+from conftest import writeFeed
+
+def test_date_queries_need_finish(feedPath):
+	sched = schedule.Schedule()
+	sched.loadSchedule(feedPath)
+	assert len(sched.getServices(DATE)) > 0
+	for query in (sched.getTrips, sched.getTripMask, sched.getStopTimes, sched.getStops):
+		with pytest.raises(RuntimeError, match = "finish"):
+			query(DATE)
+	sched.finish()
+	assert len(sched.getTrips(DATE)) > 0
+
+def test_feeds_need_distinct_namespaces(feedPath, tmp_path):
+	paths = []
+	for folder in ("rail", "bus"):
+		path = str(tmp_path / folder / "google_transit")
+		shutil.copytree(feedPath, path)
+		paths.append(path)
+	with pytest.raises(ValueError):
+		schedule.Schedule().loadFeeds(paths, workers = 1)
+
+# every departure from stop and its children, straight from the rows
+def bruteDepartures(sched, stop, seconds):
+	table = sched.stopTimes
+	overlay = sched.overlay
+	found = []
+	for s in [stop] + stop.children:
+		for row in table.stopRows(s.index).tolist():
+			trip = int(table.tripIndex[row])
+			if row == int(table.tripOffsets[trip + 1]) - 1:
+				continue
+			if not table.trips[trip].service.includes(DATE):
+				continue
+			if overlay.isCancelled(trip) or overlay.isSkipped(row):
+				continue
+			departure = int(table.departure[row]) + overlay.delay(row)
+			if departure >= seconds:
+				found.append((departure, row))
+	return sorted(found)
+
+@pytest.mark.parametrize("overlay", [False, True])
+def test_departures_match_brute_force(sched, overlay):
+	rng = random.Random(2)
+	if overlay:
+		applyRandomUpdates(sched, rng)
+	for stop in rng.sample(sched.stopTimes.stops, 40):
+		seconds = rng.randint(5 * 3600, 12 * 3600)
+		time = time_space.Time(seconds = seconds)
+		found = [(st.departureSeconds, st.row) for st in sched.getDepartures(stop, DATE, time)]
+		assert found == bruteDepartures(sched, stop, seconds)
+
+def test_equal_departures_come_in_row_order(tmp_path):
+	# B gets to S first but leaves with A, whose rows come first
+	path = writeFeed(str(tmp_path), [("S", 34.0, -118.0), ("T", 34.01, -118.0)], [
+		("A", [("S", "08:00:00"), ("T", "08:10:00")]),
+		("B", [("S", ("07:59:00", "08:00:00")), ("T", "08:11:00")]),
+	])
+	sched = loadFeed(path)
+	found = [st.row for st in sched.getDepartures(sched.stops["S"], DATE, time_space.Time(7))]
+	assert found == sorted(found)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+import os
+import zipfile
+import snapshot
+from conftest import loadFeed
+
+def test_snapshot_keeps_existing_target(feedPath, tmp_path):
+	sched = loadFeed(feedPath)
+	target = snapshot.saveSnapshot(sched, feedPath, str(tmp_path))
+	before = os.stat(os.path.join(target, snapshot.OBJECTS_FILE)).st_ino
+	assert snapshot.saveSnapshot(sched, feedPath, str(tmp_path)) == target
+	assert os.stat(os.path.join(target, snapshot.OBJECTS_FILE)).st_ino == before
+	for name in os.listdir(target):
+		if name.endswith(".npy"):
+			os.remove(os.path.join(target, name))
+			break
+	assert snapshot.loadSnapshot(feedPath, str(tmp_path)) is None
+
+def test_stale_snapshots_wait_for_cleanup(feedPath, tmp_path):
+	cacheDir = str(tmp_path)
+	old = os.path.join(cacheDir, "0" * 40)
+	os.makedirs(old)
+	target = snapshot.saveSnapshot(loadFeed(feedPath), feedPath, cacheDir)
+	assert os.path.isdir(old)
+	assert snapshot.removeStaleSnapshots(feedPath, cacheDir) == []
+	day = 24 * 60 * 60
+	os.utime(old, (os.path.getatime(old) - 2 * day, os.path.getmtime(old) - 2 * day))
+	assert snapshot.removeStaleSnapshots(feedPath, cacheDir, grace = day) == [old]
+	assert sorted(os.listdir(cacheDir)) == [os.path.basename(target)]
+
+def test_snapshot_of_zip_feed(feedPath, tmp_path):
+	archive = str(tmp_path / "feed.zip")
+	with zipfile.ZipFile(archive, 'w') as z:
+		for name in os.listdir(feedPath):
+			if name.endswith(".txt"):
+				z.write(os.path.join(feedPath, name), name)
+	first = snapshot.loadSchedule(archive)
+	assert snapshot.loadSnapshot(archive) is not None
+	assert len(snapshot.loadSchedule(archive).trips) == len(first.trips)
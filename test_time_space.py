@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import json
+import time
+import pytest
+import time_space
+
+# answers every description with the same spot, noting when it was asked
+class RecordingGeocoder:
+	concurrency = 3
+
+	def __init__(self):
+		self.times = []
+
+	def locate(self, description):
+		self.times.append(time.monotonic())
+		return time_space.Location(description, 34.0, -118.0, dict(place_id = len(self.times)))
+
+@pytest.fixture
+def finder():
+	geocoder = time_space.Finder.geocoder
+	yield time_space.Finder
+	time_space.Finder.configure(geocoder)
+
+def test_finder_results(finder, tmp_path):
+	path = str(tmp_path / "places.json")
+	with open(path, 'w') as f:
+		json.dump({"Union Station": [34.056, -118.236]}, f)
+	finder.configure(time_space.FileGeocoder(path))
+	found = finder.find("union station")
+	assert (found.latitude, found.longitude) == (34.056, -118.236)
+	assert found.address == "union station"
+	assert finder.findLatLon("Union Station").latitude == 34.056
+	assert finder.find("nowhere") is None
+
+def test_finder_caches_full_results(finder, tmp_path):
+	geocoder = RecordingGeocoder()
+	cachePath = str(tmp_path / "geocodes")
+	finder.configure(geocoder, cachePath = cachePath)
+	first = finder.find("Union Station")
+	assert finder.find("union  station").raw == first.raw
+	assert finder.findLatLon("UNION STATION").latitude == 34.0
+	finder.findMany(["union station", "el monte"])
+	assert len(geocoder.times) == 2
+
+	finder.configure(RecordingGeocoder(), cachePath = cachePath)
+	assert finder.find("El Monte").raw == dict(place_id = 2)
+	assert len(finder.geocoder.times) == 0
+
+def test_nominatim_rate_limit(finder):
+	nominatim = time_space.NominatimGeocoder(interval = 0.05)
+	nominatim.geocoder = RecordingGeocoder()
+	nominatim.geocoder.geocode = nominatim.geocoder.locate
+	finder.configure(nominatim)
+	finder.findMany(["a", "b", "c"], workers = 3)
+	times = sorted(nominatim.geocoder.times)
+	assert all(later - earlier >= 0.045 for earlier, later in zip(times, times[1:]))
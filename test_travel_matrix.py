@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import math
+import numpy as np
+import pytest
+import graph_transit
+import snapshot
+import time_space
+import travel_matrix
+import trip_planner
+from conftest import DATE
+from conftest import WALK_KM
+
+def test_matrix_matches_planner(feedPath, tmp_path):
+	output = str(tmp_path / "matrix.npy")
+	cacheDir = str(tmp_path / "cache")
+	travel_matrix.travelMatrix(feedPath, output, DATE, time_space.Time(8), workers = 2,
+			cacheDir = cacheDir, walkKm = WALK_KM, chunk = 16)
+	matrix = np.load(output)
+	sched = snapshot.loadSchedule(feedPath, cacheDir)
+	footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops, WALK_KM)
+	planner = trip_planner.ConnectionScan(sched, footpaths)
+	for origin in (0, 17, 99):
+		earliest, _, _ = planner.scan([origin], DATE, 8 * 3600)
+		expected = [travel_matrix.UNREACHABLE if e == math.inf else e - 8 * 3600 for e in earliest]
+		assert matrix[origin].tolist() == expected
+
+def test_matrix_needs_a_snapshot(feedPath, tmp_path):
+	blocked = tmp_path / "file"
+	blocked.write_text("")
+	with pytest.raises(RuntimeError, match = "snapshot"):
+		travel_matrix.travelMatrix(feedPath, str(tmp_path / "matrix.npy"), DATE,
+				time_space.Time(8), workers = 1, cacheDir = str(blocked / "cache"))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import math
+import random
+import time_space
+import trip_planner
+from conftest import DATE
+
+# earliest arrivals by relaxing every trip running on DATE until nothing
+# changes: a trip is boarded at the first stop reached before it leaves
+def bruteEarliest(sched, origin, seconds):
+	table = sched.stopTimes
+	earliest = [math.inf] * len(table.stops)
+	earliest[origin] = seconds
+	changed = True
+	while changed:
+		changed = False
+		for trip in sched.getTripMask(DATE).nonzero()[0].tolist():
+			boarded = False
+			for row in table.tripRows(trip).tolist():
+				stop = int(table.stopIndex[row])
+				if boarded and table.arrival[row] < earliest[stop]:
+					earliest[stop] = int(table.arrival[row])
+					changed = True
+				if earliest[stop] <= table.departure[row]:
+					boarded = True
+	return earliest
+
+def test_scan_matches_brute_force(sched):
+	rng = random.Random(4)
+	planner = trip_planner.ConnectionScan(sched)
+	for _ in range(20):
+		origin = rng.choice(sched.stopTimes.stops).index
+		seconds = rng.randint(6 * 3600, 10 * 3600)
+		earliest, _, _ = planner.scan([origin], DATE, seconds)
+		assert earliest == bruteEarliest(sched, origin, seconds)
+
+def test_journeys_are_connected(sched):
+	rng = random.Random(5)
+	planner = trip_planner.ConnectionScan(sched)
+	stops = sched.stopTimes.stops
+	for _ in range(30):
+		origin = rng.choice(stops)
+		departure = time_space.Time(seconds = rng.randint(6 * 3600, 9 * 3600))
+		earliest, _, _ = planner.scan([origin.index], DATE, departure.seconds)
+		reached = [stop for stop in stops if stop is not origin and earliest[stop.index] < math.inf]
+		if not reached:
+			continue
+		destination = rng.choice(reached)
+		journey = planner.query(origin, destination, DATE, departure)
+		assert journey.arrivalTime.seconds == earliest[destination.index]
+		rides = journey.rides
+		assert rides[0].start.stop is origin
+		assert rides[-1].stop.stop is destination
+		assert rides[0].departureTime.seconds >= departure.seconds
+		for ride in rides:
+			assert ride.departureTime.seconds <= ride.arrivalTime.seconds
+		for earlier, later in zip(rides, rides[1:]):
+			assert earlier.stop.stop is later.start.stop
+			assert earlier.arrivalTime.seconds <= later.departureTime.seconds
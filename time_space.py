@@ -1,28 +1,251 @@
 #!/usr/bin/env python
 
+import functools
+import json
 import math
-from geopy.geocoders import Nominatim
-from geopy.distance import vincenty
+import shelve
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 WALKING_KM_PER_HOUR = 5
+GEOCODE_CACHE_SIZE = 4096
+GEOCODE_WORKERS = 4
+NOMINATIM_INTERVAL = 1.0 # seconds between requests, per its usage policy
+GEOCODER_USER_AGENT = "transit"
+TIME_CACHE_SIZE = 1 << 17
+EARTH_RADIUS_KM = 6371.0088 # mean radius
+# one degree of a great circle on that sphere, which is what distanceKm
+# measures one degree of latitude as
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Great-circle (haversine) distances on a sphere of EARTH_RADIUS_KM. Against
+# the ellipsoidal distance geopy used to give, the error stays under 0.5% of
+# the distance (a few metres for transfer-sized hops), which is well inside
+# what walking estimates can resolve.
+def distanceKm(lat1, lon1, lat2, lon2):
+	phi1 = math.radians(lat1)
+	phi2 = math.radians(lat2)
+	dPhi = phi2 - phi1
+	dLambda = math.radians(lon2 - lon1)
+	a = math.sin(dPhi / 2) ** 2
+	a += math.cos(phi1) * math.cos(phi2) * math.sin(dLambda / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+# the same formula over arrays; inputs broadcast against each other
+def distancesKm(lats1, lons1, lats2, lons2):
+	phi1 = np.radians(lats1)
+	phi2 = np.radians(lats2)
+	dPhi = phi2 - phi1
+	dLambda = np.radians(np.subtract(lons2, lons1))
+	a = np.sin(dPhi / 2) ** 2
+	a = a + np.cos(phi1) * np.cos(phi2) * np.sin(dLambda / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def distancesFrom(lat, lon, lats, lons):
+	return distancesKm(lat, lon, np.asarray(lats, dtype = float), np.asarray(lons, dtype = float))
+
+# rows are the first set of points, columns the second
+def distanceMatrix(lats1, lons1, lats2, lons2):
+	lats1 = np.asarray(lats1, dtype = float)[:, np.newaxis]
+	lons1 = np.asarray(lons1, dtype = float)[:, np.newaxis]
+	lats2 = np.asarray(lats2, dtype = float)[np.newaxis, :]
+	lons2 = np.asarray(lons2, dtype = float)[np.newaxis, :]
+	return distancesKm(lats1, lons1, lats2, lons2)
+
+# Geocoders answer geocode() with (lat, lon) or None, and locate() with
+# their full result: something with address, latitude, longitude and raw.
+# concurrency is how many requests findMany should have in flight.
+
+# public Nominatim takes one request a second, however many threads ask
+class NominatimGeocoder:
+	concurrency = 1
+
+	def __init__(self, user_agent = GEOCODER_USER_AGENT, interval = NOMINATIM_INTERVAL):
+		self.user_agent = user_agent
+		self.interval = interval
+		self.geocoder = None
+		self.lock = threading.Lock()
+		self.last = None
+
+	def locate(self, description):
+		with self.lock:
+			if self.geocoder is None:
+				from geopy.geocoders import Nominatim
+				self.geocoder = Nominatim(user_agent = self.user_agent)
+			if self.last is not None:
+				wait = self.last + self.interval - time.monotonic()
+				if wait > 0:
+					time.sleep(wait)
+			try:
+				return self.geocoder.geocode(description)
+			finally:
+				self.last = time.monotonic()
+
+	def geocode(self, description):
+		loc = self.locate(description)
+		if loc is None:
+			return None
+		return (loc.latitude, loc.longitude)
+
+# the parts of a geocoder's answer Finder keeps; plain, so it pickles into
+# the cache file whatever library produced it
+class Location:
+	def __init__(self, address, latitude, longitude, raw = None):
+		self.address = address
+		self.latitude = latitude
+		self.longitude = longitude
+		self.raw = raw if raw is not None else dict(lat = latitude, lon = longitude, display_name = address)
 
-class Finder:
-	@staticmethod
-	def find(description):
-		return Nominatim().geocode(description)
+	@classmethod
+	def copy(cls, loc):
+		if loc is None:
+			return None
+		return cls(loc.address, loc.latitude, loc.longitude, loc.raw)
+
+# answers from a JSON object of description -> [lat, lon], for tests and
+# machines without network access
+class FileGeocoder:
+	concurrency = GEOCODE_WORKERS
+
+	def __init__(self, path):
+		with open(path, 'r') as f:
+			entries = json.load(f)
+		self.entries = {GeocodeCache.key(d): tuple(v) for d, v in entries.items()}
+
+	def geocode(self, description):
+		return self.entries.get(GeocodeCache.key(description))
+
+	def locate(self, description):
+		latLon = self.geocode(description)
+		if latLon is None:
+			return None
+		return Location(description, latLon[0], latLon[1])
+
+# most recently used answers in memory, everything ever answered on disk;
+# an answer of None (nothing found) is cached too
+class GeocodeCache:
+	MISSING = object()
+
+	def __init__(self, path = None, capacity = GEOCODE_CACHE_SIZE):
+		self.capacity = capacity
+		self.recent = OrderedDict()
+		self.store = shelve.open(path) if path is not None else None
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
 
 	@staticmethod
-	def findLatLon(description):
-		loc = Nominatim().geocode(description)
+	def key(description):
+		return " ".join(description.split()).lower()
+
+	def get(self, description):
+		key = GeocodeCache.key(description)
+		with self.lock:
+			if key in self.recent:
+				self.recent.move_to_end(key)
+				self.hits += 1
+				return self.recent[key]
+			if self.store is not None and key in self.store:
+				value = self.store[key]
+				self.remember(key, value)
+				self.hits += 1
+				return value
+			self.misses += 1
+			return GeocodeCache.MISSING
+
+	def put(self, description, value):
+		key = GeocodeCache.key(description)
+		with self.lock:
+			self.remember(key, value)
+			if self.store is not None:
+				self.store[key] = value
+				self.store.sync()
+
+	def remember(self, key, value):
+		self.recent[key] = value
+		self.recent.move_to_end(key)
+		while len(self.recent) > self.capacity:
+			self.recent.popitem(last = False)
+
+	def close(self):
+		if self.store is not None:
+			self.store.close()
+			self.store = None
+
+# Geocoder answers as Locations, cached by description. The cache is in
+# memory only until configure names a cachePath for its shelve file.
+class Finder:
+	geocoder = NominatimGeocoder()
+	cache = GeocodeCache()
+
+	@classmethod
+	def configure(cls, geocoder = None, cachePath = None, capacity = GEOCODE_CACHE_SIZE):
+		if geocoder is not None:
+			cls.geocoder = geocoder
+		cls.cache.close()
+		cls.cache = GeocodeCache(cachePath, capacity)
+
+	@classmethod
+	def locate(cls, description):
+		return Location.copy(cls.geocoder.locate(description))
+
+	# the geocoder's full answer, with address and raw
+	@classmethod
+	def find(cls, description):
+		loc = cls.cache.get(description)
+		if loc is GeocodeCache.MISSING:
+			loc = cls.locate(description)
+			cls.cache.put(description, loc)
+		return loc
+
+	@classmethod
+	def findLatLon(cls, description):
+		loc = cls.find(description)
+		if loc is None:
+			return None
 		return Place(loc.latitude, loc.longitude)
 
+	# one Place (or None) per description, in order; each distinct miss is
+	# geocoded once, at most `workers` (by default as many as the geocoder
+	# allows) at a time
+	@classmethod
+	def findMany(cls, descriptions, workers = None):
+		if workers is None:
+			workers = getattr(cls.geocoder, "concurrency", 1)
+		descriptions = list(descriptions)
+		answers = {}
+		misses = []
+		for description in descriptions:
+			key = GeocodeCache.key(description)
+			if key in answers:
+				continue
+			loc = cls.cache.get(description)
+			answers[key] = loc
+			if loc is GeocodeCache.MISSING:
+				misses.append(description)
+
+		if len(misses) > 0:
+			with ThreadPoolExecutor(max_workers = workers) as pool:
+				for description, loc in zip(misses, pool.map(cls.locate, misses)):
+					cls.cache.put(description, loc)
+					answers[GeocodeCache.key(description)] = loc
+
+		toRet = []
+		for description in descriptions:
+			loc = answers[GeocodeCache.key(description)]
+			toRet.append(None if loc is None else Place(loc.latitude, loc.longitude))
+		return toRet
+
 class Distance:
 	def __init__(self, km):
 		self.kilometers = km
 
 	@property
 	def m(self):
-		return self.kilometers / 1000
+		return self.kilometers * 1000
 
 	@property
 	def km(self):
@@ -32,18 +255,26 @@ class Distance:
 	def mi(self):
 		return self.kilometers * 100000 / 30.48 / 2580
 
+# "HH:MM:SS" -> seconds; feeds repeat the same few thousand strings
+# millions of times, so answers are memoized
+@functools.lru_cache(maxsize = TIME_CACHE_SIZE)
+def parseSeconds(strang):
+	words = strang.split(":")
+	hours = int(words[0])
+	minutes = int(words[1])
+	seconds = int(words[2])
+	return seconds + minutes * 60 + hours * 60 * 60
+
 class Time:
+	__slots__ = ("secs",)
+
 	def __init__(self, hours = 0, minutes = 0, seconds = 0):
 		secs = seconds + minutes * 60 + hours * 60 * 60
 		self.secs = secs
 
 	@classmethod
 	def fromString(cls, strang):
-		words = strang.split(":")
-		hours = int(words[0])
-		minutes = int(words[1])
-		seconds = int(words[2])
-		return cls(hours, minutes, seconds)
+		return cls(seconds = parseSeconds(strang))
 
 	@property
 	def seconds(self):
@@ -64,10 +295,35 @@ class Time:
 		return Time(seconds = (self.secs + other.secs))
 
 	def before(self, other):
-		return self.diff(other).seconds < 0
+		return self.secs < other.secs
 
 	def after(self, other):
-		return self.diff(other).seconds > 0
+		return self.secs > other.secs
+
+	def __eq__(self, other):
+		if not isinstance(other, Time):
+			return NotImplemented
+		return self.secs == other.secs
+
+	def __ne__(self, other):
+		if not isinstance(other, Time):
+			return NotImplemented
+		return self.secs != other.secs
+
+	def __lt__(self, other):
+		return self.secs < other.secs
+
+	def __le__(self, other):
+		return self.secs <= other.secs
+
+	def __gt__(self, other):
+		return self.secs > other.secs
+
+	def __ge__(self, other):
+		return self.secs >= other.secs
+
+	def __hash__(self):
+		return hash(self.secs)
 
 	def __str__(self):
 		tot = self.secs
@@ -99,9 +355,13 @@ class Place:
 		return self.lon
 
 	def distanceTo(self, other):
-		loc1 = (self.lat, self.lon)
-		loc2 = (other.lat, other.lon)
-		return Distance(vincenty(loc1, loc2).km)
+		return Distance(distanceKm(self.lat, self.lon, other.lat, other.lon))
+
+	# kilometres to each of places, as an array
+	def distancesTo(self, places):
+		lats = [p.lat for p in places]
+		lons = [p.lon for p in places]
+		return distancesFrom(self.lat, self.lon, lats, lons)
 
 	def __str__(self):
 		return "(%.3f, %.3f)" % (self.lat, self.lon)
@@ -112,13 +372,19 @@ class TimePlace:
 		self.time = Time(hours, minutes, seconds)
 
 	def travelTo(self, other):
-		dist = Distance(self.loc.distanceTo(other.loc))
+		dist = self.loc.distanceTo(other.loc)
 		timeDiff = other.time.diff(self.time)
 		return Travel(dist, timeDiff)
 
 	def canWalkTo(self, other):
 		return self.travelTo(other).isWalkable()
 
+	# one distance kernel call for all of others, as a boolean array
+	def canWalkToAll(self, others):
+		kms = self.loc.distancesTo([other.loc for other in others])
+		seconds = np.array([other.time.seconds - self.time.seconds for other in others])
+		return Travel.walkable(kms, seconds)
+
 	def __str__(self):
 		return self.loc.__str__() + " @ " + self.time.__str__()
 
@@ -127,6 +393,12 @@ class Travel:
 		self.distance = dist
 		self.duration = dur
 
+	@staticmethod
+	def walkable(kms, seconds):
+		hours = np.asarray(seconds, dtype = float) / 3600
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			return (hours > 0) & (np.asarray(kms) / hours < WALKING_KM_PER_HOUR)
+
 	def isWalkable(self):
 		return self.distance.km / self.duration.hours < WALKING_KM_PER_HOUR
 
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 
 import schedule
+import snapshot
 import quad_tree
 
 def main():
-	sched = schedule.Schedule()
-	sched.loadSchedule(schedule.RAIL_PATH)
-	tree = quad_tree.QuadTree()
-	for stopTime in sched.stopTimes.values():
-		tree.insert(quad_tree.Item(stopTime, stopTime.lon, stopTime.lat))
+	sched = snapshot.loadSchedule(schedule.RAIL_PATH)
+	items = []
+	for stopTime in sched.stopTimes:
+		stop = stopTime.stop
+		items.append(quad_tree.Item(stopTime, stop.longitude, stop.latitude))
+	tree = quad_tree.QuadTree.fromItems(items)
 	print(tree)
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+import json
+import math
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import numpy as np
+import graph_transit
+import instrument
+import isochrone
+import snapshot
+import trip_planner
+
+# Many-to-many travel times. Workers never receive the schedule: each one
+# opens the feed's snapshot, memory-mapped, so the stop time columns are
+# shared through the page cache. The day's connections and the footpaths
+# are built once, by the parent, and handed to the workers as they start;
+# tasks carry only a range of origins. Rows are written into a .npy file
+# as chunks finish, in whatever order.
+
+CHUNK_ORIGINS = 32
+UNREACHABLE = isochrone.UNREACHABLE
+
+# one per worker process, set up by startWorker
+worker = None
+
+class MatrixWorker:
+	def __init__(self, path, cacheDir, footpaths, day, origins, destinations, date, departure, until):
+		self.schedule = snapshot.loadSnapshot(path, cacheDir)
+		if self.schedule is None:
+			raise RuntimeError("the snapshot of %s is gone" % path)
+		self.planner = trip_planner.ConnectionScan(self.schedule, footpaths)
+		self.planner.addDay(date, day)
+		self.origins = origins
+		self.destinations = destinations
+		self.date = date
+		self.departure = departure
+		self.until = until
+
+	# travel seconds from origins[start:end] to every destination
+	def rows(self, start, end):
+		rows = np.full((end - start, len(self.destinations)), UNREACHABLE, dtype = np.int32)
+		limit = math.inf if self.until is None else self.until
+		for i, origin in enumerate(self.origins[start:end].tolist()):
+			earliest, _, _ = self.planner.scan([origin], self.date, self.departure,
+					until = self.until)
+			earliest = np.array(earliest, dtype = float)[self.destinations]
+			reached = np.isfinite(earliest) & (earliest <= limit)
+			rows[i, reached] = earliest[reached] - self.departure
+		return rows
+
+def startWorker(*args):
+	global worker
+	worker = MatrixWorker(*args)
+
+def computeRows(start, end):
+	return start, worker.rows(start, end)
+
+# stop indices for stop_ids, or every stop for None
+def stopIndices(sched, stopIds):
+	if stopIds is None:
+		return np.arange(len(sched.stopTimes.stops), dtype = np.int32)
+	return np.array([sched.stops[s].index for s in stopIds], dtype = np.int32)
+
+# travel seconds from each origin to each destination (stop_ids; None for
+# all stops) leaving at departure (a Time) on date, UNREACHABLE when there
+# is no way or none arriving by until. output is the .npy matrix; the stop
+# ids of its rows and columns go to a .json file beside it.
+def travelMatrix(path, output, date, departure, origins = None, destinations = None,
+		until = None, workers = None, cacheDir = None,
+		walkKm = graph_transit.TRANSFER_DISTANCE_LIMIT, chunk = CHUNK_ORIGINS):
+	# also writes the snapshot the workers map
+	sched = snapshot.loadSchedule(path, cacheDir)
+	if not snapshot.hasSnapshot(path, cacheDir):
+		# or every worker would parse the whole feed again
+		raise RuntimeError("could not write a snapshot of %s; pass a writable cacheDir" % path)
+	footpaths = {}
+	if walkKm > 0:
+		footpaths = graph_transit.walkingFootpaths(sched.stopTimes.stops, walkKm)
+	day = trip_planner.ConnectionScan(sched).getDay(date)
+	originIndices = stopIndices(sched, origins)
+	destinationIndices = stopIndices(sched, destinations)
+	stops = sched.stopTimes.stops
+	limit = None if until is None else until.seconds
+
+	header = dict(
+		date = date.isoformat(),
+		departure = departure.seconds,
+		until = limit,
+		unreachable = int(UNREACHABLE),
+		origins = [stops[i].stop_id for i in originIndices.tolist()],
+		destinations = [stops[i].stop_id for i in destinationIndices.tolist()],
+	)
+	with open(os.path.splitext(output)[0] + ".json", 'w') as f:
+		json.dump(header, f)
+
+	matrix = np.lib.format.open_memmap(output, mode = 'w+', dtype = np.int32,
+			shape = (len(originIndices), len(destinationIndices)))
+	if workers is None:
+		workers = os.cpu_count() or 1
+	initargs = (path, cacheDir, footpaths, day, originIndices, destinationIndices, date,
+			departure.seconds, limit)
+
+	def store(done):
+		for future in done:
+			start, rows = future.result()
+			matrix[start:start + len(rows)] = rows
+			matrix.flush()
+			span.addRows(len(rows))
+
+	with instrument.span("query.travelMatrix") as span, ProcessPoolExecutor(max_workers = workers,
+			initializer = startWorker, initargs = initargs) as pool:
+		# a few chunks per worker in flight, so finished rows reach the disk
+		# while the rest are computed and results never pile up in memory
+		pending = set()
+		for start in range(0, len(originIndices), chunk):
+			end = min(start + chunk, len(originIndices))
+			pending.add(pool.submit(computeRows, start, end))
+			if len(pending) >= 2 * workers:
+				done, pending = wait(pending, return_when = FIRST_COMPLETED)
+				store(done)
+		store(wait(pending).done)
+	del matrix
+	return output
+
+def main():
+	import sys
+	import datetime
+	import schedule
+	import time_space
+	path = sys.argv[1] if len(sys.argv) > 1 else schedule.RAIL_PATH
+	output = sys.argv[2] if len(sys.argv) > 2 else "travel_matrix.npy"
+	print(travelMatrix(path, output, datetime.date(2016, 10, 5), time_space.Time(8)))
+
+if __name__ == "__main__":
+	main()
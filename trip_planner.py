@@ -1,13 +1,368 @@
+#!/usr/bin/env python
 
+import heapq
+import math
+from bisect import bisect_left
+from collections import OrderedDict
+import numpy as np
+import instrument
+import time_space
+
+DAY_CACHE_SIZE = 7
 
 class Ride:
 	def __init__(self, trip, start, stop):
+		self.__trip = trip
 		self.__start = start
 		self.__stop = stop
 
+	@property
+	def trip(self):
+		return self.__trip
+
+	@property
+	def start(self):
+		return self.__start
+
+	@property
+	def stop(self):
+		return self.__stop
+
+	@property
+	def departureTime(self):
+		return self.__start.departureTime
+
+	@property
+	def arrivalTime(self):
+		return self.__stop.arrivalTime
+
+	def __str__(self):
+		values = (self.__trip.routeName, self.departureTime, self.__start.stop.name,
+				self.arrivalTime, self.__stop.stop.name)
+		return "%s: %s %s -> %s %s" % values
+
+class Walk:
+	def __init__(self, source, dest, departure, arrival):
+		self.__source = source
+		self.__dest = dest
+		self.__departure = departure
+		self.__arrival = arrival
+
+	@property
+	def source(self):
+		return self.__source
+
+	@property
+	def dest(self):
+		return self.__dest
+
+	@property
+	def departureTime(self):
+		return self.__departure
+
+	@property
+	def arrivalTime(self):
+		return self.__arrival
+
+	def __str__(self):
+		values = (self.__departure, self.__source.name, self.__arrival, self.__dest.name)
+		return "walk: %s %s -> %s %s" % values
+
 class Journey:
 	def __init__(self):
 		self.__rides = []
 
 	def addRide(self, ride):
 		self.__rides.append(ride)
+
+	@property
+	def rides(self):
+		return self.__rides[:]
+
+	@property
+	def departureTime(self):
+		return self.__rides[0].departureTime
+
+	@property
+	def arrivalTime(self):
+		return self.__rides[-1].arrivalTime
+
+	@property
+	def duration(self):
+		return self.arrivalTime.diff(self.departureTime)
+
+	@property
+	def transfers(self):
+		return max(sum(1 for r in self.__rides if isinstance(r, Ride)) - 1, 0)
+
+	def __str__(self):
+		return "\n".join([ride.__str__() for ride in self.__rides])
+
+# every hop between consecutive stop times of a trip, as parallel arrays
+# sorted by departure time
+class ConnectionTable:
+	def __init__(self, table):
+		self.table = table
+		rows = np.flatnonzero(table.tripIndex[:-1] == table.tripIndex[1:])
+		order = np.lexsort((table.arrival[rows + 1], table.departure[rows]))
+		rows = rows[order]
+		self.rows = rows
+		self.trip = table.tripIndex[rows]
+		self.departureStop = table.stopIndex[rows]
+		self.arrivalStop = table.stopIndex[rows + 1]
+		self.departure = table.departure[rows]
+		self.arrival = table.arrival[rows + 1]
+
+	def __len__(self):
+		return len(self.rows)
+
+	# python lists of the connections running on one day: the scan loop
+	# reads them element by element, which is much faster on lists
+	def forTrips(self, tripMask):
+		active = np.flatnonzero(tripMask[self.trip])
+		return ConnectionDay(
+			self.rows[active].tolist(),
+			self.trip[active].tolist(),
+			self.departureStop[active].tolist(),
+			self.arrivalStop[active].tolist(),
+			self.departure[active].tolist(),
+			self.arrival[active].tolist(),
+		)
+
+class ConnectionDay:
+	def __init__(self, rows, trip, departureStop, arrivalStop, departure, arrival):
+		self.rows = rows
+		self.trip = trip
+		self.departureStop = departureStop
+		self.arrivalStop = arrivalStop
+		self.departure = departure
+		self.arrival = arrival
+
+	def __len__(self):
+		return len(self.rows)
+
+	def firstAfter(self, seconds):
+		return bisect_left(self.departure, seconds)
+
+# earliest-arrival queries with the connection scan algorithm
+class ConnectionScan:
+	def __init__(self, sched, footpaths = None):
+		self.schedule = sched
+		# built on the first day not handed in with addDay
+		self.connections = None
+		# stop index -> [(stop index, walking seconds)]
+		self.footpaths = footpaths if footpaths is not None else {}
+		self.days = OrderedDict()
+		self.patches = {}
+
+	def getDay(self, date):
+		key = date.toordinal()
+		if key in self.days:
+			self.days.move_to_end(key)
+			instrument.count("query.connectionDay.hits")
+			return self.days[key]
+		with instrument.span("query.connectionDay") as span:
+			if self.connections is None:
+				self.connections = ConnectionTable(self.schedule.stopTimes)
+			day = self.connections.forTrips(self.schedule.getTripMask(date))
+			span.addRows(len(day))
+		self.addDay(date, day)
+		return day
+
+	# a ConnectionDay built elsewhere, for a planner over the same rows
+	def addDay(self, date, day):
+		self.days[date.toordinal()] = day
+		if len(self.days) > DAY_CACHE_SIZE:
+			self.days.popitem(last = False)
+
+	# the connections of the trips the overlay touches that run on date,
+	# with real-time times, sorted the way the day's connections are:
+	# (departure, arrival, row, departure stop, arrival stop, trip,
+	# can board, can alight). Ties keep row order, so a trip's hops at the
+	# same time are still scanned in the order they are ridden. Rebuilt
+	# only when the overlay changes.
+	def getPatch(self, date):
+		overlay = self.schedule.overlay
+		key = date.toordinal()
+		cached = self.patches.get(key)
+		if cached is not None and cached[0] == overlay.version:
+			return cached[1], cached[2]
+		if cached is None and len(self.patches) >= DAY_CACHE_SIZE:
+			self.patches.clear()
+
+		table = self.schedule.stopTimes
+		running = self.schedule.calendar.runningOn(date)
+		affected = frozenset(overlay.trips)
+		patch = []
+		for trip in affected:
+			if trip in overlay.cancelled or not running(trip):
+				continue
+			rows = table.tripRows(trip)
+			if len(rows) < 2:
+				continue
+			delays = overlay.delays(rows)
+			departures = (table.departure[rows] + delays).tolist()
+			arrivals = (table.arrival[rows] + delays).tolist()
+			stops = table.stopIndex[rows].tolist()
+			skipped = overlay.skippedRows[rows].tolist()
+			rows = rows.tolist()
+			for i in range(len(rows) - 1):
+				patch.append((departures[i], arrivals[i + 1], rows[i], stops[i], stops[i + 1],
+						trip, not skipped[i], not skipped[i + 1]))
+		patch.sort()
+		self.patches[key] = (overlay.version, affected, patch)
+		return affected, patch
+
+	# the day's static connections from first on, leaving out trips the
+	# overlay changed, in the same tuples as getPatch
+	@staticmethod
+	def unaffected(day, first, affected):
+		for c in range(first, len(day)):
+			trip = day.trip[c]
+			if trip not in affected:
+				yield (day.departure[c], day.arrival[c], day.rows[c], day.departureStop[c],
+						day.arrivalStop[c], trip, True, True)
+
+	# earliest arrival at every stop from origins leaving at departure;
+	# stops at target once it cannot improve, and at connections leaving
+	# after until. With offsets, origins[i] is reached offsets[i] seconds
+	# later on foot, so no footpath starts there until a vehicle arrives.
+	# Returns (earliest, reachedBy, rodeBy) as lists by stop index.
+	def scan(self, origins, date, departure, target = None, until = None, offsets = None):
+		day = self.getDay(date)
+		stopCount = len(self.schedule.stopTimes.stops)
+		earliest = [math.inf] * stopCount
+		# footpaths are not transitive, so walks only start from a stop when
+		# a vehicle (or the start) gets there sooner than before
+		arrived = [math.inf] * stopCount
+		# stop index -> (boarding row, alighting row) or
+		# (None, walked-from stop index) for earliest; None at the start
+		reachedBy = [None] * stopCount
+		# stop index -> (boarding row, alighting row) for arrived, which a
+		# walk from that stop continues
+		rodeBy = [None] * stopCount
+		boarded = {}
+		footpaths = self.footpaths
+
+		if offsets is not None:
+			for origin, offset in zip(origins, offsets):
+				earliest[origin] = min(earliest[origin], departure + offset)
+		else:
+			for origin in origins:
+				arrived[origin] = departure
+				earliest[origin] = departure
+			for origin in origins:
+				for other, seconds in footpaths.get(origin, ()):
+					if departure + seconds < earliest[other]:
+						earliest[other] = departure + seconds
+						reachedBy[other] = (None, origin)
+		limit = math.inf if until is None else until
+
+		first = day.firstAfter(departure)
+		if self.schedule.overlay.active:
+			affected, patch = self.getPatch(date)
+			patch = patch[bisect_left(patch, (departure,)):]
+			connections = heapq.merge(ConnectionScan.unaffected(day, first, affected), patch)
+			for dep, arr, row, depStop, stop, trip, canBoard, canAlight in connections:
+				if dep > limit or (target is not None and dep >= earliest[target]):
+					break
+				if trip not in boarded:
+					if not canBoard or earliest[depStop] > dep:
+						continue
+					boarded[trip] = row
+				if canAlight and arr < arrived[stop]:
+					arrived[stop] = arr
+					rodeBy[stop] = (boarded[trip], row + 1)
+					if arr < earliest[stop]:
+						earliest[stop] = arr
+						reachedBy[stop] = rodeBy[stop]
+					for other, seconds in footpaths.get(stop, ()):
+						if arr + seconds < earliest[other]:
+							earliest[other] = arr + seconds
+							reachedBy[other] = (None, stop)
+			return earliest, reachedBy, rodeBy
+
+		# the same loop over the static lists alone, kept apart because it
+		# is the common case and much faster without tuples
+		rows = day.rows
+		trips = day.trip
+		departureStops = day.departureStop
+		arrivalStops = day.arrivalStop
+		departures = day.departure
+		arrivals = day.arrival
+		for c in range(first, len(day)):
+			dep = departures[c]
+			if dep > limit or (target is not None and dep >= earliest[target]):
+				break
+			trip = trips[c]
+			if trip not in boarded:
+				if earliest[departureStops[c]] > dep:
+					continue
+				boarded[trip] = rows[c]
+			arr = arrivals[c]
+			stop = arrivalStops[c]
+			if arr < arrived[stop]:
+				arrived[stop] = arr
+				rodeBy[stop] = (boarded[trip], rows[c] + 1)
+				if arr < earliest[stop]:
+					earliest[stop] = arr
+					reachedBy[stop] = rodeBy[stop]
+				for other, seconds in footpaths.get(stop, ()):
+					if arr + seconds < earliest[other]:
+						earliest[other] = arr + seconds
+						reachedBy[other] = (None, stop)
+
+		return earliest, reachedBy, rodeBy
+
+	def query(self, origin, destination, date, departure):
+		with instrument.span("query.journey"):
+			return self.findJourney(origin, destination, date, departure)
+
+	def findJourney(self, origin, destination, date, departure):
+		table = self.schedule.stopTimes
+		start = departure.seconds
+		earliest, reachedBy, rodeBy = self.scan([origin.index], date, start, destination.index)
+		if earliest[destination.index] == math.inf:
+			return None
+
+		legs = []
+		stop = destination.index
+		leg = reachedBy[stop]
+		while leg is not None:
+			board, alight = leg
+			if board is None:
+				# the walk leaves when the ride into walkedFrom gets there
+				walkedFrom = alight
+				leg = rodeBy[walkedFrom]
+				if leg is None:
+					leaves = earliest[walkedFrom]
+				else:
+					leaves = table.stopTime(leg[1]).arrivalSeconds
+				arrival = time_space.Time(seconds = earliest[stop])
+				departure = time_space.Time(seconds = leaves)
+				legs.append(Walk(table.stops[walkedFrom], table.stops[stop], departure, arrival))
+				stop = walkedFrom
+			else:
+				trip = table.trips[table.tripIndex[board]]
+				legs.append(Ride(trip, table.stopTime(board), table.stopTime(alight)))
+				stop = int(table.stopIndex[board])
+				leg = reachedBy[stop]
+
+		journey = Journey()
+		for leg in reversed(legs):
+			journey.addRide(leg)
+		return journey
+
+def main():
+	import datetime
+	import schedule
+	import snapshot
+	sched = snapshot.loadSchedule(schedule.RAIL_PATH)
+	planner = ConnectionScan(sched)
+	stops = list(sched.stops.values())
+	journey = planner.query(stops[0], stops[-1], datetime.date(2016, 10, 5),
+			time_space.Time(8))
+	print(journey)
+
+if __name__ == "__main__":
+	main()